@@ -0,0 +1,145 @@
+"""Connections to AWS for the scripts, made when they are first wanted.
+
+boto is only imported once a connection is actually needed, so asking a
+script for --help, or having it fail on its options or its config, costs
+nothing. Each thread gets one connection per service however many times
+it asks (boto connections aren't safe to share between threads, but each
+one keeps its sockets open between requests). Buckets are looked up by
+name with a single request rather than by listing every bucket, and a
+bucket found by one thread is known to every other."""
+
+import threading
+
+class session:
+
+	def __init__(self, access_key, access_secret, host=None, port=None, is_secure=None):
+
+		self.access_key = access_key
+		self.access_secret = access_secret
+
+		self.host = host
+		self.port = port
+		self.is_secure = is_secure
+
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.buckets = {}
+
+	def s3(self):
+
+		conn = getattr(self.local, 's3', None)
+
+		if conn is None:
+			conn = self.local.s3 = self.connect_s3()
+
+		return conn
+
+	def ec2(self):
+
+		conn = getattr(self.local, 'ec2', None)
+
+		if conn is None:
+			conn = self.local.ec2 = self.connect_ec2()
+
+		return conn
+
+	def connect_s3(self):
+
+		from boto.s3.connection import S3Connection
+		from boto.s3.connection import OrdinaryCallingFormat
+
+		# Something other than AWS, like the stand-in in s3_fake.py,
+		# which only understands path-style requests
+
+		args = {}
+
+		if self.host:
+			args['host'] = self.host
+			args['calling_format'] = OrdinaryCallingFormat()
+
+		if self.port:
+			args['port'] = self.port
+
+		if self.is_secure is not None:
+			args['is_secure'] = self.is_secure
+
+		return S3Connection(self.access_key, self.access_secret, **args)
+
+	def connect_ec2(self):
+
+		from boto.ec2.connection import EC2Connection
+		return EC2Connection(self.access_key, self.access_secret)
+
+	# The bucket called name, on this thread's connection, or None if there
+	# is no such bucket. With create, a missing bucket is created, and
+	# without validate the bucket is taken to exist.
+
+	def bucket(self, name, create=False, validate=True):
+
+		from boto.s3.bucket import Bucket
+
+		# boto hands back names as unicode, which would make every
+		# request made through the bucket unicode too
+
+		if isinstance(name, unicode):
+			name = name.encode('utf-8')
+
+		self.lock.acquire()
+
+		try:
+			known = name in self.buckets or not validate
+		finally:
+			self.lock.release()
+
+		if known:
+			return Bucket(self.s3(), name)
+
+		bucket = self.s3().lookup(name)
+
+		if bucket is None:
+
+			if not create:
+				return None
+
+			bucket = self.s3().create_bucket(name)
+
+		self.lock.acquire()
+
+		try:
+			self.buckets[name] = True
+		finally:
+			self.lock.release()
+
+		return bucket
+
+	# An upload started on another thread, for adding parts to it on this
+	# thread's connection
+
+	def multipart_upload(self, bucket_name, key_name, upload_id):
+
+		from boto.s3.multipart import MultiPartUpload
+
+		mp = MultiPartUpload(self.bucket(bucket_name))
+		mp.key_name = key_name
+		mp.id = upload_id
+
+		return mp
+
+# For the s3-* scripts, whose config has an [aws] section with access_key
+# and access_secret (and host, port and is_secure for something that
+# isn't AWS)
+
+def from_config(cfg, section='aws'):
+
+	args = {}
+
+	if cfg.has_option(section, 'host'):
+		args['host'] = cfg.get(section, 'host')
+
+	if cfg.has_option(section, 'port'):
+		args['port'] = cfg.getint(section, 'port')
+
+	if cfg.has_option(section, 'is_secure'):
+		args['is_secure'] = cfg.getboolean(section, 'is_secure')
+
+	return session(cfg.get(section, 'access_key'), cfg.get(section, 'access_secret'), **args)
@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 
-import boto
 import ConfigParser
 import optparse
 import logging
@@ -10,9 +9,13 @@ import os
 import os.path
 import pipes
 import sys
+import threading
 import time
 import types
 
+import aws_session
+import ec2_waiter
+
 class launch:
 
     def __init__(self, options):
@@ -24,6 +27,7 @@ class launch:
 
         self.default_section = 'default'
 
+        self.session = None
         self.conn = None
 
         self.cache_images = {}
@@ -56,8 +60,8 @@ class launch:
             key = self.read_config('aws_key')
             secret = self.read_config('aws_secret')
 
-            from boto.ec2.connection import EC2Connection
-            self.conn = EC2Connection(key, secret)
+            self.session = aws_session.session(key, secret)
+            self.conn = self.session.ec2()
         except Exception, e:
             logging.error("failed to create EC2 connection: %s" % e)
             return False
@@ -136,29 +140,13 @@ class launch:
 
         logging.info('created new volume with ID %s' % volume.id)
 
-        status = None
-        tries = 0
-        max_tries = 30
-
-        while status != 'available':
-
-            volumes = self.conn.get_all_volumes([volume.id])
-            volume = volumes[0]
-            status = volume.status
-
-            logging.info('volume status is %s' % status)
+        volumes = self.wait_for_volumes([volume], 'available', timeout=kwargs.get('timeout', 300))
 
-            if status == 'available':
-                break
-
-            tries += 1
-            if tries >= max_tries:
-                logging.error('max tries for volume status has been exceeded')
-                return None
+        if not volumes:
+            logging.error('volume %s never became available' % volume.id)
+            return None
 
-            time.sleep(10)
-
-        return volume
+        return volumes[0]
 
     # Note: both the instance and the volume need to be in the same availability zone
 
@@ -200,15 +188,32 @@ class launch:
         # http://groups.google.com/group/boto-users/browse_thread/thread/c4051181a1b8904d
         # http://developer.amazonwebservices.com/connect/thread.jspa?threadID=30362&tstart=0
 
-        while status != 'in-use':
-            time.sleep(15)
-            volume.update()
-            status = volume.status
-            logging.info('volume status: %s' % status)
+        if not self.wait_for_volumes([volume], 'in-use', timeout=kwargs.get('timeout', 300)):
+            logging.error('volume %s never attached to %s' % (volume.id, instance.id))
+            return False
 
         logging.info('volume is ok to mount!')
         return True
 
+    # Waits for the volumes to get to status (checking on all of them with
+    # one request each time) and returns the ones that did, fresh from
+    # EC2.
+
+    def wait_for_volumes(self, volumes, status, timeout=300):
+
+        def on_change(volume, old, new):
+            logging.info('volume %s status: %s' % (volume.id, new))
+
+        w = ec2_waiter.waiter(lambda ids: self.conn.get_all_volumes(volume_ids=ids),
+                              lambda volume: volume.status,
+                              (status,), ('error', 'deleting', 'deleted'),
+                              what='volume', base_delay=2, max_delay=15, timeout=timeout,
+                              on_change=on_change)
+
+        done, failed, pending = w.wait([ volume.id for volume in volumes ])
+
+        return [ done[volume.id] for volume in volumes if volume.id in done ]
+
     def mount_ebs_volume(self, **kwargs):
 
         if not self.options.ssh_key:
@@ -229,18 +234,16 @@ class launch:
 
             mkfs_cmd = 'mkfs -F -L CACHE2 -m 10 -t ext3 %s' % device
 
-            status = 1
-
             # we have to do this kind of crap because even though
             # the volume is marked as 'in-use' it may not actually
             # be ready...
 
-            while status != 0:
-                status = self.execute_ssh_command(host, mkfs_cmd)
+            ok = ec2_waiter.until(lambda: self.execute_ssh_command(host, mkfs_cmd) == 0,
+                                  what='EBS device on %s' % host,
+                                  base_delay=2, max_delay=15, timeout=kwargs.get('timeout', 300))
 
-                if status != 0:
-                    logging.info('waiting for EBS device...')
-                    time.sleep(15)
+            if not ok:
+                return False
 
         # ok now finish it up...
 
@@ -309,14 +312,31 @@ class launch:
 
     def launch_instance(self, **kwargs):
 
+        instances = self.launch_instances(count=1, **kwargs)
+
+        if not instances:
+            return None
+
+        return instances[0]
+
+    # Launches count instances in a single reservation (or as many as EC2
+    # will give us, so long as that is at least min_count) and returns
+    # the ones that are running once they all are, or once timeout
+    # seconds have gone by.
+
+    def launch_instances(self, count=1, min_count=None, timeout=300, **kwargs):
+
         ima = kwargs.get('class', self.default_section)
 
+        if not min_count:
+            min_count = count
+
         # what are we actually launching?
 
         image = self.load_image(**kwargs)
 
         if not image:
-            return None
+            return []
 
         # http://code.google.com/p/boto/source/browse/trunk/boto/ec2/image.py
         # http://code.google.com/p/boto/wiki/EC2InstanceTypes
@@ -346,35 +366,47 @@ class launch:
         userdata = self.mk_userdata(bootstrap_files, **kwargs)
 
         try :
-            reservation = image.run(1, 1, keypair, groups, userdata, None, instance_type)
+            reservation = image.run(min_count, count, keypair, groups, userdata, None, instance_type)
         except Exception, e :
             logging.error("failed to create image: %s" % e)
-            return None
+            return []
 
-        instance = reservation.instances[0]
-        status = instance.state
-        attempts = 0
-        max_attempts = 20
+        logging.info("[%s] reservation %s has %s instances" % (ima, reservation.id, len(reservation.instances)))
 
-        while status != 'running':
-            attempts += 1
-            time.sleep(5)
+        instances = self.wait_for_instances(reservation.instances, timeout)
 
-            try:
-                instance.update()
-            except Exception, e:
-                logging.warning("failed to update instance %s: %s" % (instance.id, e))
+        for instance in instances:
+            self.instance_info(ima, instance)
+
+        return instances
+
+    # Polls all of the instances with one request each time. The
+    # instances that come back are fresh from EC2, so unlike the ones
+    # from the reservation (or instance.update()) they have their private
+    # IP addresses. Returns the running ones, which on a timeout may not
+    # be all of them.
+
+    def wait_for_instances(self, instances, timeout=300):
+
+        def on_change(instance, old, new):
+            logging.info("instance %s is %s" % (instance.id, new))
 
-                if attempts >= max_attempts:
-                    logging.error("failed to create instance after %s attempts ...giving up" % max_attempts)
-                    return None
+        def on_failed(instance):
+            logging.error("instance %s is %s, giving up on it" % (instance.id, instance.state))
 
-            status = instance.state
+        def describe(ids):
+            return [ i for r in self.conn.get_all_instances(instance_ids=ids) for i in r.instances ]
 
-        instance = self.refresh_instance(instance)
-        self.instance_info(ima, instance)
+        w = ec2_waiter.waiter(describe, lambda instance: instance.state,
+                              ('running',), ('shutting-down', 'terminated', 'stopping', 'stopped'),
+                              what='instance', base_delay=2, max_delay=20, timeout=timeout,
+                              on_change=on_change, on_failed=on_failed)
 
-        return instance
+        running, failed, pending = w.wait([ instance.id for instance in instances ])
+
+        # in the order they were launched
+
+        return [ running[instance.id] for instance in instances if instance.id in running ]
 
     def mk_userdata(self, bootstrap_files, **kwargs):
 
@@ -412,22 +444,6 @@ class launch:
 
         return data
 
-    # This is a hack to account for the fact that the boto _update
-    # method doesn't update the private IP when an instance is spun
-    # up.
-
-    def refresh_instance(self, instance):
-
-        try:
-            id = str(instance.id)
-            r = self.conn.get_all_instances(id)
-            instance = r[0].instances[0]
-        except Exception, e:
-            logging.error("failed to refresh instance, %s" % e)
-            return None
-
-        return instance
-
     def instance_info(self, ima, instance):
 
         logging.info("[%s] instance id: %s" % (ima, instance.id))
@@ -435,47 +451,71 @@ class launch:
         logging.info("[%s] public IP address: %s" % (ima, instance.ip_address))
         logging.info("[%s] private IP address: %s" % (ima, instance.private_ip_address))
 
-    def ensure_setup(self, launched, check_file='/etc/stamen/created'):
+    # Probes every host for check_file at once (with no more than
+    # ssh_workers ssh commands running at a time), each on its own
+    # backoff schedule, so a slow host doesn't hold up checking on the
+    # others. Returns { hostname: seconds until it was up, or None }.
+
+    def ensure_setup(self, launched, check_file='/etc/stamen/created', timeout=3000):
 
         if not self.options.ssh_key:
             logging.error('No SSH key defined, so unable to ensure userdata setup')
             return False
 
-        ok = 0
-        required_ok = len(launched)
+        slots = threading.Semaphore(max(1, getattr(self.options, 'ssh_workers', 8)))
+        ready = {}
+
+        started = time.time()
+
+        def probe(hostname):
+
+            slots.acquire()
+
+            try:
+                status = self.execute_ssh_command(hostname, 'cat %s' % check_file, connect_timeout=5)
+            finally:
+                slots.release()
+
+            return status == 0
+
+        def wait(hostname):
 
-        seen = {}
+            ok = ec2_waiter.until(lambda: probe(hostname), what=hostname,
+                                  base_delay=2, max_delay=30, timeout=timeout)
 
-        cycles = 0
-        max_cycles = 100
+            if ok:
+                ready[hostname] = time.time() - started
+                logging.info("%s is up after %.0fs!" % (hostname, ready[hostname]))
 
-        while ok < required_ok:
-            for instance in launched:
+        threads = []
 
-                hostname = instance.public_dns_name
+        for instance in launched:
 
-                if seen.get(hostname, False):
-                    continue
+            t = threading.Thread(target=wait, args=(instance.public_dns_name,))
+            t.setDaemon(True)
+            t.start()
 
-                ssh_command = 'cat %s' % check_file
+            threads.append(t)
 
-                status = self.execute_ssh_command(hostname, ssh_command)
+        # join() with a timeout, so that ^C still works
 
-                if status == 0:
-                    logging.info("%s is up!" % hostname)
-                    ok += 1
+        for t in threads:
+            while t.isAlive():
+                t.join(1)
 
-                    seen[ hostname ] = True
+        times = {}
 
-            cycles += 1
+        for instance in launched:
 
-            if cycles == max_cycles:
-                logging.warning("exceeded max cycles to wait for start up, bailing")
-                break
+            hostname = instance.public_dns_name
+            times[hostname] = ready.get(hostname)
 
-            if ok < required_ok:
-                logging.info("sleeping...")
-                time.sleep(30)
+            if times[hostname] is None:
+                logging.warning("%s never came up" % hostname)
+            else:
+                logging.info("%s ready in %.0fs" % (hostname, times[hostname]))
+
+        return times
 
     def execute_ssh_commands(self, host, ssh_commands, abort_on_error=False):
 
@@ -486,9 +526,20 @@ class launch:
             if abort_on_error:
                 return status
 
-    def execute_ssh_command(self, host, cmd):
+    def execute_ssh_command(self, host, cmd, connect_timeout=None):
+
+        # For probing hosts that may not be up yet: give up quickly rather
+        # than waiting out the TCP timeout, and never stop to ask for a
+        # password. BatchMode also means nobody can be asked to accept
+        # the host key, which a new instance's always is, so new keys are
+        # accepted (and changed ones still refused).
+
+        ssh_opts = ''
 
-        ssh_cmd = "ssh -l root -i %s %s \"%s\"" % (self.options.ssh_key, host, cmd)
+        if connect_timeout:
+            ssh_opts = '-o ConnectTimeout=%s -o BatchMode=yes -o StrictHostKeyChecking=accept-new ' % connect_timeout
+
+        ssh_cmd = "ssh %s-l root -i %s %s \"%s\"" % (ssh_opts, self.options.ssh_key, host, cmd)
         logging.info(ssh_cmd)
 
         (status, out) = commands.getstatusoutput(ssh_cmd)
@@ -500,6 +551,8 @@ class launch:
 
 if __name__ == '__main__' :
 
+    import boto
+
     if not boto.Version.startswith('1.9'):
         logging.error("Boto too old. Need 1.9, have %s" % boto.Version)
         sys.exit()
@@ -518,6 +571,26 @@ if __name__ == '__main__' :
                         help='...',
                         action='store_true', default=False)
 
+    parser.add_option('--ssh-workers', dest='ssh_workers',
+                        help='number of hosts to check on over SSH at once (default: 8)',
+                        action='store', type='int', default=8)
+
+    parser.add_option('-n', '--count', dest='count',
+                        help='number of instances to launch (default: 1)',
+                        action='store', type='int', default=1)
+
+    parser.add_option('--min-count', dest='min_count',
+                        help='launch fewer than --count instances rather than none if EC2 can not provide them all, but at least this many',
+                        action='store', type='int', default=None)
+
+    parser.add_option('--timeout', dest='timeout',
+                        help='seconds to wait for the instances to be running before carrying on with those that are (default: 300)',
+                        action='store', type='int', default=300)
+
+    parser.add_option('--ebs-each', dest='ebs_each',
+                        help='with ebs_attach_volume and more than one instance, create, attach and format a new volume for each instance after the first',
+                        action='store_true', default=False)
+
     # Can has config?
 
     options, args = parser.parse_args()
@@ -528,23 +601,42 @@ if __name__ == '__main__' :
     ec2 = launch(options)
     ec2.connect()
 
-    instance = ec2.launch_instance()
-    ec2.ensure_setup([instance])
+    instances = ec2.launch_instances(count=options.count, min_count=options.min_count, timeout=options.timeout)
+
+    if not instances:
+        logging.error("no instances are running")
+        sys.exit(1)
+
+    ec2.ensure_setup(instances)
 
     if ec2.read_config('ebs_attach_volume'):
 
         volume_id = ec2.read_config('ebs_volume_id')
         volume_size = ec2.read_config('ebs_volume_size')
 
-        args = { 'instance' : instance }
+        # Only the first instance gets a volume (the configured one, if
+        # there is one, which can only be attached to one instance)
+        # unless each of them is asked for a new one of its own
+
+        targets = instances[:1]
+
+        if options.ebs_each:
+            targets = instances
+        elif len(instances) > 1:
+            logging.info("setting up EBS for %s only, use --ebs-each to give every instance a volume" % instances[0].id)
+
+        for instance in targets:
+
+            args = { 'instance' : instance }
 
-        if volume_id:
-            args['volume_id'] = volume_id
+            if volume_id:
+                args['volume_id'] = volume_id
+                volume_id = None
 
-        if volume_size:
-            args['size'] = volume_size
+            if volume_size:
+                args['size'] = volume_size
 
-        volume = ec2.setup_ebs_volume(**args)
+            volume = ec2.setup_ebs_volume(**args)
 
     #
 
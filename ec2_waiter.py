@@ -0,0 +1,182 @@
+"""Waiting for EC2 resources (instances, volumes) to get where we want them.
+
+A waiter polls any number of resources with one describe request per
+round, rather than one each, and sleeps between rounds for an
+exponentially growing, jittered delay up to a ceiling. The delay starts
+over whenever something changes state, since once one thing moves the
+rest usually aren't far behind. Nothing waits past its deadline: what
+hasn't got there by then is handed back as still pending, for the caller
+to decide what to do about."""
+
+import logging
+import random
+import time
+
+class backoff:
+
+    def __init__(self, base_delay=1.0, max_delay=30.0, timeout=None):
+
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt = 0
+
+        self.deadline = None
+
+        if timeout:
+            self.deadline = time.time() + timeout
+
+    def remaining(self):
+
+        if self.deadline is None:
+            return None
+
+        return max(0, self.deadline - time.time())
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def reset(self):
+        self.attempt = 0
+
+    # Somewhere between half and all of base_delay * 2 ** attempt, so that
+    # we never poll much faster than we mean to but several waiters
+    # started together don't stay in step. Returns False, without
+    # sleeping, once the deadline has passed.
+
+    def sleep(self):
+
+        if self.expired():
+            return False
+
+        delay = min(self.max_delay, self.base_delay * 2 ** self.attempt)
+        delay = random.uniform(delay / 2.0, delay)
+
+        remaining = self.remaining()
+
+        if remaining is not None:
+            delay = min(delay, remaining)
+
+        self.attempt += 1
+        time.sleep(delay)
+
+        return True
+
+# describe(ids) returns the resources with those ids (anything with an
+# id), state(resource) says what state one is in. The callbacks are
+# called with the resource as it was just described: on_change(resource,
+# old state, new state) for every change, including the first time it is
+# seen, on_done(resource) once it is in one of the done states and
+# on_failed(resource) once it is in one of the failed ones, after which
+# it is not polled again.
+
+class waiter:
+
+    def __init__(self, describe, state, done, failed=(), what='resource', base_delay=1.0, max_delay=30.0, timeout=300, on_change=None, on_done=None, on_failed=None):
+
+        self.describe = describe
+        self.state = state
+        self.done = done
+        self.failed = failed
+        self.what = what
+
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+
+        self.on_change = on_change
+        self.on_done = on_done
+        self.on_failed = on_failed
+
+    # Returns (done, failed, pending): the resources that got to a done
+    # state and those that failed, both as { id: resource }, and the ids
+    # still pending at the deadline.
+
+    def wait(self, ids):
+
+        pending = list(ids)
+        states = {}
+
+        done = {}
+        failed = {}
+
+        b = backoff(self.base_delay, self.max_delay, self.timeout)
+
+        while pending:
+
+            # A resource that was only just created may not be
+            # described yet, which is just like it not being ready
+
+            try:
+                resources = self.describe(pending)
+            except Exception, e:
+                logging.warning("failed to describe %s %ss: %s" % (len(pending), self.what, e))
+                resources = []
+
+            changed = False
+
+            for resource in resources:
+
+                if not resource.id in pending:
+                    continue
+
+                new = self.state(resource)
+                old = states.get(resource.id)
+
+                if new != old:
+
+                    states[resource.id] = new
+                    changed = True
+
+                    if self.on_change:
+                        self.on_change(resource, old, new)
+
+                if new in self.done:
+
+                    done[resource.id] = resource
+                    pending.remove(resource.id)
+
+                    if self.on_done:
+                        self.on_done(resource)
+
+                elif new in self.failed:
+
+                    failed[resource.id] = resource
+                    pending.remove(resource.id)
+
+                    if self.on_failed:
+                        self.on_failed(resource)
+
+            if not pending:
+                break
+
+            if changed:
+                b.reset()
+
+            if not b.sleep():
+                logging.error("%s %ss still not ready after %ss: %s" % (len(pending), self.what, self.timeout, ', '.join(pending)))
+                break
+
+        return done, failed, pending
+
+# For things that can only be found out by trying: calls fn until it
+# returns something true, backing off in between, and returns what it
+# returned or None if the deadline passed first.
+
+def until(fn, what='operation', base_delay=1.0, max_delay=30.0, timeout=300):
+
+    b = backoff(base_delay, max_delay, timeout)
+
+    while True:
+
+        rsp = fn()
+
+        if rsp:
+            return rsp
+
+        logging.info("waiting for %s..." % what)
+
+        if not b.sleep():
+            logging.error("%s still not done after %ss" % (what, timeout))
+            return None
+
+# -*- indent-tabs-mode:nil tab-width:4 -*-
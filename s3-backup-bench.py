@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""Benchmarks for s3-backup.py. Starts the S3 stand-in from s3_fake.py,
+generates synthetic trees and times s3-backup.py over each of them in
+three scenarios: cold (nothing stored yet), warm (nothing changed) and
+changed (1% of the files rewritten). Results are written as one JSON
+object per line.
+
+The stand-in runs in its own process, partly so that it doesn't compete
+with the backup for the GIL and partly because a forked child's peak RSS
+includes whatever its parent was holding at the time of the fork."""
+
+import sys
+import os
+import os.path
+import httplib
+import json
+import logging
+import random
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+
+logging.basicConfig(level=logging.INFO)
+
+class bench:
+
+	def __init__(self, options):
+
+		self.options = options
+		self.root = tempfile.mkdtemp(prefix='s3-backup-bench-')
+
+		here = os.path.dirname(os.path.abspath(__file__))
+
+		self.script = os.path.join(here, 's3-backup.py')
+
+		args = [ sys.executable, os.path.join(here, 's3_fake.py'), '-p', '0', '-l', str(options.latency) ]
+		self.server = subprocess.Popen(args, stderr=subprocess.PIPE)
+
+		# INFO:root:fake S3 listening on 127.0.0.1:40123
+
+		host, port = self.server.stderr.readline().strip().split(' ')[-1].split(':')
+
+		self.server_conn = httplib.HTTPConnection(host, int(port))
+		self.fake_request('PUT', '/bench')
+
+		self.config = os.path.join(self.root, 'bench.cfg')
+
+		fh = open(self.config, 'w')
+		fh.write('[aws]\naccess_key = bench\naccess_secret = bench\nhost = %s\nport = %s\nis_secure = false\n' % (host, port))
+		fh.close()
+
+	def fake_request(self, method, path):
+
+		self.server_conn.request(method, path)
+		return self.server_conn.getresponse().read()
+
+	def stats(self):
+		return json.loads(self.fake_request('GET', '/_stats'))
+
+	def cleanup(self):
+
+		self.server.terminate()
+		self.server.wait()
+
+		shutil.rmtree(self.root)
+
+	def write(self, path, size):
+
+		fh = open(path, 'wb')
+
+		while size > 0:
+
+			chunk = os.urandom(min(size, 1024 * 1024))
+			fh.write(chunk)
+			size -= len(chunk)
+
+		fh.close()
+
+	# Returns the list of files created
+
+	def make_tree(self, kind):
+
+		directory = os.path.join(self.root, kind)
+		files = []
+
+		if kind == 'small':
+
+			for i in range(self.options.small_files):
+				files.append((os.path.join(directory, '%04d' % (i / 100), '%06d' % i), random.randint(1024, 8192)))
+
+		elif kind == 'large':
+
+			for i in range(self.options.large_files):
+				files.append((os.path.join(directory, 'large-%02d' % i), self.options.large_size * 1024 * 1024))
+
+		elif kind == 'deep':
+
+			for i in range(self.options.deep_files):
+
+				parts = [ 'd%s' % ((i >> n) & 1) for n in range(self.options.depth) ]
+				files.append((os.path.join(directory, *(parts + [ '%06d' % i ])), random.randint(1024, 8192)))
+
+		for path, size in files:
+
+			parent = os.path.dirname(path)
+
+			if not os.path.isdir(parent):
+				os.makedirs(parent)
+
+			self.write(path, size)
+
+		return directory, [ path for path, size in files ]
+
+	def change(self, files, fraction):
+
+		changed = random.sample(files, max(1, int(len(files) * fraction)))
+		later = time.time() + 2
+
+		for path in changed:
+
+			self.write(path, os.path.getsize(path))
+			os.utime(path, (later, later))
+
+		return len(changed)
+
+	def run_backup(self, kind, directory):
+
+		args = [ sys.executable, self.script, '-c', self.config, '-D', directory, '-B', 'bench', '-p', kind ]
+		args.extend(shlex.split(self.options.backup_args))
+
+		log = open(os.path.join(self.root, 'backup-%s.log' % kind), 'w+')
+
+		self.stats()
+		start = time.time()
+
+		# wait4 rather than wait so that we get the child's own peak RSS
+
+		proc = subprocess.Popen(args, stdout=log, stderr=subprocess.STDOUT)
+		pid, status, rusage = os.wait4(proc.pid, 0)
+
+		elapsed = time.time() - start
+		stats = self.stats()
+
+		log.seek(0)
+		stored = re.findall('backup completed, (\d+) new files stored', log.read())
+		log.close()
+
+		return {
+			'elapsed': round(elapsed, 3),
+			'exit_status': status >> 8,
+			'stored': int(stored[-1]) if stored else None,
+			'requests': stats['requests'],
+			'requests_total': sum(stats['requests'].values()),
+			'bytes_uploaded': stats['bytes_in'],
+			'bytes_per_sec': round(stats['bytes_in'] / elapsed, 1),
+			'peak_rss_kb': rusage.ru_maxrss,
+		}
+
+	def run(self, out):
+
+		for kind in self.options.trees.split(','):
+
+			logging.info('generating %s tree' % kind)
+
+			directory, files = self.make_tree(kind)
+			total = sum([ os.path.getsize(path) for path in files ])
+
+			# s3-backup.py keeps its index next to the config, so every
+			# tree starts without one
+
+			index = os.path.join(self.root, 'bench-index.db')
+
+			if os.path.exists(index):
+				os.unlink(index)
+
+			for scenario in ('cold', 'warm', 'changed'):
+
+				changed = 0
+
+				if scenario == 'changed':
+					changed = self.change(files, self.options.changed)
+
+				logging.info('run %s backup of %s tree' % (scenario, kind))
+
+				result = self.run_backup(kind, directory)
+				result['files_per_sec'] = round(len(files) / result['elapsed'], 1)
+
+				result.update({
+					'tree': kind,
+					'scenario': scenario,
+					'files': len(files),
+					'bytes': total,
+					'changed': changed,
+					'latency': self.options.latency,
+					'backup_args': self.options.backup_args,
+				})
+
+				out.write(json.dumps(result, sort_keys=True) + '\n')
+				out.flush()
+
+			shutil.rmtree(directory)
+
+if __name__ == '__main__':
+
+	import optparse
+
+	parser = optparse.OptionParser(usage="""s3-backup-bench.py [options]""")
+
+	parser.add_option('-t', '--trees', dest='trees', action='store', default='small,large,deep',
+			  help='comma-separated trees to generate: small, large, deep (default: all of them)')
+	parser.add_option('-a', '--backup-args', dest='backup_args', action='store', default='-M -i -m -w 8',
+			  help='arguments passed to s3-backup.py (default: "-M -i -m -w 8")')
+	parser.add_option('-l', '--latency', dest='latency', action='store', type='float', default=0.01,
+			  help='seconds of latency added to every request (default: 0.01)')
+	parser.add_option('-o', '--output', dest='output', action='store', default=None,
+			  help='write results here rather than to stdout')
+
+	parser.add_option('--small-files', dest='small_files', action='store', type='int', default=10000)
+	parser.add_option('--large-files', dest='large_files', action='store', type='int', default=4)
+	parser.add_option('--large-size', dest='large_size', action='store', type='int', default=64,
+			  help='size of each large file in MB (default: 64)')
+	parser.add_option('--deep-files', dest='deep_files', action='store', type='int', default=1000)
+	parser.add_option('--depth', dest='depth', action='store', type='int', default=16)
+	parser.add_option('--changed', dest='changed', action='store', type='float', default=0.01,
+			  help='fraction of files to rewrite for the changed scenario (default: 0.01)')
+	parser.add_option('--seed', dest='seed', action='store', type='int', default=None)
+
+	options, args = parser.parse_args()
+
+	random.seed(options.seed)
+
+	out = sys.stdout
+
+	if options.output:
+		out = open(options.output, 'w')
+
+	b = bench(options)
+
+	try:
+		b.run(out)
+	finally:
+		b.cleanup()
+
+	sys.exit()
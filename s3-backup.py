@@ -5,183 +5,2427 @@
 import sys
 import os
 import os.path
-import httplib
+import mimetypes
 import logging
 import time
+import calendar
+import sqlite3
+import threading
+import Queue
+import collections
+import multiprocessing
+import hashlib
+import fnmatch
+import re
+import stat
+import gzip
+import tempfile
+import json
+import zlib
+
+from cStringIO import StringIO
+
+import aws_session
+import s3_dedup
+import s3_digest
+import s3_inotify
+import s3_metrics
+import s3_pack
+import s3_pool
+import s3_scheduler
+
+# os.scandir is Python 3.5+; on older Pythons use the scandir module if
+# it is installed and os.listdir + os.lstat if it is not.
+
+try:
+	from os import scandir
+except ImportError:
+
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
 
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
+logging.basicConfig(level=logging.INFO)
+
+class direntry:
+
+	def __init__(self, root, name):
+
+		self.name = name
+		self.path = os.path.join(root, name)
+		self._lstat = os.lstat(self.path)
+
+	def is_symlink(self):
+		return stat.S_ISLNK(self._lstat.st_mode)
+
+	def is_dir(self):
+		return stat.S_ISDIR(self.stat().st_mode)
+
+	def stat(self):
+
+		if self.is_symlink():
+			return os.stat(self.path)
+
+		return self._lstat
+
+def listdir(root):
+
+	if scandir:
+		return scandir(root)
+
+	return [ direntry(root, name) for name in os.listdir(root) ]
+
+# Walks a tree one directory at a time, yielding (fullpath, relpath, stat)
+# for each regular file as it goes. Excluded directories are pruned before
+# they are read. Rules are globs (matched against the relative path if they
+# contain a '/' and against the name otherwise) or, when prefixed with
+# 're:', regular expressions matched against the relative path.
+
+class scanner:
+
+	def __init__(self, root, include=None, exclude=None):
+
+		self.root = root
+		self.include = [ self.compile(r) for r in (include or []) ]
+		self.exclude = [ self.compile(r) for r in (exclude or []) ]
+
+		# time spent walking, not counting time spent waiting for
+		# whoever is consuming the files
+
+		self.elapsed = 0.0
+		self.dirs = 0
+		self.files_seen = 0
+		self.errors = 0
+
+	def compile(self, rule):
+
+		if rule.startswith('re:'):
+			return ('re', re.compile(rule[3:]))
+
+		if '/' in rule:
+			return ('path', re.compile(fnmatch.translate(rule.strip('/'))))
+
+		return ('name', re.compile(fnmatch.translate(rule)))
+
+	def matches(self, rules, relpath, name):
+
+		for kind, pattern in rules:
+
+			if kind == 'name':
+				target = name
+			else:
+				target = relpath
+
+			if pattern.match(target):
+				return True
+
+		return False
+
+	# Whether the rules keep relpath out of a backup, either because it
+	# or one of its parent directories is excluded or because it isn't
+	# included (which only applies to files)
+
+	def is_filtered(self, relpath, is_dir=False):
+
+		parts = relpath.split('/')
+
+		if self.exclude:
+
+			for i in range(len(parts)):
+
+				if self.matches(self.exclude, '/'.join(parts[:i + 1]), parts[i]):
+					return True
+
+		if self.include and not is_dir and not self.matches(self.include, relpath, parts[-1]):
+			return True
+
+		return False
+
+	def files(self, start=''):
+
+		pending = [ start ]
+		start = time.time()
+
+		while pending:
+
+			reldir = pending.pop()
+			fulldir = os.path.join(self.root, reldir)
+
+			self.dirs += 1
+
+			try:
+				entries = sorted(listdir(fulldir), key=lambda e: e.name)
+			except OSError, e:
+				logging.error('failed to read %s: %s' % (fulldir, e))
+				self.errors += 1
+				continue
+
+			subdirs = []
+
+			for entry in entries:
+
+				relpath = os.path.join(reldir, entry.name)
+
+				if self.exclude and self.matches(self.exclude, relpath, entry.name):
+					logging.debug('excluding %s' % relpath)
+					continue
+
+				try:
+
+					# like os.walk, don't follow symlinks to directories
+
+					if entry.is_dir():
+
+						if not entry.is_symlink():
+							subdirs.append(relpath)
+
+						continue
+
+					st = entry.stat()
+
+				except OSError, e:
+
+					# A symlink to something that isn't there is never
+					# backed up anyway, so it mustn't count as an error
+					# (which would stop --mirror deleting anything)
+
+					if entry.is_symlink():
+						logging.warning('skipping broken symlink %s: %s' % (entry.path, e))
+						continue
+
+					logging.error('failed to stat %s: %s' % (entry.path, e))
+					self.errors += 1
+					continue
+
+				if not stat.S_ISREG(st.st_mode):
+					continue
+
+				if self.include and not self.matches(self.include, relpath, entry.name):
+					continue
+
+				self.files_seen += 1
+				self.elapsed += time.time() - start
+
+				yield entry.path, relpath, st
+
+				start = time.time()
+
+			subdirs.reverse()
+			pending.extend(subdirs)
+
+		self.elapsed += time.time() - start
+
+	# Like files(), for only the given paths (relative to the root),
+	# walking any that are directories. Paths that have gone are
+	# skipped.
+
+	def paths(self, relpaths):
+
+		walked = []
+
+		for relpath in sorted(set(relpaths)):
+
+			if [ d for d in walked if relpath.startswith(d + '/') ]:
+				continue
+
+			fullpath = os.path.join(self.root, relpath)
+
+			try:
+				st = os.lstat(fullpath)
+
+				if stat.S_ISDIR(st.st_mode):
+
+					if not self.is_filtered(relpath, True):
+
+						walked.append(relpath)
+
+						for f in self.files(relpath):
+							yield f
+
+					continue
+
+				st = os.stat(fullpath)
+
+			except OSError:
+				continue
+
+			if not stat.S_ISREG(st.st_mode) or self.is_filtered(relpath):
+				continue
+
+			self.files_seen += 1
+			yield fullpath, relpath, st
+
+# A local record of what has already been stored, so that unchanged files
+# can be skipped with a lookup rather than a request to S3.
+
+class index:
+
+	def __init__(self, path):
+
+		self.path = path
+		self.pending = 0
+
+		# The workers share one connection, so every use of it is
+		# serialized by the lock.
+
+		self.lock = threading.Lock()
+
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.text_factory = str
+		self.db.execute('CREATE TABLE IF NOT EXISTS files (bucket TEXT, key TEXT, path TEXT, size INTEGER, mtime REAL, inode INTEGER, etag TEXT, PRIMARY KEY (bucket, key))')
+		self.db.execute('CREATE TABLE IF NOT EXISTS digests (inode INTEGER, size INTEGER, mtime REAL, part_size INTEGER, digest TEXT, PRIMARY KEY (inode, size, mtime, part_size))')
+		self.db.commit()
+
+	def is_current(self, bucket, key, path, st):
+
+		self.lock.acquire()
+
+		try:
+			row = self.db.execute('SELECT path, size, mtime, inode FROM files WHERE bucket=? AND key=?', (bucket, key)).fetchone()
+		finally:
+			self.lock.release()
+
+		if not row:
+			return False
+
+		return row == (path, st.st_size, st.st_mtime, st.st_ino)
+
+	def store(self, bucket, key, path, st, etag):
+
+		self.lock.acquire()
+
+		try:
+			self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', (bucket, key, path, st.st_size, st.st_mtime, st.st_ino, etag))
+			self.pending += 1
+
+			if self.pending >= 1000:
+				self.db.commit()
+				self.pending = 0
+		finally:
+			self.lock.release()
+
+	# part_size is 0 for the MD5 of the whole file and the part size
+	# for a multipart-style ETag
+
+	def get_digest(self, st, part_size):
+
+		self.lock.acquire()
+
+		try:
+			row = self.db.execute('SELECT digest FROM digests WHERE inode=? AND size=? AND mtime=? AND part_size=?', (st.st_ino, st.st_size, st.st_mtime, part_size)).fetchone()
+		finally:
+			self.lock.release()
+
+		if not row:
+			return None
+
+		return row[0]
+
+	def store_digest(self, st, part_size, digest):
+
+		self.lock.acquire()
+
+		try:
+			self.db.execute('DELETE FROM digests WHERE inode=? AND part_size=?', (st.st_ino, part_size))
+			self.db.execute('INSERT INTO digests VALUES (?, ?, ?, ?, ?)', (st.st_ino, st.st_size, st.st_mtime, part_size, digest))
+			self.pending += 1
+
+			if self.pending >= 1000:
+				self.db.commit()
+				self.pending = 0
+		finally:
+			self.lock.release()
+
+	def forget(self, bucket, key):
+
+		self.lock.acquire()
+
+		try:
+			self.db.execute('DELETE FROM files WHERE bucket=? AND key=?', (bucket, key))
+		finally:
+			self.lock.release()
+
+	def verify(self, bucket, prefix, manifest):
+
+		dropped = 0
+		rows = self.db.execute('SELECT key, size, etag FROM files WHERE bucket=? AND key LIKE ?', (bucket, prefix + '%')).fetchall()
+
+		for key, size, etag in rows:
+
+			remote = manifest.get(key, None)
+
+			if remote and remote[0] == size and (not etag or remote[1] == etag):
+				continue
+
+			logging.info('%s has drifted from the index, forgetting it' % key)
+
+			self.forget(bucket, key)
+			dropped += 1
+
+		self.commit()
+
+		logging.info('verified %s index entries against %s, %s dropped' % (len(rows), bucket, dropped))
+		return dropped
+
+	def commit(self):
+
+		self.lock.acquire()
+
+		try:
+			self.db.commit()
+			self.pending = 0
+		finally:
+			self.lock.release()
+
+	def close(self):
+
+		self.commit()
+		self.db.close()
+
+# A plan is what a backup would do, written out so that it can be looked
+# at, or applied later (in shards, or resumed after a crash) with
+# --execute. It is a gzipped text file: a JSON header line, then one
+# tab-separated line per action (op, size, mtime, key, path, with the
+# key and path string-escaped) and a JSON totals line at the end.
+
+class plan:
+
+	def __init__(self, path, header=None):
+
+		self.path = path
+		self.header = header
+		self.lock = threading.Lock()
+
+		self.totals = {}
+		self.writing = header is not None
+		self.journal = None
+
+		if self.writing:
+			self.fh = gzip.open(path, 'wb')
+			self.fh.write('# s3-backup plan %s\n' % json.dumps(header, sort_keys=True))
+
+		else:
+			self.fh = gzip.open(path, 'rb')
+			self.header = json.loads(self.fh.readline().split(' ', 3)[3])
+
+	def count(self, op, size):
+
+		self.lock.acquire()
+
+		try:
+			n, total = self.totals.get(op, (0, 0))
+			self.totals[op] = (n + 1, total + size)
+		finally:
+			self.lock.release()
+
+	def add(self, op, size, mtime, key, path):
+
+		line = '%s\t%s\t%s\t%s\t%s\n' % (op, size, mtime, key.encode('string_escape'), path.encode('string_escape'))
+
+		self.lock.acquire()
+
+		try:
+			self.fh.write(line)
+		finally:
+			self.lock.release()
+
+		self.count(op, size)
+
+	def close(self):
+
+		if self.writing:
+
+			totals = dict([ (op, { 'count': n, 'bytes': b }) for op, (n, b) in self.totals.items() ])
+			self.fh.write('# totals %s\n' % json.dumps(totals, sort_keys=True))
+
+		if self.journal:
+			self.journal.close()
+
+		self.fh.close()
+
+	# Yields (op, size, mtime, key, path) for the actions in shard
+	# number shard of shards
+
+	def entries(self, shard=0, shards=1):
+
+		for line in self.fh:
+
+			if line.startswith('#'):
+				continue
+
+			op, size, mtime, key, path = line.rstrip('\n').split('\t')
+
+			key = key.decode('string_escape')
+			path = path.decode('string_escape')
+
+			if not in_shard(key, shard, shards):
+				continue
+
+			yield op, int(size), float(mtime), key, path
+
+	# The keys that have already been dealt with, so that an interrupted
+	# --execute can pick up where it stopped
+
+	def journal_path(self, shard=0, shards=1):
+
+		if shards > 1:
+			return '%s.done.%s-of-%s' % (self.path, shard, shards)
+
+		return '%s.done' % self.path
+
+	def load_journal(self, shard=0, shards=1):
+
+		done = {}
+		path = self.journal_path(shard, shards)
+
+		if os.path.exists(path):
+
+			for line in open(path, 'rb'):
+				done[line.rstrip('\n').decode('string_escape')] = True
+
+		self.journal = open(path, 'ab')
+		return done
+
+	def mark_done(self, key):
+
+		self.lock.acquire()
+
+		try:
+			self.journal.write(key.encode('string_escape') + '\n')
+			self.journal.flush()
+		finally:
+			self.lock.release()
+
+# Which of the --execute processes a key belongs to
+
+def in_shard(key, shard, shards):
+	return shards <= 1 or (zlib.crc32(key) & 0xffffffff) % shards == shard
+
+class s3:
+
+	def __init__(self, cfg):
+
+		self.cfg = cfg
+		self.session = None
+		self.digests = None
+		self.pool = None
+		self.scheduler = None
+		self.metrics = None
+		self.plan = None
+		self.seen = None
+		self.packs = None
+		self.blobs = None
+		self.partial = False
+
+	# With paths (relative to the directory), only those are backed up
+	# and nothing is deleted
+
+	def backup(self, options, paths=None):
+
+		# The paths are ones inotify saw change, so a copy that is
+		# already stored isn't enough to go on (see is_current)
+
+		self.partial = paths is not None
+
+		# An existing plan knows where things go
+
+		if options.execute:
+
+			self.plan = plan(options.execute)
+
+			for p in ('directory', 'bucket', 'prefix', 'public'):
+				if not getattr(options, p):
+					setattr(options, p, self.plan.header.get(p))
+
+		for p in ('directory', 'bucket', 'public', 'prefix', 'modified', 'force', 'debug', 'include', 'exclude', 'manifest', 'index', 'verify', 'checksum', 'workers', 'multipart_threshold', 'part_size', 'part_workers', 'abort_after', 'pool_size', 'rate', 'bandwidth', 'plan', 'execute', 'shard', 'mirror', 'pack', 'dedup', 'hash_procs'):
+			if paths is None:
+				logging.info('%s: %s' % (p, getattr(options, p)))
+
+		# A plan is one action per key, which a group of packed files
+		# or a run's worth of deduplicated ones isn't (yet)
+
+		if (options.pack or options.dedup) and (options.plan or options.execute):
+			logging.error('--pack and --dedup can not be combined with --plan or --execute')
+			return None
+
+		bucket = None
+
+		try:
+			bucket = self.get_bucket(options)
+		except Exception, e:
+			logging.error('failed to get on with AWS: %s' % e)
+
+			if options.debug:
+				logging.info('debugging is enabled, so carrying on anyway...')
+			else:
+				return None
+
+		#
+
+		manifest = None
+		idx = None
+
+		self.metrics = s3_metrics.metrics('s3backup')
+
+		# --mirror needs the listing even with --force, to know what to delete
+
+		if (options.manifest or options.verify or options.mirror) and not options.debug and (options.mirror or not options.force) and paths is None:
+
+			try:
+				with self.metrics.timer('phase.manifest'):
+					manifest = self.load_manifest(options, bucket)
+			except Exception, e:
+				logging.error('failed to build remote manifest, falling back to HEAD requests: %s' % e)
+
+		# The index file also holds the digest cache for --checksum and
+		# --dedup
+
+		db = None
+
+		if (options.index or options.checksum or options.dedup) and not options.debug:
+			db = index(self.index_path(options))
+
+		if options.index:
+			idx = db
+
+			if idx and options.verify and manifest is not None:
+
+				with self.metrics.timer('phase.verify'):
+					idx.verify(options.bucket, self.key_prefix(options), manifest)
+
+		if options.checksum or options.dedup:
+			self.digests = db
+
+		self.lock = threading.Lock()
+		self.pending = {}
+
+		self.pool = s3_pool.pool(max(options.pool_size, options.workers), options.idle_timeout)
+		self.scheduler = s3_scheduler.scheduler(options.rate, options.bandwidth * 1024, options.workers * max(options.part_workers, 1), retries=options.retries, metrics=self.metrics)
+
+		# Planning doesn't write anything to S3 so it must not abort
+		# anyone's multipart uploads either, and nor do the partial runs
+		# in watch mode, which would otherwise list them every few
+		# seconds; full runs see to it
+
+		self.started = time.time()
+
+		if not options.debug and not options.plan and paths is None:
+
+			try:
+				with self.metrics.timer('phase.pending_uploads'):
+					self.pending = self.pending_uploads(options, bucket)
+			except Exception, e:
+				logging.error('failed to list incomplete multipart uploads: %s' % e)
+
+		# Without the pack index there is no telling which groups have
+		# changed, and storing a new one would lose track of the old
+		# archives, so give up rather than guess.
+
+		self.run = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+
+		packing = options.pack and not options.debug
+
+		if packing:
+
+			try:
+				with self.metrics.timer('phase.pack_index'):
+					self.packs = self.load_packs(options, bucket)
+			except Exception, e:
+				logging.error('failed to load the pack index: %s' % e)
+				return None
+
+			self.packed = {}
+			self.superseded = []
+
+		# Likewise, without knowing which blobs are stored already
+		# everything would be uploaded again
+
+		dedup = options.dedup and not options.debug
+
+		if dedup:
+
+			try:
+				with self.metrics.timer('phase.blobs'):
+					self.blobs = self.load_blobs(options, bucket, manifest)
+			except Exception, e:
+				logging.error('failed to list stored blobs: %s' % e)
+				return None
+
+			self.uploading = {}
+
+			fd, path = tempfile.mkstemp(prefix='s3-backup-manifest-', suffix='.gz')
+			os.close(fd)
+
+			header = {
+				'bucket': options.bucket,
+				'prefix': options.prefix,
+				'directory': os.path.abspath(options.directory),
+				'run': self.run,
+			}
+
+			self.run_manifest = s3_dedup.manifest(path, header)
+
+		# The walk feeds a bounded queue so that memory stays flat no
+		# matter how big the tree is; the workers do the cache checks
+		# and uploads.
+
+		self.counter = 0
+
+		# The hashing processes are forked before there are any worker
+		# threads, so that none of them starts life with a lock that a
+		# thread was holding
+
+		hashers = None
+
+		if options.hash_procs > 0 and self.digests and not options.execute:
+			hashers = multiprocessing.Pool(options.hash_procs)
+
+		queue = Queue.Queue(options.workers * 100)
+		workers = []
+
+		for i in range(options.workers):
+
+			t = threading.Thread(target=self.worker, args=(options, queue, bucket, manifest, idx))
+			t.setDaemon(True)
+			t.start()
+
+			workers.append(t)
+
+		walker = scanner(options.directory, options.include, options.exclude)
+
+		if options.plan:
+
+			header = {
+				'bucket': options.bucket,
+				'prefix': options.prefix,
+				'directory': os.path.abspath(options.directory),
+				'public': options.public,
+				'created': int(time.time()),
+			}
+
+			self.plan = plan(options.plan, header)
+
+		self.seen = {}
+
+		if options.execute:
+			self.execute_plan(options, bucket, idx, queue)
+
+		else:
+
+			current = None
+
+			if paths is None:
+				files = walker.files()
+			else:
+				files = walker.paths(paths)
+
+			if hashers:
+				files = self.hashed(options, hashers, files, manifest, idx)
+
+			for fullpath, shortpath, st in files:
+
+				relpath = shortpath
+
+				if options.prefix:
+					shortpath = '%s/%s' % (options.prefix, shortpath)
+
+				if options.mirror:
+					self.seen[shortpath] = True
+
+				# The walk finishes one directory before it starts the
+				# next, so a group is complete as soon as the directory
+				# changes
+
+				if packing and st.st_size < options.pack_threshold * 1024 and s3_pack.packable(relpath):
+
+					reldir, name = os.path.split(relpath)
+
+					if current and current.reldir != reldir:
+						self.queue_pack(options, queue, current)
+						current = None
+
+					if not current:
+						current = s3_pack.group(reldir)
+
+					current.add(fullpath, name, st)
+					continue
+
+				queue.put((fullpath, shortpath, st))
+
+			if current:
+				self.queue_pack(options, queue, current)
+
+		if hashers:
+			hashers.close()
+			hashers.join()
+
+		for t in workers:
+			queue.put(None)
+
+		for t in workers:
+			t.join()
+
+		self.metrics.timing('phase.walk', walker.elapsed)
+		self.metrics.incr('walk.dirs', walker.dirs)
+		self.metrics.incr('walk.files', walker.files_seen)
+
+		if options.mirror and not options.debug and not options.execute and paths is None:
+
+			if manifest is None:
+				logging.error('no listing of the bucket, so not deleting anything')
+			else:
+				with self.metrics.timer('phase.mirror'):
+					self.mirror(options, bucket, manifest, idx, walker)
+
+		if packing:
+
+			with self.metrics.timer('phase.pack_index'):
+				self.store_packs(options, bucket, manifest, idx, walker)
+
+		if dedup:
+
+			with self.metrics.timer('phase.run_manifest'):
+				self.store_run_manifest(options, bucket)
+
+		self.seen = None
+		self.packs = None
+		self.blobs = None
+
+		# Anything left over belongs to a file that was not uploaded as
+		# a multipart upload this time around.
+
+		for key_name, uploads in self.pending.items():
+			for mp in uploads:
+
+				if self.is_abandoned(options, mp):
+					self.abort_upload(mp)
+
+		if self.plan:
+
+			for op, (n, size) in sorted(self.plan.totals.items()):
+				logging.info('plan: %s %s files, %s bytes' % (op, n, size))
+
+			self.plan.close()
+			self.plan = None
+
+		if db:
+			db.close()
+
+		self.report(options)
+
+		self.digests = None
+		return self.counter
+
+	def get_bucket(self, options):
+
+		if not self.session:
+			self.session = aws_session.from_config(self.cfg)
+
+		return self.session.bucket(options.bucket, create=True)
+
+	def report(self, options):
+
+		self.metrics.incr('connections.opened', self.pool.opened)
+		self.metrics.incr('connections.reused', self.pool.reused)
+		self.metrics.incr('requests.retried', self.scheduler.retried)
+		self.metrics.incr('requests.throttled', self.scheduler.throttled)
+
+		self.pool.close()
+
+		self.metrics.summary()
+
+		if options.metrics_file:
+
+			try:
+				self.metrics.write(options.metrics_file, options.metrics_format)
+			except Exception, e:
+				logging.error('failed to write metrics to %s: %s' % (options.metrics_file, e))
+
+	# Works out the digests that the workers are going to want in the
+	# --hash-procs processes, --hash-batch files (or 64MB) at a time, and
+	# yields the walk's files in the order they came once their digests
+	# are in the cache. Only so many batches are in flight at once, so
+	# the walk never gets far ahead of the hashing.
+
+	def hashed(self, options, hashers, files, manifest, idx):
+
+		window = collections.deque()
+		batch = []
+		work = []
+		size = 0
+
+		try:
+
+			for fullpath, relpath, st in files:
+
+				part_sizes = self.wanted_digests(options, manifest, idx, relpath, st)
+				batch.append(((fullpath, relpath, st), part_sizes))
+
+				if part_sizes:
+					work.append((fullpath, part_sizes))
+					size += st.st_size * len(part_sizes)
+
+				if len(batch) >= options.hash_batch or size >= 64 * 1024 * 1024:
+
+					window.append(self.hash_batch(hashers, batch, work))
+					batch, work, size = [], [], 0
+
+					while len(window) > options.hash_procs * 4:
+						for f in self.hash_results(window.popleft()):
+							yield f
+
+			if batch:
+				window.append(self.hash_batch(hashers, batch, work))
+
+			while window:
+				for f in self.hash_results(window.popleft()):
+					yield f
+
+		except:
+			hashers.terminate()
+			raise
+
+	def hash_batch(self, hashers, batch, work):
+
+		result = None
+
+		if work:
+			result = hashers.apply_async(s3_digest.digest_batch, (work,))
+
+		return batch, result
+
+	def hash_results(self, pending):
+
+		batch, result = pending
+		digests = []
+
+		if result:
+
+			with self.metrics.timer('hash.wait'):
+				digests = result.get()
+
+		digests.reverse()
+
+		for f, part_sizes in batch:
+
+			if part_sizes:
+
+				found = digests.pop()
+
+				if found:
+
+					for part_size, digest in found.items():
+						self.digests.store_digest(f[2], part_size, digest)
+
+					self.metrics.incr('files.hashed')
+					self.metrics.incr('bytes.hashed', f[2].st_size * len(part_sizes))
+
+			yield f
+
+	# The digests backup_file is going to need for a file, other than
+	# any that are cached: the whole-file MD5 for --dedup, and for
+	# --checksum whatever will reproduce the remote ETag
+
+	def wanted_digests(self, options, manifest, idx, relpath, st):
+
+		if options.pack and st.st_size < options.pack_threshold * 1024:
+			return []
+
+		shortpath = relpath
+
+		if options.prefix:
+			shortpath = '%s/%s' % (options.prefix, relpath)
+
+		if options.dedup:
+			part_sizes = [ 0 ]
+
+		elif not options.checksum or options.force:
+			return []
+
+		elif idx and idx.is_current(options.bucket, shortpath, os.path.join(options.directory, relpath), st):
+			return []
+
+		elif manifest is not None:
+
+			remote = manifest.get(shortpath)
+
+			if not remote or remote[0] != st.st_size:
+				return []
+
+			part_sizes = s3_digest.etag_part_sizes(remote[1], st.st_size, [ self.part_size(options, st.st_size) ])
+
+		# Without a listing there is no ETag to go on, so guess at
+		# whatever s3-backup.py would have stored
+
+		elif st.st_size >= options.multipart_threshold * 1024 * 1024:
+			part_sizes = [ self.part_size(options, st.st_size) ]
+
+		else:
+			part_sizes = [ 0 ]
+
+		return [ part_size for part_size in part_sizes if not self.digests.get_digest(st, part_size) ]
+
+	# Backs up changes as they happen. inotify says which paths changed
+	# and each is backed up once it has been left alone for --watch-delay
+	# seconds (or has been changing for ten times that). A full run at
+	# the start, every --reconcile seconds and whenever inotify loses
+	# track catches anything that was missed.
+
+	def watch(self, options):
+
+		walker = scanner(options.directory, options.include, options.exclude)
+
+		try:
+			watcher = s3_inotify.watcher(options.directory, lambda relpath: walker.is_filtered(relpath, True))
+		except Exception, e:
+			logging.error('failed to watch %s: %s' % (options.directory, e))
+			return None
+
+		# A run with --pack or --dedup describes whole directories or
+		# the whole tree, so changes there are picked up by full runs,
+		# which the caches keep cheap
+
+		partial = not (options.pack or options.dedup)
+
+		changed = {}
+		reconcile = 0
+
+		try:
+
+			while True:
+
+				now = time.time()
+
+				if now >= reconcile:
+
+					logging.info('full run over %s' % options.directory)
+
+					changed = {}
+					self.backup(options)
+
+					reconcile = time.time() + options.reconcile
+					continue
+
+				timeout = reconcile - now
+
+				for first, last in changed.values():
+					timeout = min(timeout, max(0, min(last + options.watch_delay, first + options.watch_delay * 10) - now))
+
+				found, rescan = watcher.read(timeout)
+				now = time.time()
+
+				for relpath in found:
+
+					if not walker.is_filtered(relpath, True):
+						changed[relpath] = (changed.get(relpath, (now, now))[0], now)
+
+				if rescan:
+					logging.warning('lost track of changes under %s, rescanning' % options.directory)
+
+					watcher.rescan()
+					reconcile = 0
+					continue
+
+				ready = [ relpath for relpath, (first, last) in changed.items() if now - last >= options.watch_delay or now - first >= options.watch_delay * 10 ]
+
+				if not ready:
+					continue
+
+				if not partial:
+					reconcile = 0
+					continue
+
+				for relpath in ready:
+					del changed[relpath]
+
+				logging.info('back up %s changed paths' % len(ready))
+				self.backup(options, ready)
+
+		finally:
+			watcher.close()
+
+	# Streams stdin, or a named pipe, to a key as it is read, for dumps
+	# that are never written to disk or whose size isn't known up front.
+	# Parts are read into memory and handed to the part workers through a
+	# queue that holds at most --part-workers of them, so reading stops
+	# while the uploads catch up and memory stays at a few parts however
+	# big the stream is. Returns the number of bytes stored, or None.
+
+	def stream(self, options):
+
+		self.metrics = s3_metrics.metrics('s3backup')
+
+		try:
+			bucket = self.get_bucket(options)
+		except Exception, e:
+			logging.error('failed to get on with AWS: %s' % e)
+			return None
+
+		self.pool = s3_pool.pool(options.pool_size, options.idle_timeout)
+		self.scheduler = s3_scheduler.scheduler(options.rate, options.bandwidth * 1024, max(options.part_workers, 1), retries=options.retries, metrics=self.metrics)
+
+		key = self.key_prefix(options) + options.stream
+
+		if options.stream_from == '-':
+			name, src = 'stdin', sys.stdin
+
+		else:
+			name = options.stream_from
+
+			try:
+				src = open(name, 'rb')
+			except Exception, e:
+				logging.error('failed to open %s: %s' % (name, e))
+				return None
+
+		start = time.time()
+		mtime = start
+
+		try:
+			size = self.stream_to(options, bucket, key, name, src, mtime)
+		finally:
+			src.close()
+
+		if size is not None:
+
+			elapsed = max(time.time() - start, 0.001)
+			logging.info('%s stored at %s/%s, %s bytes at %.1f MB/s' % (name, options.bucket, key, size, size / elapsed / 1024 / 1024))
+
+			self.metrics.incr('bytes.uploaded', size)
+
+		self.report(options)
+		return size
+
+	def stream_to(self, options, bucket, key, name, src, mtime):
+
+		policy = None
+
+		if options.public:
+			policy = 'public-read'
+
+		# Something smaller than a part can't be a multipart upload of
+		# more than one part, so it might as well be a single PUT
+
+		data = self.read_part(src, self.stream_part_size(options, 1))
+
+		if len(data) < self.stream_part_size(options, 1):
+
+			headers = {
+				'Content-Type': mimetypes.guess_type(key)[0] or 'application/octet-stream',
+				'x-amz-meta-x-mtime': str(mtime),
+			}
+
+			k = bucket.new_key(key)
+
+			try:
+				self.scheduler.call(k.set_contents_from_string, data, headers=headers, policy=policy, nbytes=len(data), what='PUT')
+			except Exception, e:
+				logging.error('failed to store %s at %s: %s' % (name, key, e))
+				return None
+
+			return len(data)
+
+		metadata = { 'x-mtime': mtime }
+
+		try:
+			mp = self.scheduler.call(bucket.initiate_multipart_upload, key, metadata=metadata, policy=policy, what='multipart.initiate')
+		except Exception, e:
+			logging.error('failed to start multipart upload for %s: %s' % (key, e))
+			return None
+
+		logging.info('start multipart upload %s for %s from %s' % (mp.id, key, name))
+
+		todo = Queue.Queue(max(options.part_workers, 1))
+		digests = {}
+		failed = []
+		threads = []
+
+		for i in range(max(options.part_workers, 1)):
+
+			t = threading.Thread(target=self.stream_worker, args=(bucket.name, mp, todo, digests, failed))
+			t.setDaemon(True)
+			t.start()
+
+			threads.append(t)
+
+		part_num = 1
+		size = 0
+		finished = False
+
+		# Unlike a file, a stream can't be read again, so an upload that
+		# fails is aborted rather than left to be resumed
+
+		try:
+
+			while data and not failed:
+
+				todo.put((part_num, data))
+				size += len(data)
+				part_num += 1
+
+				# let go of the part before reading the next one
+
+				data = None
+				data = self.read_part(src, self.stream_part_size(options, part_num))
+
+			finished = True
+
+		except Exception, e:
+			logging.error('failed to read %s: %s' % (name, e))
+
+		finally:
+
+			for t in threads:
+				todo.put(None)
+
+			for t in threads:
+				t.join()
+
+			if failed or not finished:
+				self.abort_upload(mp)
+
+		if failed or not finished:
+			return None
+
+		try:
+			rsp = self.scheduler.call(mp.complete_upload, what='multipart.complete')
+		except Exception, e:
+			logging.error('failed to complete multipart upload %s for %s: %s' % (mp.id, key, e))
+			self.abort_upload(mp)
+			return None
+
+		# The parts were each checked as they went; this checks that S3
+		# put the same parts together
+
+		joined = ''.join([ digests[n].decode('hex') for n in sorted(digests) ])
+		etag = '%s-%s' % (hashlib.md5(joined).hexdigest(), len(digests))
+
+		if (rsp.etag or '').strip('"') != etag:
+			logging.error('ETag %s of %s is not the one of what was sent (%s)' % (rsp.etag, key, etag))
+			return None
+
+		return size
+
+	# The part size for a given part of a stream. There is no knowing how
+	# big a stream is going to be, so to stay inside S3's 10000 parts the
+	# part size doubles every 1000 parts, up to S3's 5GB limit.
+
+	def stream_part_size(self, options, part_num):
+
+		part_size = max(options.part_size * 1024 * 1024, 5 * 1024 * 1024)
+		return min(part_size * 2 ** ((part_num - 1) / 1000), 5 * 1024 * 1024 * 1024)
+
+	# A pipe can hand back less than was asked for before it ends, so keep
+	# reading until there is a whole part or nothing more to read
+
+	def read_part(self, src, size):
+
+		chunks = []
+
+		while size > 0:
+
+			chunk = src.read(min(size, s3_digest.MB))
+
+			if not chunk:
+				break
+
+			chunks.append(chunk)
+			size -= len(chunk)
+
+		return ''.join(chunks)
+
+	def stream_worker(self, bucket_name, mp, todo, digests, failed):
+
+		mp_local = self.session.multipart_upload(bucket_name, mp.key_name, mp.id)
+
+		while True:
+
+			task = todo.get()
+
+			if task is None:
+				break
+
+			part_num, data = task
+			task = None
+
+			# Once a part has failed the upload is going to be aborted,
+			# so the rest are only taken off the queue
+
+			if not failed:
+
+				try:
+					digests[part_num] = self.scheduler.call(self.send_data_part, mp_local, part_num, data, nbytes=len(data), what='multipart.part')
+					logging.info('stored part %s of %s (%s bytes)' % (part_num, mp.key_name, len(data)))
+
+				except Exception, e:
+					logging.error('failed to store part %s of %s: %s' % (part_num, mp.key_name, e))
+					failed.append(part_num)
+
+			data = None
+
+	# Sends a part that is already in memory, with its MD5, which boto
+	# then checks against the ETag that comes back
+
+	def send_data_part(self, mp, part_num, data):
+
+		h = hashlib.md5(data)
+		mp.upload_part_from_file(StringIO(data), part_num, md5=(h.hexdigest(), h.digest().encode('base64').strip()), size=len(data))
+
+		return h.hexdigest()
+
+	# Each worker gets its own connection (and so its own socket), from
+	# the session
+
+	def worker(self, options, queue, bucket, manifest, idx):
+
+		if bucket:
+
+			try:
+				bucket = self.session.bucket(bucket.name)
+			except Exception, e:
+				logging.error('failed to create worker connection: %s' % e)
+
+		while True:
+
+			task = queue.get()
+
+			if task is None:
+				break
+
+			try:
+
+				if isinstance(task, s3_pack.group):
+					stored = self.store_pack(options, bucket, task)
+
+				else:
+
+					fullpath, shortpath, st = task
+
+					if options.execute:
+						stored = self.execute_file(options, bucket, idx, fullpath, shortpath)
+					else:
+						stored = self.backup_file(options, bucket, manifest, idx, fullpath, shortpath, st)
+
+			except Exception, e:
+
+				if isinstance(task, s3_pack.group):
+					logging.error("failed to back up the files in %s: %s" % (os.path.join(options.directory, task.reldir), e))
+					self.metrics.incr('files.failed', len(task.files))
+				else:
+					logging.error("failed to back up %s: %s" % (task[0], e))
+
+				stored = False
+
+			if stored:
+				self.lock.acquire()
+
+				try:
+					self.counter += int(stored)
+				finally:
+					self.lock.release()
+
+	def backup_file(self, options, bucket, manifest, idx, fullpath, shortpath, st):
+
+		aws_path = "%s/%s" % (options.bucket, shortpath)
+		aws_url = 'http://s3.amazonaws.com/%s' % aws_path
+
+		if options.debug:
+			logging.info('fullpath: %s' % fullpath)
+			logging.info('shortpath: %s' % shortpath)
+			logging.info('aws url: %s' % aws_url)
+			return False
+
+		if options.dedup:
+			return self.backup_blob(options, bucket, fullpath, shortpath, st)
+
+		start = time.time()
+
+		if idx and not options.force and idx.is_current(options.bucket, shortpath, fullpath, st):
+			logging.debug("%s unchanged since it was indexed, skipping" % fullpath)
+
+			self.metrics.timing('phase.check', time.time() - start)
+			self.metrics.incr('files.skipped.index')
+
+			if self.plan:
+				self.plan.count('skip', st.st_size)
+
+			return False
+
+		cached = self.is_cached(options, bucket, shortpath, fullpath, aws_url, manifest, st)
+		self.metrics.timing('phase.check', time.time() - start)
+
+		if cached:
+
+			if idx:
+				etag = None
+
+				if manifest and manifest.get(shortpath):
+					etag = manifest[shortpath][1]
+
+				idx.store(options.bucket, shortpath, fullpath, st, etag)
+
+			self.metrics.incr('files.skipped.cached')
+
+			if self.plan:
+				self.plan.count('skip', st.st_size)
+
+			return False
+
+		if self.plan:
+			self.plan.add('upload', st.st_size, st.st_mtime, shortpath, fullpath)
+			return False
+
+		return self.store_file(options, bucket, idx, fullpath, shortpath, st) is not None
+
+	# Deletes the keys under the prefix that no longer exist locally,
+	# leaving alone anything the include/exclude rules keep out of the
+	# backup. Nothing is deleted if the walk went wrong or if more than
+	# --mirror-max-delete of the keys would go.
+
+	def mirror(self, options, bucket, manifest, idx, walker):
+
+		if walker.errors:
+			logging.error('%s errors while walking %s, so not deleting anything' % (walker.errors, options.directory))
+			return 0
+
+		prefix = self.key_prefix(options)
+		orphans = []
+
+		for key in manifest:
+
+			if key in self.seen:
+				continue
+
+			if walker.is_filtered(key[len(prefix):]):
+				continue
+
+			# the archives are looked after by store_packs, and blobs
+			# may still be named by older runs' manifests
+
+			if s3_pack.is_pack_key(prefix, key) or s3_dedup.is_dedup_key(prefix, key):
+				continue
+
+			orphans.append(key)
+
+		if not orphans:
+			return 0
+
+		limit = int(len(manifest) * options.mirror_max_delete)
+
+		if len(orphans) > limit:
+			logging.error('refusing to delete %s of %s keys, which is more than --mirror-max-delete %s allows' % (len(orphans), len(manifest), options.mirror_max_delete))
+			return 0
+
+		orphans.sort()
+
+		if self.plan:
+
+			for key in orphans:
+				self.plan.add('delete', manifest[key][0], 0, key, '')
+
+			return 0
+
+		return self.delete_keys(options, bucket, idx, orphans)
+
+	# Multi-object delete requests of up to 1000 keys each, spread over
+	# the workers
+
+	def delete_keys(self, options, bucket, idx, keys):
+
+		batches = Queue.Queue()
+
+		for i in range(0, len(keys), 1000):
+			batches.put(keys[i:i + 1000])
+
+		deleted = []
+		threads = []
+
+		for i in range(min(options.workers, batches.qsize())):
+
+			t = threading.Thread(target=self.delete_worker, args=(options, bucket, batches, deleted))
+			t.setDaemon(True)
+			t.start()
+
+			threads.append(t)
+
+		for t in threads:
+			t.join()
+
+		if idx:
+			for key in deleted:
+				idx.forget(options.bucket, key)
+
+		if self.plan:
+			for key in deleted:
+				self.plan.mark_done(key)
+
+		logging.info('deleted %s of %s keys' % (len(deleted), len(keys)))
+
+		self.metrics.incr('keys.deleted', len(deleted))
+		return len(deleted)
+
+	# Failing to connect fails the batch like any other error, rather
+	# than the thread, which would leave its batches undeleted and
+	# unreported
+
+	def delete_worker(self, options, bucket, batches, deleted):
+
+		name = bucket.name
+		bucket = None
+
+		while True:
+
+			try:
+				batch = batches.get_nowait()
+			except Queue.Empty:
+				break
+
+			try:
+
+				if bucket is None:
+					bucket = self.session.bucket(name)
+
+				rsp = self.scheduler.call(bucket.delete_keys, batch, quiet=True, what='DELETE.multi')
+			except Exception, e:
+				logging.error('failed to delete %s keys starting at %s: %s' % (len(batch), batch[0], e))
+				continue
+
+			failed = {}
+
+			for err in rsp.errors:
+				logging.error('failed to delete %s: %s' % (err.key, err.message))
+				failed[err.key] = True
+
+			for key in batch:
+
+				if key in failed:
+					continue
+
+				logging.info('deleted %s' % key)
+				deleted.append(key)
+
+	# Feeds the workers from a plan rather than from a walk of the tree;
+	# deletes are batched up and done here
+
+	def execute_plan(self, options, bucket, idx, queue):
+
+		shard, shards = self.shard(options)
+
+		done = self.plan.load_journal(shard, shards)
+
+		if done:
+			logging.info('%s entries of %s were already executed' % (len(done), options.execute))
+
+		deletes = []
+
+		for op, size, mtime, key, path in self.plan.entries(shard, shards):
+
+			if key in done:
+				continue
+
+			if op == 'upload':
+				queue.put((path, key, None))
+
+			elif op == 'delete':
+				deletes.append(key)
+
+				if len(deletes) == 1000:
+					self.delete_keys(options, bucket, idx, deletes)
+					deletes = []
+
+			else:
+				logging.warning('unknown plan action %s for %s' % (op, key))
+
+		if deletes:
+			self.delete_keys(options, bucket, idx, deletes)
+
+	# (I, N) for --shard I/N, or (0, 1)
+
+	def shard(self, options):
+
+		if options.execute and options.shard:
+			return tuple([ int(n) for n in options.shard.split('/') ])
+
+		return 0, 1
+
+	def execute_file(self, options, bucket, idx, fullpath, shortpath):
+
+		try:
+			st = os.stat(fullpath)
+		except Exception, e:
+			logging.error("failed to stat %s: %s" % (fullpath, e))
+			return False
+
+		if self.store_file(options, bucket, idx, fullpath, shortpath, st) is not None:
+			self.plan.mark_done(shortpath)
+			return True
+
+		return False
+
+	def queue_pack(self, options, queue, group):
+
+		self.packed[group.reldir] = True
+
+		# --mirror drops packed files that are gone, so it has to repack
+		# groups that still hold any
+
+		count = None
+
+		if options.mirror:
+			count = len(group.files)
+
+		if self.packs.is_current(group.reldir, group.signature(), count):
+			logging.debug('%s unchanged since it was packed, skipping' % (group.reldir or '.'))
+
+			self.metrics.incr('files.skipped.packed', len(group.files))
+			return
+
+		queue.put(group)
+
+	# Writes a group of small files out as one or more archives and
+	# records where each file went. Returns the number of files stored.
+
+	def store_pack(self, options, bucket, group):
+
+		prefix = self.key_prefix(options)
+		archives = []
+		start = time.time()
+
+		def store(path, n):
+
+			key = group.archive_key(prefix, self.run, n)
+			st = os.stat(path)
+
+			if st.st_size >= options.multipart_threshold * 1024 * 1024:
+				self.upload_multipart(options, bucket, key, path, st)
+			else:
+				self.upload_file(options, bucket, key, path, st)
+
+			archives.append(key)
+
+			self.metrics.incr('packs.uploaded')
+			self.metrics.incr('bytes.uploaded', st.st_size)
+
+		try:
+			packed, failed = group.write(options.pack_size * 1024 * 1024, store)
+
+		except Exception, e:
+			logging.error('failed to pack %s: %s' % (os.path.join(options.directory, group.reldir), e))
+
+			self.metrics.incr('files.failed', len(group.files))
+			return 0
+
+		for fullpath, e in failed:
+			logging.error('failed to pack %s: %s' % (fullpath, e))
+
+		# A group with files missing from its archives mustn't look
+		# current, or they would never be packed
+
+		signature = group.signature()
+
+		if failed:
+			signature = None
+
+		superseded = self.packs.update(group.reldir, signature, archives, packed, not options.mirror)
+
+		self.lock.acquire()
+
+		try:
+			self.superseded.extend(superseded)
+		finally:
+			self.lock.release()
+
+		logging.info('%s files from %s packed into %s' % (len(packed), os.path.join(options.directory, group.reldir), ', '.join(archives)))
+
+		self.metrics.timing('phase.pack', time.time() - start)
+		self.metrics.incr('files.packed', len(packed))
+		self.metrics.incr('files.failed', len(failed))
+
+		return len(packed)
+
+	def load_packs(self, options, bucket):
+
+		k = bucket.new_key(s3_pack.index_key(self.key_prefix(options)))
+
+		try:
+			data = self.scheduler.call(k.get_contents_as_string, what='GET')
+		except Exception, e:
+
+			if getattr(e, 'status', None) != 404:
+				raise
+
+			logging.info('no pack index at %s, starting a new one' % k.name)
+			return s3_pack.index()
+
+		packs = s3_pack.index(data)
+
+		logging.info('pack index lists %s groups' % len(packs.groups))
+		return packs
+
+	# Stores the updated pack index and then deletes the archives it no
+	# longer points at. With --mirror, groups for directories that are
+	# gone are dropped, along with any archive nothing points at (left
+	# behind by a run that died before it stored the index).
+
+	def store_packs(self, options, bucket, manifest, idx, walker):
+
+		prefix = self.key_prefix(options)
+		superseded = self.superseded
+
+		if options.mirror and not walker.errors:
+
+			superseded.extend(self.packs.forget(self.packed, walker.is_filtered))
+
+			if manifest is not None:
+
+				current = self.packs.archives()
+				index_key = s3_pack.index_key(prefix)
+
+				for key in manifest:
+
+					if s3_pack.is_pack_key(prefix, key) and key != index_key and not key in current:
+						superseded.append(key)
+
+		if self.packs.changed:
+
+			k = bucket.new_key(s3_pack.index_key(prefix))
+
+			headers = { 'Content-Type': 'application/gzip' }
+			policy = None
+
+			if options.public:
+				policy = 'public-read'
+
+			data = self.packs.dumps()
+
+			try:
+				self.scheduler.call(k.set_contents_from_string, data, headers=headers, policy=policy, nbytes=len(data), what='PUT')
+			except Exception, e:
+				logging.error('failed to store the pack index, leaving the old archives alone: %s' % e)
+				return
+
+			logging.info('stored pack index (%s groups, %s bytes)' % (len(self.packs.groups), len(data)))
+
+		current = self.packs.archives()
+		superseded = sorted(set([ key for key in superseded if not key in current ]))
+
+		if superseded:
+			self.delete_keys(options, bucket, idx, superseded)
+
+	# Stores the file's content as a blob, unless a blob with the same
+	# MD5 is stored already, and adds it to this run's manifest. Two
+	# workers with the same new content don't both upload it: the second
+	# waits to see how the first got on.
+
+	def backup_blob(self, options, bucket, fullpath, shortpath, st):
+
+		relpath = shortpath[len(self.key_prefix(options)):]
+
+		start = time.time()
+
+		try:
+			md5 = self.local_digest(fullpath, st, 0)
+		except Exception, e:
+			logging.error('failed to read %s: %s' % (fullpath, e))
+
+			self.metrics.incr('files.failed')
+			return False
 
-logging.basicConfig(level=logging.INFO)
+		self.metrics.timing('phase.check', time.time() - start)
 
-class s3:
+		while True:
 
-	def __init__(self, cfg):
+			self.lock.acquire()
 
-		self.cfg = cfg
-		self.conn = None
+			try:
+				stored = md5 in self.blobs
+				uploading = self.uploading.get(md5)
 
-	def backup(self, options):
+				if not stored and not uploading:
+					self.uploading[md5] = threading.Event()
 
-		for p in ('directory', 'bucket', 'public', 'prefix', 'modified', 'force', 'debug'):
-			logging.info('%s: %s' % (p, getattr(options, p)))
+			finally:
+				self.lock.release()
 
-		# sudo put me in another method...
+			if not uploading:
+				break
 
-		bucket = None
+			uploading.wait()
+
+		if stored:
+			logging.debug('%s is a copy of blob %s, skipping' % (fullpath, md5))
+
+			self.run_manifest.add(md5, st.st_size, st.st_mtime, relpath)
+			self.metrics.incr('files.deduplicated')
+			return False
+
+		key = s3_dedup.blob_key(self.key_prefix(options), md5)
+		ok = False
 
 		try:
+			etag = self.store_file(options, bucket, None, fullpath, key, st)
+			ok = etag is not None
 
-			# sudo put me in another method...
+			# A file that changed since it was hashed may have been
+			# stored under the wrong name, so it is left out of the
+			# manifest, and a blob that doesn't hold what its name says
+			# (or can't be shown to) is deleted rather than left for the
+			# next run to take as a copy
 
-			if not self.conn:
-				access_key = self.cfg.get('aws', 'access_key')
-				access_secret = self.cfg.get('aws', 'access_secret')
-				self.conn = S3Connection(access_key, access_secret)
+			if ok:
+				changed = os.stat(fullpath).st_mtime != st.st_mtime
+				matches = s3_dedup.etag_matches(md5, etag)
 
-			for b in self.conn.get_all_buckets():
+				if changed:
+					logging.error('%s changed while it was being stored' % fullpath)
 
-				if b.name == options.bucket:
-					bucket = b
-					break
+				if matches is False or (changed and not matches):
+					self.delete_blob(bucket, key)
+
+				if changed or matches is False:
+					ok = False
+
+		finally:
+
+			self.lock.acquire()
+
+			try:
+
+				if ok:
+					self.blobs[md5] = True
+
+				self.uploading.pop(md5).set()
 
-			if not bucket:
-				bucket = self.conn.create_bucket(options.bucket)
+			finally:
+				self.lock.release()
 
+		if ok:
+			self.run_manifest.add(md5, st.st_size, st.st_mtime, relpath)
+
+		return ok
+
+	# Blob keys under the prefix, from the listing if there is one
+
+	def delete_blob(self, bucket, key):
+
+		try:
+			self.scheduler.call(bucket.delete_key, key, what='DELETE')
+			logging.info('deleted %s' % key)
 		except Exception, e:
-			logging.error('failed to get on with AWS: %s' % e)
+			logging.error('failed to delete %s: %s' % (key, e))
+
+	def load_blobs(self, options, bucket, manifest):
+
+		prefix = s3_dedup.blob_prefix(self.key_prefix(options))
+		blobs = {}
+
+		if manifest is not None:
+			keys = [ (name, entry[1]) for name, entry in manifest.iteritems() ]
+		else:
+			keys = [ (k.name, k.etag.strip('"')) for k in bucket.list(prefix=prefix) ]
+
+		# A blob whose ETag shows it holds something else is left out,
+		# to be stored again
+
+		for key, etag in keys:
+
+			if not key.startswith(prefix):
+				continue
+
+			md5 = str(key[len(prefix):])
+
+			if s3_dedup.etag_matches(md5, etag) is False:
+				logging.warning('blob %s has an ETag of %s, ignoring it' % (md5, etag))
+				continue
+
+			blobs[md5] = True
+
+		logging.info('%s blobs stored under %s' % (len(blobs), prefix))
+		return blobs
+
+	def store_run_manifest(self, options, bucket):
+
+		path = self.run_manifest.path
+		count = self.run_manifest.count
+
+		self.run_manifest.close()
+		self.run_manifest = None
+
+		key = s3_dedup.manifest_key(self.key_prefix(options), self.run)
+
+		try:
+			self.upload_file(options, bucket, key, path, os.stat(path))
+			logging.info('stored manifest of %s files at %s' % (count, key))
+
+		except Exception, e:
+			logging.error('failed to store manifest %s: %s' % (key, e))
+
+		finally:
+			os.unlink(path)
+
+	# Returns the ETag the key was stored with, or None if it couldn't be
+
+	def store_file(self, options, bucket, idx, fullpath, shortpath, st):
+
+		aws_url = 'http://s3.amazonaws.com/%s/%s' % (options.bucket, shortpath)
+		start = time.time()
+
+		try:
+
+			part_size = 0
+
+			if st.st_size >= options.multipart_threshold * 1024 * 1024:
+				part_size = self.part_size(options, st.st_size)
+				etag = self.upload_multipart(options, bucket, shortpath, fullpath, st)
 
-			if options.debug:
-				logging.info('debugging is enabled, so carrying on anyway...')
 			else:
-				return None
+				etag = self.upload_file(options, bucket, shortpath, fullpath, st)
 
-		#
+			logging.info("%s stored at %s" % (fullpath, aws_url))
 
-		counter = 0
+			etag = (etag or '').strip('"')
 
-		for root, dirs, files in os.walk(options.directory):
-			for f in files:
+			if idx:
+				idx.store(options.bucket, shortpath, fullpath, st, etag)
 
-				fullpath = os.path.join(root, f)
-				shortpath = fullpath.replace(options.directory, '').lstrip('/')
+			# What was just sent is what S3 has, so there is no need to
+			# hash it again next time
 
-                                if options.prefix:
-                                        shortpath = '%s/%s' % (options.prefix, shortpath)
-                                        
-				aws_path = "%s/%s" % (options.bucket, shortpath)
-				aws_url = 'http://s3.amazonaws.com/%s' % aws_path
+			if self.digests and etag and os.stat(fullpath).st_mtime == st.st_mtime:
+				self.digests.store_digest(st, part_size, etag)
 
-				if options.debug:
-					logging.info('fullpath: %s' % fullpath)                                
-					logging.info('shortpath: %s' % shortpath)
-					logging.info('aws url: %s' % aws_url)                                        
-					continue
+			self.metrics.timing('phase.upload', time.time() - start)
+			self.metrics.incr('files.uploaded')
+			self.metrics.incr('bytes.uploaded', st.st_size)
+			return etag
 
-                                if self.is_cached(options, bucket, shortpath, fullpath, aws_url):
-                                        continue
+		except Exception, e:
+			logging.error("failed to store %s (%s) :%s" % (fullpath, aws_url, e))
 
-				logging.info("set contents from %s" % fullpath)
+		self.metrics.incr('files.failed')
+		return None
 
-				try:
-					k = Key(bucket)
-					k.key = shortpath
-					k.set_contents_from_filename(fullpath)
+	# A single PUT to a signed URL, sent over one of the pooled
+	# connections. The metadata and ACL go with the PUT rather than in
+	# separate requests after it.
 
-					mtime = os.path.getmtime(fullpath)
-					k.set_metadata('x-mtime', mtime)
+	def upload_file(self, options, bucket, shortpath, fullpath, st):
 
-					if options.public:
-						k.set_acl('public-read')
+		logging.info("set contents from %s" % fullpath)
 
-					logging.info("%s stored at %s" % (fullpath, aws_url))
-					counter += 1
+		headers = {
+			'Content-Type': mimetypes.guess_type(fullpath)[0] or 'application/octet-stream',
+			'x-amz-meta-x-mtime': str(st.st_mtime),
+		}
 
-				except Exception, e:
-					logging.error("failed to store %s (%s) :%s" % (fullpath, aws_url, e))
+		if options.public:
+			headers['x-amz-acl'] = 'public-read'
 
-		return counter
+		k = bucket.new_key(shortpath)
+		url = k.generate_url(expires_in=600, method='PUT', headers=headers)
 
-        def is_cached(self, options, bucket, shortpath, local_path, aws_url):
+		headers['Content-Length'] = str(st.st_size)
 
-		if options.force:
-		        logging.info('not cached (force enabled)')
-                        return False
-                
-                try:
+		rsp = self.scheduler.call(self.put_object, url, fullpath, headers, st.st_size, nbytes=st.st_size, what='PUT')
+		return rsp.getheader('etag')
+
+	# The file is hashed as it is sent, so that it is only read once.
+	# That means there is no Content-MD5 to send up front, so the ETag
+	# that comes back (the MD5 of what S3 got) is checked instead.
+
+	def put_object(self, url, fullpath, headers, length):
+
+		fh = open(fullpath, 'rb')
+
+		try:
+			body = s3_digest.reader(fh, length)
+			rsp = self.pool.request('PUT', url, body, headers)
+		finally:
+			fh.close()
+
+		self.check_response(rsp, 'PUT')
+
+		etag = (rsp.getheader('etag') or '').strip('"')
+
+		if etag != body.hexdigest():
+			raise s3_scheduler.transient_error(rsp.status, 'ETag %s of %s is not the MD5 of what was sent (%s)' % (etag, fullpath, body.hexdigest()))
+
+		return rsp
+
+	def head_object(self, url):
+
+		rsp = self.pool.request('HEAD', url)
+
+		if rsp.status != 404:
+			self.check_response(rsp, 'HEAD')
+
+		return rsp
+
+	def check_response(self, rsp, method):
+
+		if rsp.status >= 500 or rsp.status == 429:
+			raise s3_scheduler.transient_error(rsp.status, rsp.reason)
+
+		if rsp.status >= 300:
+			raise Exception('%s returned %s: %s' % (method, rsp.status, rsp.data[:200]))
+
+	# Multipart uploads left behind by an earlier run that died, keyed
+	# by key name. They are resumed if the same file is uploaded again
+	# and aborted at the end of the run otherwise. With --shard the
+	# other shards' keys are left to the processes applying them, which
+	# are likely uploading them right now.
+
+	def pending_uploads(self, options, bucket):
+
+		prefix = self.key_prefix(options)
+		shard, shards = self.shard(options)
+
+		pending = {}
+
+		for mp in bucket.list_multipart_uploads():
+
+			if not mp.key_name.startswith(prefix):
+				continue
+
+			name = mp.key_name
+
+			if isinstance(name, unicode):
+				name = name.encode('utf-8')
+
+			if not in_shard(name, shard, shards):
+				continue
+
+			pending.setdefault(mp.key_name, []).append(mp)
+
+		if pending:
+			logging.info('found incomplete multipart uploads for %s keys' % len(pending))
+
+		return pending
+
+	# When an upload was started, or None if there is no telling
+
+	def initiated(self, mp):
+
+		try:
+			return calendar.timegm(time.strptime(mp.initiated[:19], '%Y-%m-%dT%H:%M:%S'))
+		except Exception, e:
+			logging.warning('unable to tell when multipart upload %s was started: %s' % (mp.id, e))
+
+		return None
+
+	# Whether an upload looks like it was left behind rather than being
+	# in progress, and so can be aborted. An upload being made right now
+	# (by another shard, a --stream or another backup) looks just like
+	# one a crashed run left behind, so only those started more than
+	# --abort-after hours ago count, and anything started since this run
+	# did belongs to someone else.
+
+	def is_abandoned(self, options, mp):
+
+		initiated = self.initiated(mp)
+
+		if initiated is None:
+			return False
+
+		if initiated >= self.started:
+			logging.info('leave multipart upload %s for %s, which was started during this run' % (mp.id, mp.key_name))
+			return False
+
+		if initiated > self.started - options.abort_after * 3600:
+			logging.info('leave multipart upload %s for %s, which may still be in progress' % (mp.id, mp.key_name))
+			return False
+
+		return True
+
+	def abort_upload(self, mp):
+
+		logging.info('abort incomplete multipart upload %s for %s' % (mp.id, mp.key_name))
+
+		try:
+			self.scheduler.call(mp.cancel_upload, what='multipart.abort')
+		except Exception, e:
+			logging.error('failed to abort multipart upload %s: %s' % (mp.id, e))
+
+	def part_size(self, options, size):
+
+		# S3 allows at most 10000 parts per upload
+
+		part_size = max(options.part_size * 1024 * 1024, 5 * 1024 * 1024)
+		return max(part_size, (size + 9999) / 10000)
+
+	def part_layout(self, options, size):
+
+		part_size = self.part_size(options, size)
+		parts = []
+		offset = 0
+
+		while offset < size:
+
+			length = min(part_size, size - offset)
+			parts.append((len(parts) + 1, offset, length))
+
+			offset += length
+
+		return parts
+
+	def upload_multipart(self, options, bucket, shortpath, fullpath, st):
+
+		parts = self.part_layout(options, st.st_size)
+		done = {}
+
+		self.lock.acquire()
+
+		try:
+			previous = self.pending.pop(shortpath, [])
+		finally:
+			self.lock.release()
+
+		mp = None
+
+		# Any upload of this key from before this run is worth resuming
+		# (reusable_parts checks its parts against the file), however
+		# recent; the ones that aren't resumed are only aborted if they
+		# look abandoned
+
+		for candidate in previous:
+
+			initiated = self.initiated(candidate)
+
+			if initiated is None or initiated >= self.started:
+				continue
+
+			if mp:
+
+				if self.is_abandoned(options, candidate):
+					self.abort_upload(candidate)
+
+				continue
 
-			aws_t = None
+			try:
+				done = self.reusable_parts(candidate, fullpath, parts)
+				mp = candidate
+
+				logging.info('resume multipart upload %s for %s, %s of %s parts already stored' % (mp.id, shortpath, len(done), len(parts)))
+
+			except Exception, e:
+				logging.warning('unable to resume multipart upload %s: %s' % (candidate.id, e))
+
+				if self.is_abandoned(options, candidate):
+					self.abort_upload(candidate)
+
+		if not mp:
+
+			policy = None
 
 			if options.public:
-				http_conn = httplib.HTTPConnection("s3.amazonaws.com")
-				# http_conn.set_debuglevel(3)
+				policy = 'public-read'
 
-				http_conn.request("HEAD", aws_url)
-				rsp = http_conn.getresponse()
+			metadata = { 'x-mtime': st.st_mtime }
 
-				if rsp.status != 200:
+			mp = self.scheduler.call(bucket.initiate_multipart_upload, shortpath, metadata=metadata, policy=policy, what='multipart.initiate')
+			logging.info('start multipart upload %s for %s in %s parts' % (mp.id, fullpath, len(parts)))
 
-			        	logging.info('HEAD returned %s (%s)' % (rsp.status, aws_url))
-                        		return False
-                        
-				if not options.modified:
-					logging.info("%s has already been stored" % aws_url)
-					return True
+		todo = Queue.Queue()
+
+		for part in parts:
+
+			if not part[0] in done:
+				todo.put(part)
+
+		failed = []
+		threads = []
+
+		for i in range(min(options.part_workers, todo.qsize())):
+
+			t = threading.Thread(target=self.part_worker, args=(options, bucket.name, mp, fullpath, todo, failed))
+			t.setDaemon(True)
+			t.start()
+
+			threads.append(t)
+
+		for t in threads:
+			t.join()
+
+		# Leave the upload in place so that the next run can pick up
+		# where this one stopped.
+
+		if failed:
+			raise Exception('%s of %s parts failed, multipart upload %s left for the next run' % (len(failed), len(parts), mp.id))
+
+		rsp = self.scheduler.call(mp.complete_upload, what='multipart.complete')
+		return rsp.etag
+
+	# Returns the part numbers of an existing upload that match the
+	# current layout and the current contents of the file.
+
+	def reusable_parts(self, mp, fullpath, parts):
+
+		stored = {}
+
+		for part in mp:
+			stored[part.part_number] = (int(part.size), part.etag.strip('"'))
+
+		done = {}
+
+		for part_num, offset, length in parts:
+
+			remote = stored.get(part_num, None)
+
+			if not remote or remote[0] != length:
+				continue
+
+			if remote[1] == self.part_md5(fullpath, offset, length):
+				done[part_num] = True
+
+		return done
+
+	def part_md5(self, fullpath, offset, length):
+
+		h = hashlib.md5()
+		fh = open(fullpath, 'rb')
+
+		try:
+			fh.seek(offset)
+
+			while length > 0:
+
+				chunk = fh.read(min(length, 1024 * 1024))
+
+				if not chunk:
+					break
+
+				h.update(chunk)
+				length -= len(chunk)
+
+		finally:
+			fh.close()
+
+		return h.hexdigest()
+
+	def part_worker(self, options, bucket_name, mp, fullpath, todo, failed):
+
+		# Like the file workers, each part worker gets its own connection
+
+		mp_local = self.session.multipart_upload(bucket_name, mp.key_name, mp.id)
+
+		while True:
+
+			try:
+				part_num, offset, length = todo.get_nowait()
+			except Queue.Empty:
+				break
+
+			if not self.upload_part(options, mp_local, fullpath, part_num, offset, length):
+				failed.append(part_num)
+
+	def upload_part(self, options, mp, fullpath, part_num, offset, length):
+
+		try:
+			self.scheduler.call(self.send_part, mp, fullpath, part_num, offset, length, nbytes=length, what='multipart.part')
+
+			logging.debug('stored part %s of %s' % (part_num, mp.key_name))
+			return True
+
+		except Exception, e:
+			logging.warning('failed to store part %s of %s: %s' % (part_num, mp.key_name, e))
+
+		return False
+
+	def send_part(self, mp, fullpath, part_num, offset, length):
+
+		fh = open(fullpath, 'rb')
+
+		try:
+			fh.seek(offset)
+			mp.upload_part_from_file(fh, part_num, size=length)
+		finally:
+			fh.close()
+
+	def key_prefix(self, options):
+
+		if options.prefix:
+			return '%s/' % options.prefix
+
+		return ''
+
+	# By default the index lives next to the config file, so that each
+	# config gets its own.
+
+	def index_path(self, options):
+
+		if options.index_file:
+			return options.index_file
+
+		root, ext = os.path.splitext(os.path.abspath(options.config))
+		return '%s-index.db' % root
+
+	# Fetch (key, size, ETag, last-modified) for everything under the
+	# prefix in one paginated listing. Each LIST request returns up to
+	# 1000 keys so a mostly unchanged tree costs (keys / 1000) requests
+	# instead of one HEAD request per local file.
+
+	def load_manifest(self, options, bucket):
+
+		prefix = self.key_prefix(options)
 
-                		last_modified = rsp.getheader('last-modified')
+		logging.info('fetch manifest for %s/%s' % (bucket.name, prefix))
 
-				# Last-Modified: Sun, 11 Jul 2010 15:42:30 GMT
-				format = "%a, %d %b %Y %H:%M:%S GMT"
+		manifest = {}
 
-				aws_t = int(time.mktime(time.strptime(last_modified, format)))
+		# boto hands back key names as unicode but local paths (and so
+		# keys) are byte strings
 
+		for k in bucket.list(prefix=prefix):
+
+			name = k.name
+
+			if isinstance(name, unicode):
+				name = name.encode('utf-8')
+
+			manifest[name] = (int(k.size), k.etag.strip('"'), k.last_modified)
+
+		logging.info('manifest contains %s keys' % len(manifest))
+		return manifest
+
+	def is_cached(self, options, bucket, shortpath, local_path, aws_url, manifest=None, st=None):
+
+		if options.force:
+			logging.info('not cached (force enabled)')
+			return False
+
+		try:
+
+			if not st:
+				st = os.stat(local_path)
+
+			if manifest is not None:
+				return self.is_cached_manifest(options, manifest, shortpath, local_path, st)
+
+			logging.info('fetch cache info from S3 %s' % shortpath)
+
+			k = bucket.new_key(shortpath)
+
+			if options.public:
+				aws_url = k.generate_url(expires_in=0, method='HEAD', query_auth=False)
 			else:
+				aws_url = k.generate_url(expires_in=120, method='HEAD')
 
-				logging.info('fetch cache info from S3 %s' % shortpath)
+			rsp = self.scheduler.call(self.head_object, aws_url, what='HEAD')
 
-				k = bucket.new_key(shortpath)
-				url = k.generate_url(expires_in=120, method='HEAD')
+			if rsp.status != 200:
 
-				aws_url = url.replace("https://" + bucket.name + ".s3.amazonaws.com", "")
+				logging.info('HEAD returned %s (%s)' % (rsp.status, aws_url))
+				return False
 
-				http_conn = httplib.HTTPSConnection(bucket.name + ".s3.amazonaws.com")
-				# http_conn.set_debuglevel(3)
+			if int(rsp.getheader('content-length', -1)) != st.st_size:
+				logging.info('%s size differs from S3' % local_path)
+				return False
 
-				http_conn.request("HEAD", aws_url)
-				rsp = http_conn.getresponse()
+			# Last-Modified: Sun, 11 Jul 2010 15:42:30 GMT
 
-				if rsp.status != 200:
+			last_modified = rsp.getheader('last-modified')
+			format = "%a, %d %b %Y %H:%M:%S GMT"
 
-			        	logging.info('HEAD returned %s (%s)' % (rsp.status, aws_url))
-                        		return False
-                        
-				if not options.modified:
-					logging.info("%s has already been stored" % aws_url)
-					return True
+			return self.is_current(options, local_path, st, rsp.getheader('etag'), last_modified, format)
+
+		except Exception, e:
+			logging.error('failed to determine cache status for %s: %s' % (aws_url, e))
+
+		return False
+
+	def is_cached_manifest(self, options, manifest, shortpath, local_path, st):
+
+		remote = manifest.get(shortpath, None)
+
+		if not remote:
+			logging.info('%s not in manifest' % shortpath)
+			return False
 
-                		last_modified = rsp.getheader('last-modified')
+		aws_size, aws_etag, last_modified = remote
 
-				# Last-Modified: Sun, 11 Jul 2010 15:42:30 GMT
-				format = "%a, %d %b %Y %H:%M:%S GMT"
+		try:
+
+			if st.st_size != aws_size:
+				logging.info('%s size differs from manifest' % local_path)
+				return False
+
+			# LastModified: 2010-07-11T15:42:30.000Z
+
+			format = "%Y-%m-%dT%H:%M:%S"
+			return self.is_current(options, local_path, st, aws_etag, last_modified[:19], format)
 
-				aws_t = int(time.mktime(time.strptime(last_modified, format)))
+		except Exception, e:
+			logging.error('failed to determine cache status for %s: %s' % (shortpath, e))
+
+		return False
 
-			local_t = int(os.path.getmtime(local_path))
+	# Given that a remote copy exists, decide whether it is current:
+	# by content (--checksum), by modification time (--modified, or for
+	# paths that are known to have changed) or not at all.
 
-			logging.info("last modified local:%s remote:%s" % (local_t, aws_t))
+	def is_current(self, options, local_path, st, aws_etag, last_modified, format):
 
-                        if local_t <= aws_t:
-				logging.info("%s not modified, skipping" % local_path)
+		if options.checksum:
+
+			if self.etag_matches(options, local_path, st, aws_etag):
+				logging.info("%s unchanged (checksum), skipping" % local_path)
 				return True
 
+			logging.info("%s checksum differs from %s" % (local_path, aws_etag))
 			return False
 
-		except Exception, e:
-                	logging.error('failed to determine cache status for %s: %s' % (aws_url, e))
+		if not options.modified and not self.partial:
+			logging.info("%s has already been stored" % local_path)
+			return True
 
-                return False
+		# Both formats are UTC, which time.mktime would have treated
+		# as local time
+
+		aws_t = calendar.timegm(time.strptime(last_modified, format))
+		local_t = int(st.st_mtime)
+
+		logging.info("last modified local:%s remote:%s" % (local_t, aws_t))
+
+		if local_t <= aws_t:
+			logging.info("%s not modified, skipping" % local_path)
+			return True
+
+		return False
+
+	# See s3_digest for how ETags are worked out
+
+	def etag_matches(self, options, local_path, st, aws_etag):
+
+		aws_etag = (aws_etag or '').strip('"')
+		preferred = [ self.part_size(options, st.st_size) ]
+
+		for part_size in s3_digest.etag_part_sizes(aws_etag, st.st_size, preferred):
+
+			if self.local_digest(local_path, st, part_size) == aws_etag:
+				return True
+
+		return False
+
+	# Digests are cached by (inode, size, mtime) so a file is only read
+	# again once it has actually changed.
+
+	def local_digest(self, local_path, st, part_size):
+
+		if self.digests:
+
+			digest = self.digests.get_digest(st, part_size)
+
+			if digest:
+				return digest
+
+		digest = s3_digest.file_digest(local_path, part_size)
+
+		if self.digests:
+			self.digests.store_digest(st, part_size, digest)
+
+		return digest
 
-                
 if __name__ == '__main__':
 
 	import ConfigParser
@@ -199,14 +2443,128 @@ if __name__ == '__main__':
 	parser.add_option('-f', '--force', dest='force', action='store_true', default=False)
 	parser.add_option('-d', '--debug', dest='debug', action='store_true', default=False)
 	parser.add_option('-m', '--modified', dest='modified', action='store_true', default=False)
-        
+	parser.add_option('-M', '--manifest', dest='manifest', action='store_true', default=False,
+			  help='check against a single paginated listing of the bucket rather than one HEAD request per file')
+
+	parser.add_option('-C', '--checksum', dest='checksum', action='store_true', default=False,
+			  help='compare the MD5 of local files with the remote ETag (digests are cached in the index file)')
+	parser.add_option('-i', '--index', dest='index', action='store_true', default=False,
+			  help='skip files that are unchanged since they were last stored, according to a local index')
+	parser.add_option('--index-file', dest='index_file', action='store', default=None,
+			  help='where to keep the local index (default: next to the config file)')
+	parser.add_option('--verify', dest='verify', action='store_true', default=False,
+			  help='reconcile the local index against the bucket before backing up')
+
+	parser.add_option('-w', '--workers', dest='workers', action='store', type='int', default=1,
+			  help='number of files to check and upload in parallel (default: 1)')
+
+	parser.add_option('--multipart-threshold', dest='multipart_threshold', action='store', type='int', default=64,
+			  help='upload files of at least this many MB as multipart uploads (default: 64)')
+	parser.add_option('--part-size', dest='part_size', action='store', type='int', default=16,
+			  help='size of each multipart upload part in MB, at least 5 (default: 16)')
+	parser.add_option('--part-workers', dest='part_workers', action='store', type='int', default=4,
+			  help='number of parts of a single file to upload in parallel (default: 4)')
+	parser.add_option('--abort-after', dest='abort_after', action='store', type='float', default=24,
+			  help='abort incomplete multipart uploads under the prefix that were started more than this many hours ago (default: 24)')
+
+	parser.add_option('--include', dest='include', action='append', default=[],
+			  help='only back up files matching this glob (or re:regex); may be repeated')
+	parser.add_option('--exclude', dest='exclude', action='append', default=[],
+			  help='skip files and whole directories matching this glob (or re:regex); may be repeated')
+
+	parser.add_option('--pool-size', dest='pool_size', action='store', type='int', default=10,
+			  help='number of idle keep-alive connections to keep per host, at least --workers (default: 10)')
+	parser.add_option('--idle-timeout', dest='idle_timeout', action='store', type='int', default=15,
+			  help='seconds after which an idle connection is not reused (default: 15)')
+
+	parser.add_option('--retries', dest='retries', action='store', type='int', default=5,
+			  help='number of times to retry a request that was throttled or failed transiently (default: 5)')
+	parser.add_option('--rate', dest='rate', action='store', type='float', default=0,
+			  help='maximum number of requests per second (default: no limit)')
+	parser.add_option('--bandwidth', dest='bandwidth', action='store', type='int', default=0,
+			  help='maximum upload rate in KB per second (default: no limit)')
+
+	parser.add_option('--metrics-file', dest='metrics_file', action='store', default=None,
+			  help='write counters and per-phase/per-request timings here at the end of the run')
+	parser.add_option('--metrics-format', dest='metrics_format', action='store', default='json',
+			  type='choice', choices=('json', 'statsd'), help='json or statsd (default: json)')
+
+	parser.add_option('--plan', dest='plan', action='store', default=None,
+			  help='work out what a backup would do and write it to this file instead of doing it')
+	parser.add_option('--execute', dest='execute', action='store', default=None,
+			  help='apply a plan written by --plan, resuming from where any earlier attempt stopped')
+	parser.add_option('--shard', dest='shard', action='store', default=None,
+			  help='with --execute, only apply shard I of N (as I/N, counting from 0)')
+
+	parser.add_option('--mirror', dest='mirror', action='store_true', default=False,
+			  help='delete keys under the prefix whose files no longer exist locally')
+	parser.add_option('--mirror-max-delete', dest='mirror_max_delete', action='store', type='float', default=0.1,
+			  help='with --mirror, delete nothing if more than this fraction of the keys would go (default: 0.1)')
+
+	parser.add_option('--pack', dest='pack', action='store_true', default=False,
+			  help='store small files in per-directory archives rather than one key each')
+	parser.add_option('--pack-threshold', dest='pack_threshold', action='store', type='int', default=256,
+			  help='with --pack, files smaller than this many KB are packed (default: 256)')
+	parser.add_option('--pack-size', dest='pack_size', action='store', type='int', default=64,
+			  help='with --pack, start a new archive once one reaches this many MB (default: 64)')
+
+	parser.add_option('--dedup', dest='dedup', action='store_true', default=False,
+			  help='store each distinct file content once, named by its MD5, with a manifest of paths per run')
+
+	parser.add_option('--watch', dest='watch', action='store_true', default=False,
+			  help='keep running and back up files as they change (Linux only)')
+	parser.add_option('--watch-delay', dest='watch_delay', action='store', type='float', default=2,
+			  help='with --watch, wait until a file has been left alone for this many seconds (default: 2)')
+	parser.add_option('--reconcile', dest='reconcile', action='store', type='int', default=3600,
+			  help='with --watch, do a full run every this many seconds (default: 3600)')
+
+	parser.add_option('--hash-procs', dest='hash_procs', action='store', type='int', default=0,
+			  help='with --checksum or --dedup, hash files in this many processes ahead of the workers (default: 0, hash in the workers)')
+	parser.add_option('--hash-batch', dest='hash_batch', action='store', type='int', default=64,
+			  help='with --hash-procs, number of files handed to a process at a time (default: 64)')
+
+	parser.add_option('--stream', dest='stream', action='store', default=None,
+			  help='store what is read from stdin (or --stream-from) at this key under the prefix, rather than backing up a directory')
+	parser.add_option('--stream-from', dest='stream_from', action='store', default='-',
+			  help='with --stream, read from this file or named pipe rather than stdin')
+
 	options, args = parser.parse_args()
 
 	cfg = ConfigParser.ConfigParser()
 	cfg.read(options.config)
 
 	s = s3(cfg)
+
+	if options.plan and options.execute:
+		parser.error('--plan can not be combined with --execute')
+
+	if options.watch:
+
+		if options.plan or options.execute:
+			parser.error('--watch can not be combined with --plan or --execute')
+
+		try:
+			s.watch(options)
+		except KeyboardInterrupt:
+			pass
+
+		sys.exit()
+
+	if options.stream:
+
+		if options.watch or options.plan or options.execute or options.pack or options.dedup:
+			parser.error('--stream can not be combined with --watch, --plan, --execute, --pack or --dedup')
+
+		if s.stream(options) is None:
+			sys.exit(1)
+
+		sys.exit()
+
 	c = s.backup(options)
 
-	logging.info('backup completed, %s new files stored' % c)
+	if options.plan:
+		logging.info('plan written to %s' % options.plan)
+	else:
+		logging.info('backup completed, %s new files stored' % c)
+
 	sys.exit()
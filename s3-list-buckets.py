@@ -1,38 +1,442 @@
 #!/usr/bin/env python
 
+"""Lists buckets or, with --inventory, takes stock of what is in them: the
+number of objects, the bytes they add up to, how their sizes are spread
+and when the oldest and newest of them were last modified. Buckets are
+listed in parallel, and a bucket with more than a page of keys is split
+into key ranges (see s3_ranges) that are listed in parallel too. What is
+found is cached locally for --ttl seconds, so asking again is instant."""
+
 import os
 import os.path
-import httplib
+import json
+import time
 import logging
+import threading
+import Queue
 
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
+import aws_session
+import s3_ranges
+import s3_scheduler
 
 logging.basicConfig(level=logging.INFO)
 
+def human(n):
+
+	for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+
+		if n < 1024 or unit == 'TB':
+			break
+
+		n /= 1024.0
+
+	if unit == 'B':
+		return '%s%s' % (n, unit)
+
+	return '%.1f%s' % (n, unit)
+
+def utf8(s):
+
+	if isinstance(s, unicode):
+		return s.encode('utf-8')
+
+	return s
+
+# What is in a bucket, or in part of one. Sizes are counted in
+# power-of-four buckets from 1KB up, each keyed by its upper bound, which
+# is plenty to tell a bucket of thumbnails from one of disk images.
+
+class stats:
+
+	def __init__(self, data=None):
+
+		self.count = 0
+		self.bytes = 0
+		self.sizes = {}
+		self.oldest = None
+		self.newest = None
+
+		if data:
+			self.count = data['count']
+			self.bytes = data['bytes']
+			self.sizes = dict([ (int(bound), n) for bound, n in data['sizes'].items() ])
+
+			# JSON hands back unicode, but key names are kept as
+			# UTF-8 byte strings
+
+			if data['oldest']:
+				self.oldest = tuple([ utf8(v) for v in data['oldest'] ])
+				self.newest = tuple([ utf8(v) for v in data['newest'] ])
+
+	def add(self, name, size, last_modified):
+
+		self.count += 1
+		self.bytes += size
+
+		bound = 1024
+
+		while bound < size:
+			bound *= 4
+
+		self.sizes[bound] = self.sizes.get(bound, 0) + 1
+
+		# LastModified: 2010-07-11T15:42:30.000Z, which sorts as it
+		# should as a string
+
+		if self.oldest is None or last_modified < self.oldest[0]:
+			self.oldest = (last_modified, name)
+
+		if self.newest is None or last_modified > self.newest[0]:
+			self.newest = (last_modified, name)
+
+	def merge(self, other):
+
+		self.count += other.count
+		self.bytes += other.bytes
+
+		for bound, n in other.sizes.items():
+			self.sizes[bound] = self.sizes.get(bound, 0) + n
+
+		if other.oldest and (self.oldest is None or other.oldest < self.oldest):
+			self.oldest = other.oldest
+
+		if other.newest and (self.newest is None or other.newest > self.newest):
+			self.newest = other.newest
+
+	def as_dict(self):
+
+		return {
+			'count': self.count,
+			'bytes': self.bytes,
+			'sizes': dict([ (str(bound), n) for bound, n in self.sizes.items() ]),
+			'oldest': self.oldest,
+			'newest': self.newest,
+		}
+
+class s3:
+
+	def __init__(self, cfg):
+
+		self.cfg = cfg
+		self.session = None
+		self.scheduler = None
+		self.failed = {}
+
+	def list_buckets(self):
+
+		if not self.session:
+			self.session = aws_session.from_config(self.cfg)
+
+		return self.session.s3().get_all_buckets()
+
+	# Returns { bucket name: { stats, plus when it was listed } } for the
+	# buckets named, or all of them
+
+	def inventory(self, options, names=None):
+
+		buckets = [ b.name.encode('utf-8') for b in self.list_buckets() ]
+
+		if names:
+			buckets = [ name for name in buckets if name in names ]
+
+		cache = self.load_cache(options)
+		found = {}
+		now = time.time()
+
+		for name in buckets:
+
+			cached = cache.get(name)
+
+			if cached and not options.refresh and now - cached['listed'] < options.ttl:
+				found[name] = cached
+
+		wanted = [ name for name in buckets if not name in found ]
+
+		if wanted:
+
+			self.scheduler = s3_scheduler.scheduler(options.rate, concurrency=options.workers, retries=options.retries)
+
+			self.lock = threading.Lock()
+			self.totals = {}
+			self.pending = {}
+			self.failed = {}
+			self.started = {}
+
+			# Each bucket starts as a single listing of its first page,
+			# which is all a small bucket needs; the workers split up
+			# whatever is left of a bigger one
+
+			tasks = Queue.Queue()
+
+			for name in wanted:
+
+				self.totals[name] = stats()
+				self.pending[name] = 1
+				self.started[name] = time.time()
+
+				tasks.put((name, None, None, True))
+
+			workers = []
+
+			for i in range(min(options.workers, len(wanted) * options.shards)):
+
+				t = threading.Thread(target=self.worker, args=(options, tasks))
+				t.setDaemon(True)
+				t.start()
+
+				workers.append(t)
+
+			tasks.join()
+
+			for t in workers:
+				tasks.put(None)
+
+			for t in workers:
+				t.join()
+
+			for name in wanted:
+
+				if name in self.failed:
+					continue
+
+				entry = self.totals[name].as_dict()
+				entry['listed'] = int(now)
+
+				found[name] = cache[name] = entry
+
+			try:
+				self.save_cache(options, cache)
+			except Exception, e:
+				logging.error('failed to write %s: %s' % (self.cache_path(options), e))
+
+		return found
+
+	def worker(self, options, tasks):
+
+		while True:
+
+			task = tasks.get()
+
+			if task is None:
+				break
+
+			name, low, high, first = task
+
+			try:
+				self.list_range(options, tasks, self.session.bucket(name, validate=False), low, high, first)
+
+			except Exception, e:
+				logging.error('failed to list %s after %s: %s' % (name, low, e))
+
+				self.lock.acquire()
+
+				try:
+					self.failed[name] = True
+				finally:
+					self.lock.release()
+
+			self.lock.acquire()
+
+			try:
+				self.pending[name] -= 1
+				done = not self.pending[name]
+			finally:
+				self.lock.release()
+
+			if done and not name in self.failed:
+
+				totals = self.totals[name]
+				logging.info('%s: %s objects, %s in %.1fs' % (name, totals.count, human(totals.bytes), time.time() - self.started[name]))
+
+			tasks.task_done()
+
+	# Lists the keys in (low, high], or with first just the first page,
+	# queueing up ranges for the rest if there is more
+
+	def list_range(self, options, tasks, bucket, low, high, first):
+
+		found = stats()
+		marker = low
+
+		while True:
+
+			rs = self.scheduler.call(bucket.get_all_keys, marker=marker or '')
+
+			finished = not rs.is_truncated
+
+			for k in rs:
+
+				name = k.name
+
+				if isinstance(name, unicode):
+					name = name.encode('utf-8')
+
+				if not s3_ranges.in_range(name, high):
+					finished = True
+					break
+
+				found.add(name, int(k.size), str(k.last_modified))
+				marker = name
+
+			if finished or first:
+				break
+
+		ranges = []
+
+		if first and not finished:
+			ranges = s3_ranges.discover(lambda *args: self.list_page(bucket, *args), '', options.shards, marker)
+
+		self.lock.acquire()
+
+		try:
+			self.totals[bucket.name].merge(found)
+
+			if ranges:
+
+				self.pending[bucket.name] += len(ranges)
+
+				for low, high in ranges:
+					tasks.put((bucket.name, low, high, False))
+
+		finally:
+			self.lock.release()
+
+	# A page of keys under prefix with '/' as the delimiter, as (key
+	# names, common prefixes), for s3_ranges.discover
+
+	def list_page(self, bucket, prefix, marker, max_keys):
+
+		from boto.s3.prefix import Prefix
+
+		names = []
+		prefixes = []
+
+		for item in self.scheduler.call(bucket.get_all_keys, prefix=prefix, marker=marker, delimiter='/', max_keys=max_keys):
+
+			if isinstance(item, Prefix):
+				prefixes.append(utf8(item.name))
+			else:
+				names.append(utf8(item.name))
+
+		return names, prefixes
+
+	# Like the backup index, the cache lives next to the config file by
+	# default
+
+	def cache_path(self, options):
+
+		if options.cache:
+			return options.cache
+
+		root, ext = os.path.splitext(os.path.abspath(options.config))
+		return '%s-inventory.json' % root
+
+	def load_cache(self, options):
+
+		path = self.cache_path(options)
+
+		if not os.path.exists(path):
+			return {}
+
+		try:
+			fh = open(path, 'rb')
+
+			try:
+				data = json.load(fh)
+			finally:
+				fh.close()
+
+		except Exception, e:
+			logging.warning('ignoring unreadable cache %s: %s' % (path, e))
+			return {}
+
+		return dict([ (utf8(name), entry) for name, entry in data['buckets'].items() ])
+
+	def save_cache(self, options, cache):
+
+		path = self.cache_path(options)
+		tmp = '%s.tmp' % path
+
+		fh = open(tmp, 'wb')
+
+		try:
+			json.dump({ 'buckets': cache }, fh, sort_keys=True)
+		finally:
+			fh.close()
+
+		os.rename(tmp, path)
+
+	def report(self, found):
+
+		for name in sorted(found.keys(), key=lambda name: -found[name]['bytes']):
+
+			entry = found[name]
+			totals = stats(entry)
+
+			print '%s: %s objects, %s (listed %s)' % (name, totals.count, human(totals.bytes), time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['listed'])))
+
+			if totals.oldest:
+				print '  oldest: %s %s' % totals.oldest
+				print '  newest: %s %s' % totals.newest
+
+			for bound in sorted(totals.sizes.keys()):
+				print '  <= %8s: %s' % (human(bound), totals.sizes[bound])
+
 if __name__ == '__main__':
 
 	import ConfigParser
 	import optparse
 	import sys
 
-	parser = optparse.OptionParser()
+	parser = optparse.OptionParser(usage="""s3-list-buckets.py [options] [bucket ...]
+
+Prints the names of the buckets or, with --inventory, what is in them (all
+of them, or only the ones named).""")
+
 	parser.add_option('-c', '--config', dest='config', action='store')
 
+	parser.add_option('-i', '--inventory', dest='inventory', action='store_true', default=False,
+			  help='count the objects and bytes in each bucket')
+	parser.add_option('--json', dest='json', action='store_true', default=False,
+			  help='with --inventory, print the results as JSON')
+	parser.add_option('--ttl', dest='ttl', action='store', type='int', default=3600,
+			  help='with --inventory, use cached results up to this many seconds old (default: 3600)')
+	parser.add_option('--refresh', dest='refresh', action='store_true', default=False,
+			  help='with --inventory, list every bucket again whatever the cache says')
+	parser.add_option('--cache', dest='cache', action='store', default=None,
+			  help='where to cache inventory results (default: next to the config file)')
+
+	parser.add_option('-w', '--workers', dest='workers', action='store', type='int', default=8,
+			  help='number of listings to run in parallel (default: 8)')
+	parser.add_option('--shards', dest='shards', action='store', type='int', default=8,
+			  help='number of key ranges to split a bucket of more than 1000 keys into (default: 8)')
+	parser.add_option('--rate', dest='rate', action='store', type='float', default=0,
+			  help='maximum number of requests per second (default: no limit)')
+	parser.add_option('--retries', dest='retries', action='store', type='int', default=5,
+			  help='number of times to retry a request that was throttled or failed transiently (default: 5)')
+
 	options, args = parser.parse_args()
 
 	cfg = ConfigParser.ConfigParser()
 	cfg.read(options.config)
 
-	bucket = None
-	deleted = 0
-        
-	access_key = cfg.get('aws', 'access_key')
-	access_secret = cfg.get('aws', 'access_secret')
-	conn = S3Connection(access_key, access_secret)
+	s = s3(cfg)
+
+	if not options.inventory:
+
+		for b in s.list_buckets():
+			print b.name
+
+		sys.exit()
+
+	found = s.inventory(options, args)
 
-	for b in conn.get_all_buckets():
+	if options.json:
+		print json.dumps({ 'buckets': found }, indent=2, sort_keys=True)
+	else:
+		s.report(found)
 
-		print b.name
+	if s.failed:
+		sys.exit(1)
 
 	sys.exit()
@@ -1,59 +1,661 @@
 #!/usr/bin/env python
 
+"""Deletes the keys in a bucket, or only the ones matching some rules,
+with multi-object DELETE requests of up to 1000 keys each. The key space
+is split into ranges that are listed in parallel, and each range's lister
+feeds batches to a pool of delete workers. How far each range has got is
+checkpointed to a local file, so an interrupted purge carries on where it
+stopped rather than listing everything again."""
+
+import sys
 import os
 import os.path
-import httplib
+import re
+import json
+import time
+import calendar
 import logging
+import threading
+import collections
+import Queue
 
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
+import aws_session
+import s3_metrics
+import s3_ranges
+import s3_scheduler
 
 logging.basicConfig(level=logging.INFO)
 
+# How the keys were split into ranges and where each range has got to:
+# the last key listed such that every matching key up to it has been
+# deleted. Batches can be deleted out of order, so the position only
+# moves on once every batch before it is done, and a range where a batch
+# failed stays where it was so that the next run lists those keys again.
+# The ranges themselves are kept because splitting the keys that are
+# left would come out differently.
+
+class checkpoint:
+
+	def __init__(self, path, params):
+
+		self.path = path
+		self.params = params
+		self.lock = threading.Lock()
+		self.changed = False
+
+		self.layout = None
+		self.ranges = {}
+		self.issued = {}
+		self.stalled = {}
+
+	def load(self):
+
+		if not os.path.exists(self.path):
+			return False
+
+		fh = open(self.path, 'rb')
+
+		try:
+			data = json.load(fh)
+		finally:
+			fh.close()
+
+		if data['params'] != self.params:
+			raise Exception('%s is for a different purge (%s), remove it to start again' % (self.path, json.dumps(data['params'], sort_keys=True)))
+
+		def utf8(s):
+
+			if s is None:
+				return None
+
+			return s.encode('utf-8')
+
+		self.layout = [ (utf8(low), utf8(high)) for low, high in data['layout'] ]
+
+		for n, entry in data['ranges'].items():
+
+			marker = entry['marker']
+
+			if marker is not None:
+				marker = marker.encode('utf-8')
+
+			self.ranges[int(n)] = { 'marker': marker, 'done': entry['done'] }
+
+		return True
+
+	def set_layout(self, layout):
+
+		self.lock.acquire()
+
+		try:
+			self.layout = layout
+			self.changed = True
+		finally:
+			self.lock.release()
+
+	def marker(self, n):
+		return self.ranges.get(n, {}).get('marker')
+
+	def is_done(self, n):
+		return self.ranges.get(n, {}).get('done', False)
+
+	# Called by a range's lister, in listing order, for each batch it
+	# hands out; upto is the last key listed when the batch was cut.
+	# Returns the entry to pass to complete().
+
+	def issue(self, n, upto, finished=False):
+
+		entry = [ upto, finished, None ]
+
+		self.lock.acquire()
+
+		try:
+
+			if not n in self.stalled:
+				self.issued.setdefault(n, collections.deque()).append(entry)
+
+		finally:
+			self.lock.release()
+
+		return entry
+
+	# Listing on past keys that didn't match needs nothing deleting, so
+	# the position can move on as soon as everything before it is done
+
+	def listed(self, n, upto, finished=False):
+
+		self.lock.acquire()
+
+		try:
+			issued = self.issued.get(n)
+			merged = False
+
+			# Only the latest of several positions in a row matters
+
+			if issued and issued[-1][2] and not issued[-1][1]:
+				issued[-1][0] = upto
+				issued[-1][1] = finished
+				merged = True
+
+		finally:
+			self.lock.release()
+
+		if merged:
+			self.advance(n)
+		else:
+			self.complete(n, self.issue(n, upto, finished))
+
+	def complete(self, n, entry, ok=True):
+
+		self.lock.acquire()
+
+		try:
+			entry[2] = ok
+
+			if n in self.stalled:
+				return
+
+			if not ok:
+				self.stalled[n] = True
+				self.issued.pop(n, None)
+				return
+
+		finally:
+			self.lock.release()
+
+		self.advance(n)
+
+	def advance(self, n):
+
+		self.lock.acquire()
+
+		try:
+			issued = self.issued.get(n)
+
+			while issued and issued[0][2]:
+
+				upto, finished, ok = issued.popleft()
+
+				self.ranges[n] = { 'marker': upto, 'done': finished }
+				self.changed = True
+
+		finally:
+			self.lock.release()
+
+	def is_complete(self, count):
+		return not self.stalled and len([ n for n in range(count) if self.is_done(n) ]) == count
+
+	# Written to a temporary file and renamed into place, so that a purge
+	# killed half way through a write still has the previous checkpoint
+
+	def save(self):
+
+		self.lock.acquire()
+
+		try:
+
+			if not self.changed:
+				return
+
+			data = json.dumps({ 'params': self.params, 'layout': self.layout, 'ranges': self.ranges, 'saved': int(time.time()) }, sort_keys=True)
+			self.changed = False
+
+		finally:
+			self.lock.release()
+
+		tmp = '%s.tmp' % self.path
+		fh = open(tmp, 'wb')
+
+		try:
+			fh.write(data)
+		finally:
+			fh.close()
+
+		os.rename(tmp, self.path)
+
+	def remove(self):
+
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+
+class purge:
+
+	def __init__(self, cfg):
+
+		self.cfg = cfg
+		self.session = None
+		self.scheduler = None
+		self.metrics = None
+		self.checkpoint = None
+		self.errors = 0
+
+	# Returns the number of keys deleted (or that would be, with
+	# --dry-run), or None if the purge didn't get going
+
+	def purge(self, options):
+
+		for p in ('bucket', 'prefix', 'match', 'older_than', 'min_size', 'max_size', 'dry_run', 'shards', 'workers', 'rate', 'checkpoint'):
+			logging.info('%s: %s' % (p, getattr(options, p)))
+
+		bucket = None
+
+		try:
+
+			if not self.session:
+				self.session = aws_session.from_config(self.cfg)
+
+			bucket = self.session.bucket(options.bucket)
+
+		except Exception, e:
+			logging.error('failed to get on with AWS: %s' % e)
+			return None
+
+		if not bucket:
+			logging.error('failed to locate any buckets named %s' % options.bucket)
+			return None
+
+		self.metrics = s3_metrics.metrics('s3purge')
+		self.scheduler = s3_scheduler.scheduler(options.rate, concurrency=options.workers + options.shards, retries=options.retries, metrics=self.metrics)
+
+		self.pattern = None
+
+		if options.match:
+			self.pattern = re.compile(options.match)
+
+		self.cutoff = None
+
+		if options.older_than is not None:
+			self.cutoff = time.time() - options.older_than * 86400
+
+		ranges = None
+
+		if not options.dry_run:
+
+			params = {
+				'bucket': options.bucket,
+				'prefix': options.prefix,
+				'match': options.match,
+				'older_than': options.older_than,
+				'min_size': options.min_size,
+				'max_size': options.max_size,
+			}
+
+			self.checkpoint = checkpoint(self.checkpoint_path(options), params)
+
+			try:
+
+				if self.checkpoint.load():
+
+					ranges = self.checkpoint.layout
+					logging.info('resuming from %s, %s of %s ranges already done' % (self.checkpoint.path, len([ n for n in range(len(ranges)) if self.checkpoint.is_done(n) ]), len(ranges)))
+
+			except Exception, e:
+				logging.error('failed to load checkpoint: %s' % e)
+				return None
+
+		if ranges is None:
+
+			try:
+				with self.metrics.timer('phase.split'):
+					ranges = s3_ranges.discover(lambda *args: self.list_page(options, bucket, *args), options.prefix or '', options.shards)
+			except Exception, e:
+				logging.error('failed to split up %s: %s' % (options.bucket, e))
+				return None
+
+			logging.info('listing %s ranges in parallel' % len(ranges))
+
+			if self.checkpoint:
+				self.checkpoint.set_layout(ranges)
+
+		# The queue holds at most a couple of batches per worker, so the
+		# listers wait for the deletes to catch up and memory stays the
+		# same however big the bucket is
+
+		queue = Queue.Queue(options.workers * 2)
+		deleters = []
+		listers = []
+
+		if not options.dry_run:
+
+			for i in range(options.workers):
+
+				t = threading.Thread(target=self.deleter, args=(options.bucket, queue))
+				t.setDaemon(True)
+				t.start()
+
+				deleters.append(t)
+
+		for n, (low, high) in enumerate(ranges):
+
+			t = threading.Thread(target=self.lister, args=(options, bucket, n, low, high, queue))
+			t.setDaemon(True)
+			t.start()
+
+			listers.append(t)
+
+		try:
+			self.wait(options, listers)
+
+			for t in deleters:
+				queue.put(None)
+
+			self.wait(options, deleters)
+
+		except KeyboardInterrupt:
+
+			if self.checkpoint:
+				self.checkpoint.save()
+				logging.info('interrupted, run again with the same options to carry on from %s' % self.checkpoint.path)
+
+			return None
+
+		counters = self.metrics.as_dict()['counters']
+		self.errors = counters.get('errors', 0)
+
+		if options.dry_run:
+			logging.info('would delete %s keys (%s bytes) of the %s listed' % (counters.get('keys.matched', 0), counters.get('bytes.matched', 0), counters.get('keys.listed', 0)))
+
+		else:
+			self.checkpoint.save()
+
+			if self.errors or not self.checkpoint.is_complete(len(ranges)):
+				logging.error('%s errors, run again with the same options to pick up from %s' % (self.errors, self.checkpoint.path))
+			else:
+				self.checkpoint.remove()
+
+		self.metrics.incr('requests.retried', self.scheduler.retried)
+		self.metrics.incr('requests.throttled', self.scheduler.throttled)
+
+		self.metrics.summary()
+
+		if options.dry_run:
+			return counters.get('keys.matched', 0)
+
+		return counters.get('keys.deleted', 0)
+
+	# Waits for threads to finish, logging progress (and saving the
+	# checkpoint) every --progress seconds
+
+	def wait(self, options, threads):
+
+		last = self.metrics.as_dict()['counters']
+		last_time = time.time()
+
+		for t in threads:
+
+			while t.isAlive():
+
+				t.join(options.progress)
+
+				now = time.time()
+
+				if now - last_time < options.progress:
+					continue
+
+				counters = self.metrics.as_dict()['counters']
+				elapsed = now - last_time
+
+				def rate(name):
+					return (counters.get(name, 0) - last.get(name, 0)) / elapsed
+
+				logging.info('listed %s keys (%.0f/s), %s matching (%s bytes), deleted %s (%.0f/s)' % (counters.get('keys.listed', 0), rate('keys.listed'), counters.get('keys.matched', 0), counters.get('bytes.matched', 0), counters.get('keys.deleted', 0), rate('keys.deleted')))
+
+				last, last_time = counters, now
+
+				if self.checkpoint:
+					self.checkpoint.save()
+
+	# Like the backup index, the checkpoint lives next to the config file
+	# by default
+
+	def checkpoint_path(self, options):
+
+		if options.checkpoint:
+			return options.checkpoint
+
+		root, ext = os.path.splitext(os.path.abspath(options.config))
+		return '%s-purge-%s.json' % (root, options.bucket)
+
+	def matches(self, options, k, name):
+
+		if options.min_size is not None and k.size < options.min_size:
+			return False
+
+		if options.max_size is not None and k.size > options.max_size:
+			return False
+
+		# LastModified: 2010-07-11T15:42:30.000Z
+
+		if self.cutoff is not None and calendar.timegm(time.strptime(k.last_modified[:19], '%Y-%m-%dT%H:%M:%S')) >= self.cutoff:
+			return False
+
+		if self.pattern and not self.pattern.search(name):
+			return False
+
+		return True
+
+	# A page of keys under prefix with '/' as the delimiter, as (key
+	# names, common prefixes), for s3_ranges.discover
+
+	def list_page(self, options, bucket, prefix, marker, max_keys):
+
+		from boto.s3.prefix import Prefix
+
+		names = []
+		prefixes = []
+
+		for item in self.scheduler.call(bucket.get_all_keys, prefix=prefix, marker=marker, delimiter='/', max_keys=max_keys, what='LIST'):
+
+			name = item.name
+
+			if isinstance(name, unicode):
+				name = name.encode('utf-8')
+
+			if isinstance(item, Prefix):
+				prefixes.append(name)
+			else:
+				names.append(name)
+
+		return names, prefixes
+
+	# Lists one range a page at a time, picking up from the checkpoint,
+	# and hands out batches of matching keys as they fill up
+
+	def lister(self, options, bucket, n, low, high, queue):
+
+		if self.checkpoint and self.checkpoint.is_done(n):
+			return
+
+		marker = low
+
+		if self.checkpoint and self.checkpoint.marker(n) is not None:
+			marker = self.checkpoint.marker(n)
+
+		try:
+			bucket = self.session.bucket(options.bucket)
+		except Exception, e:
+			logging.error('failed to create lister connection: %s' % e)
+
+			self.metrics.incr('errors')
+			return
+
+		batch = []
+		finished = False
+
+		while not finished:
+
+			try:
+				rs = self.scheduler.call(bucket.get_all_keys, prefix=options.prefix or '', marker=marker or '', what='LIST')
+			except Exception, e:
+				logging.error('failed to list %s after %s: %s' % (options.bucket, marker, e))
+
+				self.metrics.incr('errors')
+				return
+
+			finished = not rs.is_truncated
+			listed = 0
+
+			for k in rs:
+
+				name = k.name
+
+				if isinstance(name, unicode):
+					name = name.encode('utf-8')
+
+				if not s3_ranges.in_range(name, high):
+					finished = True
+					break
+
+				marker = name
+				listed += 1
+
+				if not self.matches(options, k, name):
+					continue
+
+				self.metrics.incr('keys.matched')
+				self.metrics.incr('bytes.matched', k.size)
+
+				if options.dry_run:
+					continue
+
+				logging.debug('delete %s' % name)
+				batch.append((k.name, k.size))
+
+				if len(batch) == 1000:
+					queue.put((n, self.checkpoint.issue(n, name), batch))
+					batch = []
+
+			self.metrics.incr('keys.listed', listed)
+
+			if not listed and not finished:
+				logging.error('listing %s after %s came back empty but truncated' % (options.bucket, marker))
+
+				self.metrics.incr('errors')
+				return
+
+			if not batch and self.checkpoint:
+				self.checkpoint.listed(n, marker, finished)
+
+		if batch:
+			queue.put((n, self.checkpoint.issue(n, marker, True), batch))
+
+	# Failing to connect fails the batch like any other error, rather
+	# than the thread, which would leave the listers waiting on a full
+	# queue forever
+
+	def deleter(self, bucket_name, queue):
+
+		bucket = None
+
+		while True:
+
+			task = queue.get()
+
+			if task is None:
+				break
+
+			n, entry, batch = task
+			failed = {}
+
+			try:
+
+				if bucket is None:
+					bucket = self.session.bucket(bucket_name)
+
+				rsp = self.scheduler.call(bucket.delete_keys, [ name for name, size in batch ], quiet=True, what='DELETE.multi')
+
+				for err in rsp.errors:
+					logging.error('failed to delete %s: %s' % (err.key, err.message))
+					failed[err.key] = True
+
+			except Exception, e:
+				logging.error('failed to delete %s keys starting at %s: %s' % (len(batch), batch[0][0], e))
+
+				for name, size in batch:
+					failed[name] = True
+
+			deleted = [ (name, size) for name, size in batch if not name in failed ]
+
+			self.metrics.incr('keys.deleted', len(deleted))
+			self.metrics.incr('bytes.deleted', sum([ size for name, size in deleted ]))
+
+			if failed:
+				self.metrics.incr('keys.failed', len(failed))
+				self.metrics.incr('errors')
+
+			self.checkpoint.complete(n, entry, not failed)
+
 if __name__ == '__main__':
 
 	import ConfigParser
 	import optparse
-	import sys
 
 	parser = optparse.OptionParser()
 
 	parser.add_option('-c', '--config', dest='config', action='store')
 	parser.add_option('-B', '--bucket', dest='bucket', action='store')
-	parser.add_option('-X', dest='delete', action='store_true', default=False)        
+	parser.add_option('-X', dest='delete', action='store_true', default=False,
+			  help='delete the bucket itself once it is empty')
+
+	parser.add_option('-p', '--prefix', dest='prefix', action='store', default=None,
+			  help='only delete keys starting with this')
+	parser.add_option('--match', dest='match', action='store', default=None,
+			  help='only delete keys matching this regular expression')
+	parser.add_option('--older-than', dest='older_than', action='store', type='float', default=None,
+			  help='only delete keys last modified more than this many days ago')
+	parser.add_option('--min-size', dest='min_size', action='store', type='int', default=None,
+			  help='only delete keys of at least this many bytes')
+	parser.add_option('--max-size', dest='max_size', action='store', type='int', default=None,
+			  help='only delete keys of at most this many bytes')
+	parser.add_option('-n', '--dry-run', dest='dry_run', action='store_true', default=False,
+			  help='only count the keys (and bytes) that would be deleted')
+
+	parser.add_option('--shards', dest='shards', action='store', type='int', default=8,
+			  help='number of key ranges to list in parallel (default: 8)')
+	parser.add_option('-w', '--workers', dest='workers', action='store', type='int', default=4,
+			  help='number of 1000 key delete requests to make in parallel (default: 4)')
+	parser.add_option('--checkpoint', dest='checkpoint', action='store', default=None,
+			  help='where to record how far the purge has got (default: next to the config file)')
+	parser.add_option('--progress', dest='progress', action='store', type='int', default=10,
+			  help='log progress every this many seconds (default: 10)')
+
+	parser.add_option('--rate', dest='rate', action='store', type='float', default=0,
+			  help='maximum number of requests per second (default: no limit)')
+	parser.add_option('--retries', dest='retries', action='store', type='int', default=5,
+			  help='number of times to retry a request that was throttled or failed transiently (default: 5)')
 
 	options, args = parser.parse_args()
 
+	if not options.bucket:
+		parser.error('--bucket is required')
+
 	cfg = ConfigParser.ConfigParser()
 	cfg.read(options.config)
 
-	bucket = None
-	deleted = 0
-        
-	access_key = cfg.get('aws', 'access_key')
-	access_secret = cfg.get('aws', 'access_secret')
-	conn = S3Connection(access_key, access_secret)
-
-	for b in conn.get_all_buckets():
+	p = purge(cfg)
+	c = p.purge(options)
 
-		if b.name == options.bucket:
-			bucket = b
-			break
+	if c is None:
+		sys.exit(1)
 
-        if not bucket:
-        	logging.error('failed to locate any buckets named %s' % options.bucket)
+	if options.dry_run:
 		sys.exit()
 
-        
-        for key in bucket.list():
-        	logging.info('delete %s' % key.name)
-        	key.delete()
-                deleted += 1
-
-	logging.info('deleted %s keys from %s' % (deleted, options.bucket))
-        
-	if options.delete:
-        	logging.info('delete bucket %s' % options.bucket)
-		bucket.delete()
-        
+	logging.info('deleted %s keys from %s' % (c, options.bucket))
+
+	if p.errors:
+		sys.exit(1)
+
+	filtered = options.prefix or options.match or options.older_than is not None or options.min_size is not None or options.max_size is not None
+
+	if options.delete and not filtered:
+
+		logging.info('delete bucket %s' % options.bucket)
+
+		try:
+			p.session.s3().delete_bucket(options.bucket)
+		except Exception, e:
+			logging.error('failed to delete bucket %s: %s' % (options.bucket, e))
+			sys.exit(1)
+
 	sys.exit()
@@ -0,0 +1,771 @@
+#!/usr/bin/env python
+
+"""Gets back what s3-backup.py stored. Every key under the prefix, every
+file in its packs (see s3_pack) and every file in its latest --dedup
+manifest (see s3_dedup) is fetched back into a directory by a pool of
+workers. Large objects are fetched as parallel ranged GETs, files that
+already match are skipped and modification times are set from the
+x-mtime metadata that s3-backup.py stores."""
+
+import sys
+import os
+import os.path
+import errno
+import hashlib
+import logging
+import tarfile
+import tempfile
+import threading
+import time
+import Queue
+
+from cStringIO import StringIO
+
+import aws_session
+import s3_dedup
+import s3_digest
+import s3_metrics
+import s3_pack
+import s3_pool
+import s3_scheduler
+
+logging.basicConfig(level=logging.INFO)
+
+MB = 1024 * 1024
+
+class s3:
+
+	def __init__(self, cfg):
+
+		self.cfg = cfg
+		self.session = None
+		self.pool = None
+		self.scheduler = None
+		self.metrics = None
+
+	def restore(self, options, paths=None):
+
+		for p in ('directory', 'bucket', 'prefix', 'run', 'force', 'debug', 'workers', 'multipart_threshold', 'part_size', 'part_workers', 'pool_size', 'rate', 'bandwidth'):
+			logging.info('%s: %s' % (p, getattr(options, p)))
+
+		bucket = None
+
+		try:
+
+			if not self.session:
+				self.session = aws_session.from_config(self.cfg)
+
+			bucket = self.session.bucket(options.bucket)
+
+		except Exception, e:
+			logging.error('failed to get on with AWS: %s' % e)
+			return None
+
+		if not bucket:
+			logging.error('failed to locate any buckets named %s' % options.bucket)
+			return None
+
+		self.metrics = s3_metrics.metrics('s3restore')
+
+		self.pool = s3_pool.pool(max(options.pool_size, options.workers), options.idle_timeout)
+		self.scheduler = s3_scheduler.scheduler(options.rate, options.bandwidth * 1024, options.workers * max(options.part_workers, 1), retries=options.retries, metrics=self.metrics)
+
+		self.lock = threading.Lock()
+		self.counter = 0
+
+		# Files are written to temporary files, which mkstemp makes
+		# 0600, so they are given the mode open() would have. The umask
+		# can only be read by setting it, so that is done before there
+		# are any other threads to be affected.
+
+		umask = os.umask(0)
+		os.umask(umask)
+
+		self.mode = 0666 & ~umask
+
+		prefix = self.key_prefix(options)
+		paths = [ p.strip('/') for p in (paths or []) ]
+
+		try:
+			with self.metrics.timer('phase.manifest'):
+				manifest = self.load_manifest(options, bucket, paths)
+
+			packs = None
+
+			if s3_pack.index_key(prefix) in manifest:
+
+				with self.metrics.timer('phase.pack_index'):
+					packs = self.load_packs(options, bucket)
+
+			run = self.find_run(options, manifest)
+
+		except Exception, e:
+			logging.error('failed to list what there is to restore: %s' % e)
+			return None
+
+		queue = Queue.Queue(options.workers * 100)
+		workers = []
+
+		for i in range(options.workers):
+
+			t = threading.Thread(target=self.worker, args=(options, queue, bucket))
+			t.setDaemon(True)
+			t.start()
+
+			workers.append(t)
+
+		# A file can be stored as a key of its own, in a pack or as a
+		# blob named by a run's manifest, and more than one of them if
+		# the options changed between runs. It comes from whichever was
+		# stored last, unless a particular run was asked for.
+
+		chosen = {}
+
+		for key, (size, etag, last_modified) in manifest.items():
+
+			if s3_pack.is_pack_key(prefix, key) or s3_dedup.is_dedup_key(prefix, key):
+				continue
+
+			relpath = key[len(prefix):]
+
+			if relpath and self.wanted(relpath, paths):
+				chosen[relpath] = (last_modified, ('key', key, relpath, size, etag, None))
+
+		if packs:
+
+			for relpath, key, offset, length, mtime in packs.files():
+
+				stored = manifest.get(key, (0, '', ''))[2]
+
+				if self.wanted(relpath, paths) and stored > chosen.get(relpath, ('',))[0]:
+					chosen[relpath] = (stored, ('packed', key, offset, length, mtime))
+
+		if run:
+
+			size, etag, stored = manifest[run]
+
+			with self.metrics.timer('phase.run_manifest'):
+
+				for md5, size, mtime, relpath in self.load_run(options, bucket, run, etag):
+
+					if self.wanted(relpath, paths) and (options.run or stored > chosen.get(relpath, ('',))[0]):
+						chosen[relpath] = (stored, ('key', s3_dedup.blob_key(prefix, md5), relpath, size, md5, mtime))
+
+		archives = {}
+
+		for relpath in sorted(chosen.keys()):
+
+			task = chosen[relpath][1]
+
+			if task[0] == 'packed':
+				archives.setdefault(task[1], []).append((task[2], task[3], task[4], relpath))
+			else:
+				queue.put(task)
+
+		chosen = None
+
+		for key in sorted(archives.keys()):
+			queue.put(('archive', key, sorted(archives[key])))
+
+		for t in workers:
+			queue.put(None)
+
+		for t in workers:
+			t.join()
+
+		self.metrics.incr('connections.opened', self.pool.opened)
+		self.metrics.incr('connections.reused', self.pool.reused)
+		self.metrics.incr('requests.retried', self.scheduler.retried)
+		self.metrics.incr('requests.throttled', self.scheduler.throttled)
+
+		self.pool.close()
+
+		self.metrics.summary()
+
+		if options.metrics_file:
+
+			try:
+				self.metrics.write(options.metrics_file, options.metrics_format)
+			except Exception, e:
+				logging.error('failed to write metrics to %s: %s' % (options.metrics_file, e))
+
+		return self.counter
+
+	def key_prefix(self, options):
+
+		if options.prefix:
+			return '%s/' % options.prefix
+
+		return ''
+
+	def wanted(self, relpath, paths):
+
+		if not paths:
+			return True
+
+		for path in paths:
+
+			if relpath == path or relpath.startswith(path + '/'):
+				return True
+
+		return False
+
+	# Fetch (key, size, ETag, last-modified) for everything under the
+	# prefix, or only under the paths being restored (and the packs)
+
+	def load_manifest(self, options, bucket, paths):
+
+		prefix = self.key_prefix(options)
+		prefixes = [ prefix ]
+
+		if paths:
+			prefixes = [ prefix + p for p in paths ] + [ s3_pack.pack_prefix(prefix), s3_dedup.manifest_prefix(prefix) ]
+
+		manifest = {}
+
+		for p in prefixes:
+
+			logging.info('fetch manifest for %s/%s' % (bucket.name, p))
+
+			for k in bucket.list(prefix=p):
+
+				name = k.name
+
+				if isinstance(name, unicode):
+					name = name.encode('utf-8')
+
+				manifest[name] = (int(k.size), k.etag.strip('"'), k.last_modified)
+
+		logging.info('manifest contains %s keys' % len(manifest))
+		return manifest
+
+	# The manifest of the run being restored: the one named by --run or
+	# else the latest
+
+	def find_run(self, options, manifest):
+
+		prefix = s3_dedup.manifest_prefix(self.key_prefix(options))
+		runs = sorted([ key for key in manifest if key.startswith(prefix) ])
+
+		if options.run:
+
+			key = s3_dedup.manifest_key(self.key_prefix(options), options.run)
+
+			if not key in manifest:
+				raise Exception('there is no manifest for run %s' % options.run)
+
+			return key
+
+		if runs:
+			return runs[-1]
+
+		return None
+
+	# Yields (md5, size, mtime, relpath) from a run's manifest, which is
+	# fetched to a temporary file first since it can be large
+
+	def load_run(self, options, bucket, key, etag):
+
+		fd, path = tempfile.mkstemp(prefix='s3-restore-manifest-', suffix='.gz')
+		os.close(fd)
+
+		try:
+			self.scheduler.call(self.fetch, bucket, key, path, etag, what='GET')
+
+			run = s3_dedup.manifest(path)
+			logging.info('restore run %s from %s' % (run.header.get('run'), key))
+
+			for entry in run.entries():
+				yield entry
+
+			run.close()
+
+		finally:
+			os.unlink(path)
+
+	def load_packs(self, options, bucket):
+
+		k = bucket.new_key(s3_pack.index_key(self.key_prefix(options)))
+		packs = s3_pack.index(self.scheduler.call(k.get_contents_as_string, what='GET'))
+
+		logging.info('pack index lists %s groups' % len(packs.groups))
+		return packs
+
+	# Keys come from a bucket, so don't let one write anywhere but under
+	# the directory being restored into
+
+	def local_path(self, options, relpath):
+
+		parts = relpath.split('/')
+
+		if '' in parts or '.' in parts or '..' in parts:
+			logging.error('refusing to restore %s, which is not a plain relative path' % relpath)
+			return None
+
+		return os.path.join(options.directory, *parts)
+
+	def make_dirs(self, path):
+
+		try:
+			os.makedirs(path)
+		except OSError, e:
+
+			if e.errno != errno.EEXIST:
+				raise
+
+	def worker(self, options, queue, bucket):
+
+		while True:
+
+			task = queue.get()
+
+			if task is None:
+				break
+
+			try:
+
+				if task[0] == 'archive':
+					restored = self.restore_archive(options, bucket, task[1], task[2])
+				else:
+					restored = self.restore_key(options, bucket, *task[1:])
+
+			except Exception, e:
+				logging.error('failed to restore %s: %s' % (task[1], e))
+				restored = 0
+
+			if restored:
+				self.lock.acquire()
+
+				try:
+					self.counter += restored
+				finally:
+					self.lock.release()
+
+	# A key of the file's own or, for --dedup, a blob, which comes with
+	# its MD5 (as etag) and mtime from the run's manifest
+
+	def restore_key(self, options, bucket, key, relpath, size, etag, mtime=None):
+
+		local_path = self.local_path(options, relpath)
+
+		if not local_path:
+			self.metrics.incr('files.failed')
+			return 0
+
+		start = time.time()
+
+		if not options.force and self.is_restored(options, local_path, size, etag):
+			logging.debug('%s already matches %s, skipping' % (local_path, key))
+
+			self.metrics.timing('phase.check', time.time() - start)
+			self.metrics.incr('files.skipped')
+			return 0
+
+		self.metrics.timing('phase.check', time.time() - start)
+
+		if options.debug:
+			logging.info('restore %s to %s' % (key, local_path))
+			return 0
+
+		start = time.time()
+
+		try:
+			self.make_dirs(os.path.dirname(local_path))
+
+			fd, tmp = tempfile.mkstemp(prefix='.s3-restore-', dir=os.path.dirname(local_path))
+			os.close(fd)
+
+			try:
+
+				if size >= options.multipart_threshold * MB:
+					stored_mtime = self.fetch_ranges(options, bucket, key, tmp, size)
+				else:
+					stored_mtime = self.scheduler.call(self.fetch, bucket, key, tmp, etag, nbytes=size, what='GET')
+
+				if mtime is None:
+					mtime = stored_mtime
+
+				os.chmod(tmp, self.mode)
+				os.rename(tmp, local_path)
+
+			finally:
+
+				if os.path.exists(tmp):
+					os.unlink(tmp)
+
+			if mtime:
+				os.utime(local_path, (time.time(), float(mtime)))
+
+		except Exception, e:
+			logging.error('failed to restore %s to %s: %s' % (key, local_path, e))
+
+			self.metrics.incr('files.failed')
+			return 0
+
+		logging.info('%s restored to %s' % (key, local_path))
+
+		self.metrics.timing('phase.download', time.time() - start)
+		self.metrics.incr('files.restored')
+		self.metrics.incr('bytes.downloaded', size)
+
+		return 1
+
+	def is_restored(self, options, local_path, size, etag):
+
+		try:
+			st = os.stat(local_path)
+		except OSError:
+			return False
+
+		if st.st_size != size:
+			return False
+
+		return s3_digest.etag_matches(local_path, size, etag, [ self.part_size(options, size) ])
+
+	# The same part size s3-backup.py would have used, which makes it a
+	# good first guess for a multipart ETag
+
+	def part_size(self, options, size):
+
+		part_size = max(options.part_size * MB, 5 * MB)
+		return max(part_size, (size + 9999) / 10000)
+
+	def open_object(self, bucket, key, headers=None):
+
+		url = bucket.new_key(key).generate_url(expires_in=600, method='GET')
+		rsp = self.pool.open('GET', url, None, headers)
+
+		if rsp.status >= 300:
+
+			try:
+				rsp.data = rsp.read()
+			finally:
+				self.pool.discard(rsp)
+
+			self.check_response(rsp, 'GET')
+
+		return rsp
+
+	def check_response(self, rsp, method):
+
+		if rsp.status >= 500 or rsp.status == 429:
+			raise s3_scheduler.transient_error(rsp.status, rsp.reason)
+
+		if rsp.status >= 300:
+			raise Exception('%s returned %s: %s' % (method, rsp.status, rsp.data[:200]))
+
+	# Copies length bytes of the response to fh (or nowhere, if fh is
+	# None), feeding them to digest as it goes
+
+	def copy(self, rsp, fh, length, digest=None):
+
+		while length > 0:
+
+			chunk = rsp.read(min(length, MB))
+
+			if not chunk:
+				raise s3_scheduler.transient_error(rsp.status, 'response ended %s bytes early' % length)
+
+			if digest:
+				digest.update(chunk)
+
+			if fh:
+				fh.write(chunk)
+
+			length -= len(chunk)
+
+	# A single GET, checked against the ETag when that is a plain MD5.
+	# Returns the x-mtime metadata.
+
+	def fetch(self, bucket, key, path, etag):
+
+		rsp = self.open_object(bucket, key)
+		h = hashlib.md5()
+
+		try:
+			fh = open(path, 'wb')
+
+			try:
+				self.copy(rsp, fh, int(rsp.getheader('content-length')), h)
+			finally:
+				fh.close()
+
+		except Exception:
+			self.pool.discard(rsp)
+			raise
+
+		self.pool.release(rsp)
+
+		if etag and not '-' in etag and h.hexdigest() != etag:
+			raise Exception('MD5 of %s is %s rather than %s' % (key, h.hexdigest(), etag))
+
+		return rsp.getheader('x-amz-meta-x-mtime')
+
+	# Large objects are fetched in parts, in parallel, each part going
+	# straight to its place in the file. Returns the x-mtime metadata.
+
+	def fetch_ranges(self, options, bucket, key, path, size):
+
+		part_size = self.part_size(options, size)
+
+		todo = Queue.Queue()
+
+		for offset in range(0, size, part_size):
+			todo.put((offset, min(part_size, size - offset)))
+
+		fh = open(path, 'wb')
+		fh.truncate(size)
+		fh.close()
+
+		meta = {}
+		failed = []
+		threads = []
+
+		logging.info('fetch %s in %s parts' % (key, todo.qsize()))
+
+		for i in range(min(max(options.part_workers, 1), todo.qsize())):
+
+			t = threading.Thread(target=self.range_worker, args=(bucket, key, path, todo, meta, failed))
+			t.setDaemon(True)
+			t.start()
+
+			threads.append(t)
+
+		for t in threads:
+			t.join()
+
+		if failed:
+			raise Exception('%s of %s parts failed' % (len(failed), (size + part_size - 1) / part_size))
+
+		return meta.get('mtime')
+
+	def range_worker(self, bucket, key, path, todo, meta, failed):
+
+		while True:
+
+			try:
+				offset, length = todo.get_nowait()
+			except Queue.Empty:
+				break
+
+			try:
+				self.scheduler.call(self.fetch_range, bucket, key, path, offset, length, meta, nbytes=length, what='GET.range')
+			except Exception, e:
+				logging.warning('failed to fetch bytes %s-%s of %s: %s' % (offset, offset + length - 1, key, e))
+				failed.append(offset)
+
+	def fetch_range(self, bucket, key, path, offset, length, meta):
+
+		rsp = self.open_object(bucket, key, { 'Range': 'bytes=%s-%s' % (offset, offset + length - 1) })
+
+		try:
+
+			if rsp.status != 206:
+				raise Exception('GET returned %s rather than 206 for a ranged request' % rsp.status)
+
+			fh = open(path, 'r+b')
+
+			try:
+				fh.seek(offset)
+				self.copy(rsp, fh, length)
+			finally:
+				fh.close()
+
+		except Exception:
+			self.pool.discard(rsp)
+			raise
+
+		self.pool.release(rsp)
+
+		meta['mtime'] = rsp.getheader('x-amz-meta-x-mtime')
+
+	# Packed files are fetched an archive at a time, as few ranged GETs as
+	# possible: one for each run of wanted files with no more than a MB
+	# of unwanted ones in between. members is a sorted list of
+	# (offset, length, mtime, relpath).
+
+	def restore_archive(self, options, bucket, key, members):
+
+		spans = []
+		last = None
+
+		for offset, length, mtime, relpath in members:
+
+			local_path = self.local_path(options, relpath)
+
+			if not local_path:
+				self.metrics.incr('files.failed')
+				continue
+
+			if not options.force and self.is_unpacked(local_path, length, mtime):
+				logging.debug('%s already matches %s, skipping' % (local_path, key))
+
+				self.metrics.incr('files.skipped')
+				continue
+
+			if options.debug:
+				logging.info('restore %s (bytes %s-%s of %s) to %s' % (relpath, offset, offset + length - 1, key, local_path))
+				continue
+
+			if last is None or offset - last > MB:
+				spans.append([])
+
+			spans[-1].append((offset, length, mtime, local_path))
+			last = offset + length
+
+		restored = 0
+
+		for span in spans:
+
+			start = time.time()
+			nbytes = span[-1][0] + span[-1][1] - span[0][0] + tarfile.BLOCKSIZE
+
+			try:
+				self.scheduler.call(self.fetch_span, bucket, key, span, nbytes=nbytes, what='GET.range')
+			except Exception, e:
+				logging.error('failed to restore %s files from %s: %s' % (len(span), key, e))
+
+				self.metrics.incr('files.failed', len(span))
+				continue
+
+			logging.info('%s files restored from %s' % (len(span), key))
+
+			self.metrics.timing('phase.download', time.time() - start)
+			self.metrics.incr('files.restored', len(span))
+			self.metrics.incr('bytes.downloaded', nbytes)
+
+			restored += len(span)
+
+		return restored
+
+	# Packed files carry no checksum, so they are taken to match if the
+	# size and the modification time (which a restore sets) do
+
+	def is_unpacked(self, local_path, length, mtime):
+
+		try:
+			st = os.stat(local_path)
+		except OSError:
+			return False
+
+		return st.st_size == length and int(st.st_mtime) == int(mtime)
+
+	# Each file's tar header, which s3_pack.group.write fills in with the
+	# file's mode, is the block just before its data, so that is fetched
+	# too
+
+	def fetch_span(self, bucket, key, span):
+
+		first = span[0][0] - tarfile.BLOCKSIZE
+		last = span[-1][0] + span[-1][1]
+
+		rsp = self.open_object(bucket, key, { 'Range': 'bytes=%s-%s' % (first, last - 1) })
+
+		try:
+
+			if rsp.status != 206:
+				raise Exception('GET returned %s rather than 206 for a ranged request' % rsp.status)
+
+			position = first
+
+			for offset, length, mtime, local_path in span:
+
+				self.copy(rsp, None, offset - tarfile.BLOCKSIZE - position)
+
+				header = StringIO()
+				self.copy(rsp, header, tarfile.BLOCKSIZE)
+
+				mode = tarfile.TarInfo.frombuf(header.getvalue()).mode
+
+				self.make_dirs(os.path.dirname(local_path))
+
+				fd, tmp = tempfile.mkstemp(prefix='.s3-restore-', dir=os.path.dirname(local_path))
+				fh = os.fdopen(fd, 'wb')
+
+				try:
+
+					try:
+						self.copy(rsp, fh, length)
+					finally:
+						fh.close()
+
+					os.chmod(tmp, mode)
+					os.rename(tmp, local_path)
+
+				finally:
+
+					if os.path.exists(tmp):
+						os.unlink(tmp)
+
+				os.utime(local_path, (time.time(), mtime))
+				position = offset + length
+
+		except Exception:
+			self.pool.discard(rsp)
+			raise
+
+		self.pool.release(rsp)
+
+if __name__ == '__main__':
+
+	import ConfigParser
+	import optparse
+
+	parser = optparse.OptionParser(usage="""s3-restore.py [options] [path ...]
+
+Restores everything under the prefix, or only the given paths (files or
+directories, relative to the prefix).""")
+
+	parser.add_option('-c', '--config', dest='config', action='store')
+	parser.add_option('-D', '--directory', dest='directory', action='store',
+			  help='the directory to restore into')
+	parser.add_option('-B', '--bucket', dest='bucket', action='store')
+	parser.add_option('-p', '--prefix', dest='prefix', action='store', default=None)
+	parser.add_option('-f', '--force', dest='force', action='store_true', default=False,
+			  help='fetch files even if the local copy already matches')
+	parser.add_option('-d', '--debug', dest='debug', action='store_true', default=False,
+			  help='only log what would be restored')
+	parser.add_option('--run', dest='run', action='store', default=None,
+			  help='for a --dedup backup, restore the files as they were in this run rather than the latest')
+
+	parser.add_option('-w', '--workers', dest='workers', action='store', type='int', default=1,
+			  help='number of objects to fetch in parallel (default: 1)')
+
+	parser.add_option('--multipart-threshold', dest='multipart_threshold', action='store', type='int', default=64,
+			  help='fetch objects of at least this many MB as parallel ranged GETs (default: 64)')
+	parser.add_option('--part-size', dest='part_size', action='store', type='int', default=16,
+			  help='size of each ranged GET in MB, at least 5 (default: 16)')
+	parser.add_option('--part-workers', dest='part_workers', action='store', type='int', default=4,
+			  help='number of parts of a single object to fetch in parallel (default: 4)')
+
+	parser.add_option('--pool-size', dest='pool_size', action='store', type='int', default=10,
+			  help='number of idle keep-alive connections to keep per host, at least --workers (default: 10)')
+	parser.add_option('--idle-timeout', dest='idle_timeout', action='store', type='int', default=15,
+			  help='seconds after which an idle connection is not reused (default: 15)')
+
+	parser.add_option('--retries', dest='retries', action='store', type='int', default=5,
+			  help='number of times to retry a request that was throttled or failed transiently (default: 5)')
+	parser.add_option('--rate', dest='rate', action='store', type='float', default=0,
+			  help='maximum number of requests per second (default: no limit)')
+	parser.add_option('--bandwidth', dest='bandwidth', action='store', type='int', default=0,
+			  help='maximum download rate in KB per second (default: no limit)')
+
+	parser.add_option('--metrics-file', dest='metrics_file', action='store', default=None,
+			  help='write counters and per-phase/per-request timings here at the end of the run')
+	parser.add_option('--metrics-format', dest='metrics_format', action='store', default='json',
+			  type='choice', choices=('json', 'statsd'), help='json or statsd (default: json)')
+
+	options, args = parser.parse_args()
+
+	if not options.directory or not options.bucket:
+		parser.error('both --directory and --bucket are required')
+
+	cfg = ConfigParser.ConfigParser()
+	cfg.read(options.config)
+
+	s = s3(cfg)
+	c = s.restore(options, args)
+
+	logging.info('restore completed, %s files restored' % c)
+
+	sys.exit()
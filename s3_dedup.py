@@ -0,0 +1,89 @@
+"""Content-addressed storage for s3-backup.py --dedup.
+
+Each distinct file content is stored once, as <prefix>.blobs/<md5>, and
+every run writes a manifest, <prefix>.manifests/<run>.gz, saying which
+blob each path had at the time. A file that is copied, moved or renamed
+costs a manifest line rather than another upload.
+
+A manifest is a gzipped text file: a JSON header line, then one
+tab-separated line per file (md5, size, mtime, path, with the path
+string-escaped and relative to the prefix)."""
+
+import gzip
+import json
+import threading
+
+BLOBS = '.blobs'
+MANIFESTS = '.manifests'
+
+def blob_prefix(prefix):
+	return '%s%s/' % (prefix, BLOBS)
+
+def blob_key(prefix, md5):
+	return '%s%s' % (blob_prefix(prefix), md5)
+
+def manifest_prefix(prefix):
+	return '%s%s/' % (prefix, MANIFESTS)
+
+def manifest_key(prefix, run):
+	return '%s%s.gz' % (manifest_prefix(prefix), run)
+
+def is_dedup_key(prefix, key):
+	return key.startswith(blob_prefix(prefix)) or key.startswith(manifest_prefix(prefix))
+
+# The ETag of a single PUT is the MD5 of what was sent, so a blob with
+# any other ETag doesn't hold what its name says. Multipart ETags (and
+# missing ones) can't be checked that way, which is None.
+
+def etag_matches(md5, etag):
+
+	if not etag or '-' in etag:
+		return None
+
+	return etag == md5
+
+class manifest:
+
+	def __init__(self, path, header=None):
+
+		self.path = path
+		self.header = header
+		self.lock = threading.Lock()
+		self.count = 0
+
+		self.writing = header is not None
+
+		if self.writing:
+			self.fh = gzip.open(path, 'wb')
+			self.fh.write('# s3-backup manifest %s\n' % json.dumps(header, sort_keys=True))
+
+		else:
+			self.fh = gzip.open(path, 'rb')
+			self.header = json.loads(self.fh.readline().split(' ', 3)[3])
+
+	def add(self, md5, size, mtime, path):
+
+		line = '%s\t%s\t%s\t%s\n' % (md5, size, mtime, path.encode('string_escape'))
+
+		self.lock.acquire()
+
+		try:
+			self.fh.write(line)
+			self.count += 1
+		finally:
+			self.lock.release()
+
+	# Yields (md5, size, mtime, path) for every file
+
+	def entries(self):
+
+		for line in self.fh:
+
+			if line.startswith('#'):
+				continue
+
+			md5, size, mtime, path = line.rstrip('\n').split('\t')
+			yield md5, int(size), float(mtime), path.decode('string_escape')
+
+	def close(self):
+		self.fh.close()
@@ -0,0 +1,204 @@
+"""MD5 digests of local files in the forms S3 uses for ETags.
+
+A plain ETag is the MD5 of the object. A multipart ETag is the MD5 of the
+concatenated (binary) part MD5s followed by "-" and the number of parts,
+so it can only be reproduced by guessing the part size that was used."""
+
+import hashlib
+
+MB = 1024 * 1024
+
+def file_digest(local_path, part_size=0):
+	return file_digests(local_path, [ part_size ])[part_size]
+
+# Digests for several part sizes (0 being the MD5 of the whole file) from
+# a single read of the file. Returns { part_size: digest }.
+
+def file_digests(local_path, part_sizes):
+
+	whole = None
+
+	if 0 in part_sizes:
+		whole = hashlib.md5()
+
+	# part size -> [ MD5 of each part ], and how full the last part is;
+	# a part is only started once there is a byte to put in it, so there
+	# is never a trailing empty part
+
+	parts = {}
+	filled = {}
+
+	for part_size in part_sizes:
+
+		if part_size:
+			parts[part_size] = []
+			filled[part_size] = part_size
+
+	fh = open(local_path, 'rb')
+
+	try:
+
+		while True:
+
+			chunk = fh.read(MB)
+
+			if not chunk:
+				break
+
+			if whole:
+				whole.update(chunk)
+
+			for part_size, digests in parts.items():
+
+				offset = 0
+
+				while offset < len(chunk):
+
+					if filled[part_size] == part_size:
+						digests.append(hashlib.md5())
+						filled[part_size] = 0
+
+					n = min(part_size - filled[part_size], len(chunk) - offset)
+					digests[-1].update(buffer(chunk, offset, n))
+
+					filled[part_size] += n
+					offset += n
+
+	finally:
+		fh.close()
+
+	result = {}
+
+	if whole:
+		result[0] = whole.hexdigest()
+
+	for part_size, digests in parts.items():
+
+		# an empty file is one empty part
+
+		if not digests:
+			digests.append(hashlib.md5())
+
+		joined = ''.join([ d.digest() for d in digests ])
+		result[part_size] = '%s-%s' % (hashlib.md5(joined).hexdigest(), len(digests))
+
+	return result
+
+# Runs in the --hash-procs processes: work is a list of (path, part sizes)
+# and the result is a list of { part_size: digest } (or None for a file
+# that couldn't be read), in the same order
+
+def digest_batch(work):
+
+	results = []
+
+	for path, part_sizes in work:
+
+		try:
+			results.append(file_digests(path, part_sizes))
+		except (IOError, OSError):
+			results.append(None)
+
+	return results
+
+# The part sizes that would split size bytes into count parts: the
+# preferred ones, then the smallest whole number of MB that gives the right
+# number of parts, then the part sizes other tools default to
+
+def guess_part_sizes(size, count, preferred=()):
+
+	exact = max((size + count - 1) / count, 1)
+
+	candidates = list(preferred) + [ ((exact + MB - 1) / MB) * MB, exact ]
+	candidates.extend([ n * MB for n in (5, 8, 15, 16, 64, 100) ])
+
+	guesses = []
+
+	for part_size in candidates:
+
+		if part_size in guesses:
+			continue
+
+		if (size + part_size - 1) / part_size == count or (size == 0 and count == 1):
+			guesses.append(part_size)
+
+	return guesses
+
+# Returns the part sizes worth trying for an ETag, 0 meaning the MD5 of
+# the whole file, or nothing if it isn't an ETag we can reproduce
+
+def etag_part_sizes(etag, size, preferred=()):
+
+	if not etag:
+		return []
+
+	if not '-' in etag:
+		return [ 0 ]
+
+	try:
+		count = int(etag.split('-')[1])
+	except ValueError:
+		return []
+
+	return guess_part_sizes(size, count, preferred)
+
+def etag_matches(local_path, size, etag, preferred=()):
+
+	etag = (etag or '').strip('"')
+
+	for part_size in etag_part_sizes(etag, size, preferred):
+
+		if file_digest(local_path, part_size) == etag:
+			return True
+
+	return False
+
+# length bytes of a file, from where it is now, for use as a request body.
+# It hands out large reads whatever size it is asked for and works out the
+# MD5 of what it hands out, so that a file is read once to both send and
+# hash it.
+
+class reader:
+
+	def __init__(self, fh, length, chunk_size=MB):
+
+		self.fh = fh
+		self.start = fh.tell()
+		self.length = length
+		self.chunk_size = chunk_size
+
+		self.seek(0)
+
+	def read(self, n=-1):
+
+		want = min(self.chunk_size, self.length - self.position)
+
+		if want <= 0:
+			return ''
+
+		chunk = self.fh.read(want)
+
+		if not chunk:
+			raise IOError('%s ended %s bytes early' % (getattr(self.fh, 'name', 'file'), self.length - self.position))
+
+		self.md5.update(chunk)
+		self.position += len(chunk)
+
+		return chunk
+
+	def tell(self):
+		return self.position
+
+	# Only rewinding, to send the body again, is supported
+
+	def seek(self, offset, whence=0):
+
+		if offset != 0 or whence != 0:
+			raise IOError('can only seek to the start of a reader')
+
+		self.fh.seek(self.start)
+		self.position = 0
+		self.md5 = hashlib.md5()
+
+	def hexdigest(self):
+		return self.md5.hexdigest()
@@ -0,0 +1,512 @@
+#!/usr/bin/env python
+
+"""A small, in-memory, S3-compatible stand-in for benchmarks. It speaks
+just enough of the REST API (path-style requests, no signature checks)
+for the s3-* scripts to run against it, and can add latency and errors
+to every request. Point a script at it with host/port/is_secure in the
+[aws] section of its config.
+
+GET /_stats (which is not counted) returns, and resets, the number of
+requests by method and the bytes received and sent as JSON."""
+
+import BaseHTTPServer
+import json
+import SocketServer
+import cgi
+import hashlib
+import logging
+import random
+import re
+import threading
+import time
+import urllib
+import urlparse
+
+from xml.sax.saxutils import escape
+
+class s3store:
+
+	def __init__(self):
+
+		self.lock = threading.Lock()
+		self.buckets = {}
+		self.uploads = {}
+		self.requests = {}
+		self.bytes_in = 0
+		self.bytes_out = 0
+
+	def count(self, kind):
+
+		self.lock.acquire()
+
+		try:
+			self.requests[kind] = self.requests.get(kind, 0) + 1
+		finally:
+			self.lock.release()
+
+	def transferred(self, bytes_in=0, bytes_out=0):
+
+		self.lock.acquire()
+
+		try:
+			self.bytes_in += bytes_in
+			self.bytes_out += bytes_out
+		finally:
+			self.lock.release()
+
+	# Returns and resets the request counts and byte totals
+
+	def reset_counts(self):
+
+		self.lock.acquire()
+
+		try:
+			counts = (self.requests, self.bytes_in, self.bytes_out)
+
+			self.requests = {}
+			self.bytes_in = 0
+			self.bytes_out = 0
+		finally:
+			self.lock.release()
+
+		return counts
+
+class handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+
+	# buffer the status line and headers rather than sending each one in
+	# its own packet
+
+	wbufsize = -1
+	disable_nagle_algorithm = True
+
+	def log_message(self, format, *args):
+		pass
+
+	def parse(self):
+
+		parts = urlparse.urlsplit(self.path)
+		path = urllib.unquote(parts.path).lstrip('/')
+		query = cgi.parse_qs(parts.query, keep_blank_values=True)
+		query = dict([ (k, v[0]) for k, v in query.items() ])
+
+		bucket, key = path, ''
+
+		if '/' in path:
+			bucket, key = path.split('/', 1)
+
+		return bucket, key, query
+
+	def body(self):
+
+		length = int(self.headers.get('content-length', 0) or 0)
+
+		if not length:
+			return ''
+
+		self.server.store.transferred(bytes_in=length)
+		return self.rfile.read(length)
+
+	def respond(self, status, body='', headers=None, head=False):
+
+		self.send_response(status)
+
+		for k, v in (headers or {}).items():
+			self.send_header(k, v)
+
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+
+		if body and not head:
+			self.server.store.transferred(bytes_out=len(body))
+			self.wfile.write(body)
+
+	def error(self, status, code, head=False):
+
+		body = '<?xml version="1.0" encoding="UTF-8"?><Error><Code>%s</Code><Message>%s</Message></Error>' % (code, code)
+		self.respond(status, body, {'Content-Type': 'application/xml'}, head)
+
+	def xml(self, body):
+		self.respond(200, '<?xml version="1.0" encoding="UTF-8"?>' + body, {'Content-Type': 'application/xml'})
+
+	def stats(self):
+
+		requests, bytes_in, bytes_out = self.server.store.reset_counts()
+		body = json.dumps({ 'requests': requests, 'bytes_in': bytes_in, 'bytes_out': bytes_out })
+
+		self.respond(200, body, {'Content-Type': 'application/json'})
+
+	def dispatch(self, method):
+
+		if method == 'GET' and self.path == '/_stats':
+			return self.stats()
+
+		store = self.server.store
+		store.count(method)
+
+		if self.server.latency:
+			time.sleep(self.server.latency)
+
+		if self.server.error_rate and random.random() < self.server.error_rate:
+			self.body()
+			return self.error(503, 'SlowDown', method == 'HEAD')
+
+		bucket, key, query = self.parse()
+
+		if not bucket:
+			return self.list_buckets()
+
+		if not key:
+			return getattr(self, 'bucket_%s' % method.lower())(bucket, query)
+
+		return getattr(self, 'key_%s' % method.lower())(bucket, key, query)
+
+	def do_GET(self):
+		self.dispatch('GET')
+
+	def do_HEAD(self):
+		self.dispatch('HEAD')
+
+	def do_PUT(self):
+		self.dispatch('PUT')
+
+	def do_POST(self):
+		self.dispatch('POST')
+
+	def do_DELETE(self):
+		self.dispatch('DELETE')
+
+	# buckets
+
+	def list_buckets(self):
+
+		now = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+		names = sorted(self.server.store.buckets.keys())
+
+		buckets = ''.join([ '<Bucket><Name>%s</Name><CreationDate>%s</CreationDate></Bucket>' % (escape(n), now) for n in names ])
+		self.xml('<ListAllMyBucketsResult><Owner><ID>fake</ID><DisplayName>fake</DisplayName></Owner><Buckets>%s</Buckets></ListAllMyBucketsResult>' % buckets)
+
+	def bucket_put(self, bucket, query):
+
+		self.body()
+		self.server.store.buckets.setdefault(bucket, {})
+		self.respond(200)
+
+	def bucket_head(self, bucket, query):
+
+		if not bucket in self.server.store.buckets:
+			return self.error(404, 'NoSuchBucket', True)
+
+		self.respond(200)
+
+	def bucket_delete(self, bucket, query):
+
+		store = self.server.store
+
+		if store.buckets.get(bucket):
+			return self.error(409, 'BucketNotEmpty')
+
+		store.buckets.pop(bucket, None)
+		self.respond(204)
+
+	def bucket_get(self, bucket, query):
+
+		store = self.server.store
+
+		if not bucket in store.buckets:
+			return self.error(404, 'NoSuchBucket')
+
+		if 'uploads' in query:
+			return self.list_uploads(bucket, query)
+
+		prefix = query.get('prefix', '')
+		marker = query.get('marker', '')
+		delimiter = query.get('delimiter', '')
+		max_keys = int(query.get('max-keys', 1000))
+
+		store.lock.acquire()
+
+		try:
+			names = sorted(store.buckets[bucket].keys())
+		finally:
+			store.lock.release()
+
+		contents = []
+		prefixes = []
+		truncated = False
+		last = None
+
+		for name in names:
+
+			if name <= marker or not name.startswith(prefix):
+				continue
+
+			if len(contents) + len(prefixes) >= max_keys:
+				truncated = True
+				break
+
+			if delimiter:
+				idx = name.find(delimiter, len(prefix))
+
+				if idx != -1:
+					common = name[:idx + len(delimiter)]
+
+					if not common in prefixes:
+						prefixes.append(common)
+						last = common
+
+					continue
+
+			obj = store.buckets[bucket].get(name)
+
+			if obj is None:
+				continue
+
+			contents.append('<Contents><Key>%s</Key><LastModified>%s</LastModified><ETag>&quot;%s&quot;</ETag><Size>%s</Size><StorageClass>STANDARD</StorageClass></Contents>' % (escape(name), obj['iso'], obj['etag'], len(obj['data'])))
+			last = name
+
+		common = ''.join([ '<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>' % escape(p) for p in prefixes ])
+		next_marker = ''
+
+		if truncated and last:
+			next_marker = '<NextMarker>%s</NextMarker>' % escape(last)
+
+		self.xml('<ListBucketResult><Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker>%s<MaxKeys>%s</MaxKeys><IsTruncated>%s</IsTruncated>%s%s</ListBucketResult>' % (escape(bucket), escape(prefix), escape(marker), next_marker, max_keys, str(truncated).lower(), ''.join(contents), common))
+
+	def bucket_post(self, bucket, query):
+
+		store = self.server.store
+		body = self.body()
+
+		if not 'delete' in query:
+			return self.error(400, 'InvalidRequest')
+
+		deleted = []
+
+		for name in re.findall('<Key>(.*?)</Key>', body):
+
+			name = name.replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '"').replace('&apos;', "'").replace('&amp;', '&')
+			store.buckets.get(bucket, {}).pop(name, None)
+			deleted.append('<Deleted><Key>%s</Key></Deleted>' % escape(name))
+
+		if '<Quiet>true</Quiet>' in body:
+			deleted = []
+
+		self.xml('<DeleteResult>%s</DeleteResult>' % ''.join(deleted))
+
+	# multipart
+
+	def list_uploads(self, bucket, query):
+
+		store = self.server.store
+		prefix = query.get('prefix', '')
+		uploads = []
+
+		for upload_id, upload in sorted(store.uploads.items()):
+
+			if upload['bucket'] != bucket or not upload['key'].startswith(prefix):
+				continue
+
+			uploads.append('<Upload><Key>%s</Key><UploadId>%s</UploadId><Initiated>%s</Initiated><StorageClass>STANDARD</StorageClass></Upload>' % (escape(upload['key']), upload_id, upload['iso']))
+
+		self.xml('<ListMultipartUploadsResult><Bucket>%s</Bucket><IsTruncated>false</IsTruncated>%s</ListMultipartUploadsResult>' % (escape(bucket), ''.join(uploads)))
+
+	def list_parts(self, bucket, key, query):
+
+		upload = self.server.store.uploads.get(query['uploadId'])
+
+		if not upload:
+			return self.error(404, 'NoSuchUpload')
+
+		parts = []
+
+		for num, part in sorted(upload['parts'].items()):
+			parts.append('<Part><PartNumber>%s</PartNumber><LastModified>%s</LastModified><ETag>&quot;%s&quot;</ETag><Size>%s</Size></Part>' % (num, upload['iso'], part[0], len(part[1])))
+
+		self.xml('<ListPartsResult><Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId><IsTruncated>false</IsTruncated>%s</ListPartsResult>' % (escape(bucket), escape(key), query['uploadId'], ''.join(parts)))
+
+	# keys
+
+	def store_object(self, bucket, key, data, etag):
+
+		meta = {}
+
+		for k, v in self.headers.items():
+			if k.lower().startswith('x-amz-meta-'):
+				meta[k.lower()] = v
+
+		now = time.time()
+
+		obj = {
+			'data': data,
+			'etag': etag,
+			'meta': meta,
+			'iso': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(now)),
+			'http': time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(now)),
+		}
+
+		self.server.store.buckets[bucket][key] = obj
+		return obj
+
+	def key_put(self, bucket, key, query):
+
+		store = self.server.store
+		data = self.body()
+
+		if not bucket in store.buckets:
+			return self.error(404, 'NoSuchBucket')
+
+		if 'acl' in query:
+			return self.respond(200)
+
+		etag = hashlib.md5(data).hexdigest()
+
+		if 'uploadId' in query:
+
+			upload = store.uploads.get(query['uploadId'])
+
+			if not upload:
+				return self.error(404, 'NoSuchUpload')
+
+			upload['parts'][int(query['partNumber'])] = (etag, data)
+			return self.respond(200, '', {'ETag': '"%s"' % etag})
+
+		self.store_object(bucket, key, data, etag)
+		self.respond(200, '', {'ETag': '"%s"' % etag})
+
+	def key_post(self, bucket, key, query):
+
+		store = self.server.store
+		body = self.body()
+
+		if 'uploads' in query:
+
+			upload_id = '%032x' % random.getrandbits(128)
+
+			store.uploads[upload_id] = {
+				'bucket': bucket,
+				'key': key,
+				'parts': {},
+				'headers': dict(self.headers.items()),
+				'iso': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+			}
+
+			return self.xml('<InitiateMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId></InitiateMultipartUploadResult>' % (escape(bucket), escape(key), upload_id))
+
+		if 'uploadId' in query:
+
+			upload = store.uploads.pop(query['uploadId'], None)
+
+			if not upload:
+				return self.error(404, 'NoSuchUpload')
+
+			nums = [ int(n) for n in re.findall('<PartNumber>(\d+)</PartNumber>', body) ]
+			parts = [ upload['parts'][n] for n in nums ]
+
+			digests = ''.join([ p[0].decode('hex') for p in parts ])
+			etag = '%s-%s' % (hashlib.md5(digests).hexdigest(), len(parts))
+
+			self.headers = upload['headers']
+			self.store_object(bucket, key, ''.join([ p[1] for p in parts ]), etag)
+
+			return self.xml('<CompleteMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key><ETag>&quot;%s&quot;</ETag></CompleteMultipartUploadResult>' % (escape(bucket), escape(key), etag))
+
+		self.error(400, 'InvalidRequest')
+
+	def key_head(self, bucket, key, query):
+		self.key_get(bucket, key, query, True)
+
+	def key_get(self, bucket, key, query, head=False):
+
+		store = self.server.store
+
+		if 'uploadId' in query:
+			return self.list_parts(bucket, key, query)
+
+		obj = store.buckets.get(bucket, {}).get(key)
+
+		if obj is None:
+			return self.error(404, 'NoSuchKey', head)
+
+		if 'acl' in query:
+			return self.xml('<AccessControlPolicy></AccessControlPolicy>')
+
+		data = obj['data']
+		status = 200
+
+		headers = {
+			'ETag': '"%s"' % obj['etag'],
+			'Last-Modified': obj['http'],
+			'Content-Type': 'application/octet-stream',
+			'Accept-Ranges': 'bytes',
+		}
+
+		headers.update(obj['meta'])
+
+		m = re.match('bytes=(\d+)-(\d*)$', self.headers.get('range', ''))
+
+		if m:
+			start = int(m.group(1))
+			end = len(data) - 1
+
+			if m.group(2):
+				end = min(int(m.group(2)), end)
+
+			headers['Content-Range'] = 'bytes %s-%s/%s' % (start, end, len(data))
+			data = data[start:end + 1]
+			status = 206
+
+		self.respond(status, data, headers, head)
+
+	def key_delete(self, bucket, key, query):
+
+		store = self.server.store
+
+		if 'uploadId' in query:
+			store.uploads.pop(query['uploadId'], None)
+			return self.respond(204)
+
+		store.buckets.get(bucket, {}).pop(key, None)
+		self.respond(204)
+
+class server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address, latency=0.0, error_rate=0.0):
+
+		BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+
+		self.store = s3store()
+		self.latency = latency
+		self.error_rate = error_rate
+
+	def start(self):
+
+		t = threading.Thread(target=self.serve_forever)
+		t.setDaemon(True)
+		t.start()
+
+		return t
+
+if __name__ == '__main__':
+
+	import optparse
+
+	parser = optparse.OptionParser()
+	parser.add_option('-H', '--host', dest='host', action='store', default='127.0.0.1')
+	parser.add_option('-p', '--port', dest='port', action='store', type='int', default=8000,
+			  help='port to listen on, 0 for any free one (default: 8000)')
+	parser.add_option('-l', '--latency', dest='latency', action='store', type='float', default=0.0)
+	parser.add_option('-e', '--error-rate', dest='error_rate', action='store', type='float', default=0.0)
+
+	options, args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO)
+
+	s = server((options.host, options.port), options.latency, options.error_rate)
+	logging.info('fake S3 listening on %s:%s' % s.server_address)
+
+	s.serve_forever()
@@ -0,0 +1,197 @@
+"""Watches a tree for files that are written, created or moved into it,
+using Linux's inotify through ctypes (so there is nothing to install).
+
+inotify only watches single directories, so every directory in the tree
+gets a watch of its own and new directories are watched as they appear.
+Anything that the per-directory bookkeeping can't follow (the kernel's
+event queue overflowing, a directory being moved) is reported as a need to
+rescan, which the caller should answer by walking the whole tree."""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import os.path
+import select
+import stat
+import struct
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 02000000
+
+MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR | IN_DONT_FOLLOW
+
+EVENT = struct.Struct('iIII')
+
+_libc = None
+
+def libc():
+
+	global _libc
+
+	if _libc is None:
+		_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+		if not hasattr(_libc, 'inotify_init1'):
+			raise Exception('inotify is not available on this system')
+
+	return _libc
+
+class watcher:
+
+	# skip(relpath) says whether a directory should be left out
+
+	def __init__(self, root, skip=None):
+
+		self.root = root
+		self.skip = skip
+		self.paths = {}
+		self.unwatched = 0
+
+		self.fd = libc().inotify_init1(IN_CLOEXEC)
+
+		if self.fd < 0:
+			e = ctypes.get_errno()
+			raise OSError(e, 'inotify_init1: %s' % os.strerror(e))
+
+		self.rescan()
+
+	# Watches every directory in the tree. Watching a directory that is
+	# watched already just hands back its existing watch, so this also
+	# brings the paths of moved directories up to date.
+
+	def rescan(self):
+
+		self.paths = {}
+		self.unwatched = 0
+
+		self.add('')
+
+		if self.unwatched:
+			logging.warning('%s directories under %s are not being watched; only full runs will see changes there' % (self.unwatched, self.root))
+
+		logging.info('watching %s directories under %s' % (len(self.paths), self.root))
+
+	def add(self, reldir):
+
+		pending = [ reldir ]
+
+		while pending:
+
+			reldir = pending.pop()
+			fulldir = os.path.join(self.root, reldir)
+
+			if reldir and self.skip and self.skip(reldir):
+				continue
+
+			wd = libc().inotify_add_watch(self.fd, fulldir, MASK)
+
+			if wd < 0:
+
+				e = ctypes.get_errno()
+
+				# ENOSPC is running out of watches (see
+				# /proc/sys/fs/inotify/max_user_watches)
+
+				if e != errno.ENOENT:
+					logging.debug('failed to watch %s: %s' % (fulldir, os.strerror(e)))
+					self.unwatched += 1
+
+				continue
+
+			self.paths[wd] = reldir
+
+			try:
+				names = os.listdir(fulldir)
+			except OSError:
+				continue
+
+			for name in names:
+
+				try:
+					st = os.lstat(os.path.join(fulldir, name))
+				except OSError:
+					continue
+
+				if stat.S_ISDIR(st.st_mode):
+					pending.append(os.path.join(reldir, name))
+
+	# Waits up to timeout seconds (None for ever) and returns the paths,
+	# relative to the root, of files and directories that appeared or
+	# changed, and whether the tree needs to be rescanned
+
+	def read(self, timeout=None):
+
+		changed = []
+		rescan = False
+
+		r, w, x = select.select([ self.fd ], [], [], timeout)
+
+		if not r:
+			return changed, rescan
+
+		try:
+			buf = os.read(self.fd, 256 * 1024)
+		except OSError, e:
+
+			if e.errno in (errno.EAGAIN, errno.EINTR):
+				return changed, rescan
+
+			raise
+
+		offset = 0
+
+		while offset + EVENT.size <= len(buf):
+
+			wd, mask, cookie, length = EVENT.unpack_from(buf, offset)
+			name = buf[offset + EVENT.size:offset + EVENT.size + length].rstrip('\0')
+
+			offset += EVENT.size + length
+
+			if mask & IN_Q_OVERFLOW:
+				rescan = True
+				continue
+
+			if mask & IN_IGNORED:
+				self.paths.pop(wd, None)
+				continue
+
+			reldir = self.paths.get(wd)
+
+			if reldir is None or not name:
+				continue
+
+			relpath = os.path.join(reldir, name)
+
+			if mask & IN_ISDIR:
+
+				# The watches under a directory that moved still know
+				# it by its old name
+
+				if mask & IN_MOVED_FROM:
+					rescan = True
+
+				elif mask & (IN_CREATE | IN_MOVED_TO):
+					self.add(relpath)
+					changed.append(relpath)
+
+				continue
+
+			if mask & (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE):
+				changed.append(relpath)
+
+		return changed, rescan
+
+	def close(self):
+		os.close(self.fd)
@@ -0,0 +1,192 @@
+"""Counters and latency histograms for the s3-* scripts, with a plain text
+summary and JSON or StatsD-style output for graphing runs over time."""
+
+import json
+import logging
+import threading
+import time
+
+# Latencies go into power-of-two millisecond buckets, which is plenty to
+# tell a 20ms request from a 2s one and costs a fixed amount of memory.
+
+class histogram:
+
+	def __init__(self):
+
+		self.count = 0
+		self.total = 0.0
+		self.min = None
+		self.max = None
+		self.buckets = {}
+
+	def add(self, seconds):
+
+		ms = seconds * 1000.0
+
+		self.count += 1
+		self.total += ms
+
+		if self.min is None or ms < self.min:
+			self.min = ms
+
+		if self.max is None or ms > self.max:
+			self.max = ms
+
+		bound = 1
+
+		while bound < ms:
+			bound *= 2
+
+		self.buckets[bound] = self.buckets.get(bound, 0) + 1
+
+	# The upper bound of the bucket holding the pth percentile
+
+	def percentile(self, p):
+
+		if not self.count:
+			return 0
+
+		wanted = self.count * p / 100.0
+		seen = 0
+
+		for bound in sorted(self.buckets.keys()):
+
+			seen += self.buckets[bound]
+
+			if seen >= wanted:
+				return min(bound, self.max)
+
+		return self.max
+
+	def as_dict(self):
+
+		mean = 0
+
+		if self.count:
+			mean = self.total / self.count
+
+		return {
+			'count': self.count,
+			'total_ms': round(self.total, 3),
+			'mean_ms': round(mean, 3),
+			'min_ms': round(self.min or 0, 3),
+			'max_ms': round(self.max or 0, 3),
+			'p50_ms': round(self.percentile(50), 3),
+			'p90_ms': round(self.percentile(90), 3),
+			'p99_ms': round(self.percentile(99), 3),
+			'buckets': dict([ (str(k), v) for k, v in self.buckets.items() ]),
+		}
+
+class timer:
+
+	def __init__(self, metrics, name):
+
+		self.metrics = metrics
+		self.name = name
+
+	def __enter__(self):
+
+		self.start = time.time()
+		return self
+
+	def __exit__(self, type, value, tb):
+		self.metrics.timing(self.name, time.time() - self.start)
+
+class metrics:
+
+	def __init__(self, prefix=''):
+
+		self.prefix = prefix
+		self.lock = threading.Lock()
+
+		self.started = time.time()
+		self.counters = {}
+		self.timers = {}
+
+	def incr(self, name, n=1):
+
+		self.lock.acquire()
+
+		try:
+			self.counters[name] = self.counters.get(name, 0) + n
+		finally:
+			self.lock.release()
+
+	def timing(self, name, seconds):
+
+		self.lock.acquire()
+
+		try:
+
+			if not name in self.timers:
+				self.timers[name] = histogram()
+
+			self.timers[name].add(seconds)
+
+		finally:
+			self.lock.release()
+
+	def timer(self, name):
+		return timer(self, name)
+
+	def as_dict(self):
+
+		self.lock.acquire()
+
+		try:
+			return {
+				'started': int(self.started),
+				'elapsed': round(time.time() - self.started, 3),
+				'counters': dict(self.counters),
+				'timers': dict([ (k, v.as_dict()) for k, v in self.timers.items() ]),
+			}
+		finally:
+			self.lock.release()
+
+	def summary(self):
+
+		data = self.as_dict()
+
+		logging.info('run took %.3fs' % data['elapsed'])
+
+		for name in sorted(data['counters'].keys()):
+			logging.info('%s: %s' % (name, data['counters'][name]))
+
+		for name in sorted(data['timers'].keys()):
+
+			t = data['timers'][name]
+			logging.info('%s: count=%s total=%.1fms mean=%.1fms p50=%.1fms p90=%.1fms p99=%.1fms max=%.1fms' % (name, t['count'], t['total_ms'], t['mean_ms'], t['p50_ms'], t['p90_ms'], t['p99_ms'], t['max_ms']))
+
+	def statsd_lines(self):
+
+		data = self.as_dict()
+		prefix = self.prefix
+
+		if prefix:
+			prefix = prefix + '.'
+
+		lines = [ '%selapsed:%s|g' % (prefix, int(data['elapsed'] * 1000)) ]
+
+		for name, value in sorted(data['counters'].items()):
+			lines.append('%s%s:%s|c' % (prefix, name, value))
+
+		for name, t in sorted(data['timers'].items()):
+			for stat in ('count', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms'):
+				lines.append('%s%s.%s:%s|g' % (prefix, name, stat.replace('_ms', ''), t[stat]))
+
+		return lines
+
+	def write(self, path, format='json'):
+
+		fh = open(path, 'w')
+
+		try:
+
+			if format == 'statsd':
+				fh.write('\n'.join(self.statsd_lines()) + '\n')
+			else:
+				json.dump(self.as_dict(), fh, indent=2, sort_keys=True)
+				fh.write('\n')
+
+		finally:
+			fh.close()
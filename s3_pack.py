@@ -0,0 +1,325 @@
+"""Packing small files into archive objects, so that a tree of millions of
+tiny files costs a few large PUTs rather than one PUT per file.
+
+Small files are grouped by the directory they live in. Each group is
+written as one or more tar archives under <prefix>.packs/ and a single
+gzipped JSON index, <prefix>.packs/index.json.gz, records where every
+file ended up:
+
+	{
+	  "version": 1,
+	  "groups": {
+	    "some/dir": {
+	      "signature": "<md5 of the names, sizes and mtimes>",
+	      "archives": [ "<prefix>.packs/<key>.tar", ... ],
+	      "files": { "name": [ archive, offset, length, mtime ], ... }
+	    }
+	  }
+	}
+
+where archive is a position in the group's list of archives and offset
+and length are the file's bytes within it, so any one file can be had
+with a single ranged GET. Groups whose signature hasn't changed since the
+last run are left alone. The archives are plain tar files, so they can
+also be unpacked without the index."""
+
+import gzip
+import hashlib
+import json
+import os
+import tarfile
+import tempfile
+import threading
+import time
+
+from cStringIO import StringIO
+
+DIRNAME = '.packs'
+
+def pack_prefix(prefix):
+	return '%s%s/' % (prefix, DIRNAME)
+
+def index_key(prefix):
+	return '%sindex.json.gz' % pack_prefix(prefix)
+
+def is_pack_key(prefix, key):
+	return key.startswith(pack_prefix(prefix))
+
+# S3 keys (and the JSON index) have to be UTF-8, so anything else is left
+# to be stored, or to fail, the usual way.
+
+def packable(relpath):
+
+	try:
+		relpath.decode('utf-8')
+	except UnicodeDecodeError:
+		return False
+
+	return True
+
+# JSON hands back unicode, but local paths and keys are byte strings
+
+def utf8(data):
+
+	if isinstance(data, unicode):
+		return data.encode('utf-8')
+
+	if isinstance(data, dict):
+		return dict([ (utf8(k), utf8(v)) for k, v in data.items() ])
+
+	if isinstance(data, list):
+		return [ utf8(v) for v in data ]
+
+	return data
+
+# The small files in one directory, as the walk found them
+
+class group:
+
+	def __init__(self, reldir):
+
+		self.reldir = reldir
+		self.files = []
+		self.size = 0
+
+	def add(self, fullpath, name, st):
+
+		self.files.append((fullpath, name, st))
+		self.size += st.st_size
+
+	def signature(self):
+
+		h = hashlib.md5()
+
+		for fullpath, name, st in sorted(self.files, key=lambda f: f[1]):
+			h.update('%s\0%s\0%s\n' % (name, st.st_size, st.st_mtime))
+
+		return h.hexdigest()
+
+	# Archive keys are unique to the run so that the archives the index
+	# points at are never overwritten before the new index is stored
+
+	def archive_key(self, prefix, run, n):
+
+		digest = hashlib.md5(self.reldir).hexdigest()[:16]
+		return '%s%s-%s-%s.tar' % (pack_prefix(prefix), digest, run, n)
+
+	# Writes the group out as tar files of about pack_size bytes each,
+	# calling store(path, n) for each one as it is finished. Returns
+	# { name: (n, offset, length, mtime) } for the files that made it in.
+
+	def write(self, pack_size, store, tmpdir=None):
+
+		packed = {}
+		failed = []
+
+		n = 0
+		members = 0
+		fh = None
+		tar = None
+
+		try:
+
+			for fullpath, name, st in self.files:
+
+				if tar is None:
+					fd, path = tempfile.mkstemp(prefix='s3-backup-pack-', suffix='.tar', dir=tmpdir)
+					fh = os.fdopen(fd, 'w+b')
+					tar = tarfile.open(fileobj=fh, mode='w')
+
+				# Read the whole file first so that one that changes size
+				# underneath us can't leave a short member in the archive
+
+				try:
+					src = open(fullpath, 'rb')
+
+					try:
+						data = src.read()
+						mtime = os.fstat(src.fileno()).st_mtime
+					finally:
+						src.close()
+
+				except Exception, e:
+					failed.append((fullpath, e))
+					continue
+
+				info = tarfile.TarInfo(os.path.join(self.reldir, name))
+				info.size = len(data)
+				info.mtime = int(mtime)
+				info.mode = st.st_mode & 07777
+
+				tar.addfile(info, StringIO(data))
+
+				# The data is followed by padding to the next 512 byte block
+
+				offset = tar.offset - ((len(data) + tarfile.BLOCKSIZE - 1) / tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+				packed[name] = (n, offset, len(data), mtime)
+				members += 1
+
+				if tar.offset >= pack_size:
+					self.finish(tar, fh, path, n, store)
+					tar = fh = None
+					members = 0
+					n += 1
+
+			if tar is not None and members:
+				self.finish(tar, fh, path, n, store)
+				tar = fh = None
+
+		finally:
+
+			if tar is not None:
+				tar.close()
+				fh.close()
+				os.unlink(path)
+
+		return packed, failed
+
+	def finish(self, tar, fh, path, n, store):
+
+		tar.close()
+		fh.close()
+
+		try:
+			store(path, n)
+		finally:
+			os.unlink(path)
+
+class index:
+
+	def __init__(self, data=None):
+
+		self.lock = threading.Lock()
+		self.changed = False
+
+		if data:
+			self.data = utf8(json.loads(gzip.GzipFile(fileobj=StringIO(data)).read()))
+		else:
+			self.data = { 'version': 1, 'groups': {} }
+
+		self.groups = self.data['groups']
+
+	# With count, a group that still holds files that are gone (see
+	# update) isn't current either
+
+	def is_current(self, reldir, signature, count=None):
+
+		self.lock.acquire()
+
+		try:
+			entry = self.groups.get(reldir)
+		finally:
+			self.lock.release()
+
+		if entry is None or entry['signature'] != signature:
+			return False
+
+		return count is None or len(entry['files']) == count
+
+	# Records the new archives for a group and returns the archive keys
+	# that nothing points at any more. With keep_missing, files that were
+	# packed before but aren't now stay where they were, as they would
+	# have if they had been stored one key each.
+
+	def update(self, reldir, signature, archives, packed, keep_missing=True):
+
+		self.lock.acquire()
+
+		try:
+
+			old = self.groups.get(reldir, { 'archives': [], 'files': {} })
+
+			keep = []
+			files = {}
+
+			if keep_missing:
+
+				for name, entry in old['files'].items():
+
+					if name in packed:
+						continue
+
+					key = old['archives'][entry[0]]
+
+					if not key in keep:
+						keep.append(key)
+
+					files[name] = [ keep.index(key) ] + entry[1:]
+
+			for name, (n, offset, length, mtime) in packed.items():
+				files[name] = [ len(keep) + n, offset, length, mtime ]
+
+			self.groups[reldir] = {
+				'signature': signature,
+				'archives': keep + archives,
+				'files': files,
+			}
+
+			self.changed = True
+
+			return [ key for key in old['archives'] if not key in keep and not key in archives ]
+
+		finally:
+			self.lock.release()
+
+	# Drops groups that weren't seen, other than any holding a file that
+	# keep(relpath) says to keep, and returns their archive keys
+
+	def forget(self, seen, keep=None):
+
+		self.lock.acquire()
+
+		try:
+
+			gone = []
+
+			for reldir, entry in self.groups.items():
+
+				if reldir in seen:
+					continue
+
+				if keep and [ name for name in entry['files'] if keep(os.path.join(reldir, name)) ]:
+					continue
+
+				gone.extend(self.groups.pop(reldir)['archives'])
+				self.changed = True
+
+			return gone
+
+		finally:
+			self.lock.release()
+
+	def archives(self):
+
+		keys = {}
+
+		for entry in self.groups.values():
+			for key in entry['archives']:
+				keys[key] = True
+
+		return keys
+
+	# Yields (relpath, archive key, offset, length, mtime) for every file
+
+	def files(self):
+
+		for reldir, entry in self.groups.items():
+			for name, (n, offset, length, mtime) in entry['files'].items():
+				yield os.path.join(reldir, name), entry['archives'][n], offset, length, mtime
+
+	def dumps(self):
+
+		self.lock.acquire()
+
+		try:
+			self.data['updated'] = int(time.time())
+
+			buf = StringIO()
+			fh = gzip.GzipFile(fileobj=buf, mode='wb')
+			fh.write(json.dumps(self.data, sort_keys=True, separators=(',', ':')))
+			fh.close()
+
+			return buf.getvalue()
+
+		finally:
+			self.lock.release()
@@ -0,0 +1,175 @@
+"""A small pool of persistent (keep-alive) HTTP connections to S3, shared
+between threads, so that request-heavy runs don't pay for a new TCP
+connection (and TLS handshake) for every request."""
+
+import httplib
+import logging
+import socket
+import threading
+import time
+import urlparse
+
+class pool:
+
+	def __init__(self, size=10, idle_timeout=15, timeout=60):
+
+		# size is the number of idle connections kept per host, not a
+		# limit on how many may be open at once
+
+		self.size = size
+		self.idle_timeout = idle_timeout
+		self.timeout = timeout
+
+		self.lock = threading.Lock()
+		self.idle = {}
+
+		self.opened = 0
+		self.reused = 0
+
+	def acquire(self, scheme, netloc):
+
+		now = time.time()
+		conn = None
+
+		self.lock.acquire()
+
+		try:
+			conns = self.idle.get((scheme, netloc), [])
+
+			while conns:
+
+				conn, last_used = conns.pop()
+
+				if now - last_used < self.idle_timeout:
+					self.reused += 1
+					return conn, True
+
+				conn.close()
+
+			self.opened += 1
+
+		finally:
+			self.lock.release()
+
+		if scheme == 'https':
+			conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+		else:
+			conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+		# httplib sends the headers and a file body in separate writes;
+		# with Nagle on, the body then waits for the server's delayed ACK
+
+		conn.connect()
+		conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+		return conn, False
+
+	def release(self, rsp):
+
+		conn = getattr(rsp, 'pool_conn', None)
+
+		if not conn:
+			return
+
+		rsp.pool_conn = None
+
+		if rsp.will_close or not rsp.isclosed():
+			conn.close()
+			return
+
+		self.lock.acquire()
+
+		try:
+			conns = self.idle.setdefault(rsp.pool_key, [])
+
+			if len(conns) < self.size:
+				conns.append((conn, time.time()))
+				return
+		finally:
+			self.lock.release()
+
+		conn.close()
+
+	def discard(self, rsp):
+
+		conn = getattr(rsp, 'pool_conn', None)
+
+		if conn:
+			rsp.pool_conn = None
+			conn.close()
+
+	# Returns the response without reading its body; the caller must
+	# read it to the end and then hand it back with release() (or give
+	# up on it with discard()).
+
+	def open(self, method, url, body=None, headers=None):
+
+		parts = urlparse.urlsplit(url)
+		path = parts.path or '/'
+
+		if parts.query:
+			path = '%s?%s' % (path, parts.query)
+
+		# A connection that has been idle may have been closed by the
+		# other end, which we only find out when we use it, so requests
+		# on a reused connection get one retry on a fresh one.
+
+		start = None
+
+		if hasattr(body, 'tell'):
+			start = body.tell()
+
+		while True:
+
+			conn, reused = self.acquire(parts.scheme, parts.netloc)
+
+			try:
+				conn.request(method, path, body, headers or {})
+				rsp = conn.getresponse()
+
+			except (socket.error, httplib.HTTPException), e:
+				conn.close()
+
+				if not reused or (body and start is None and hasattr(body, 'read')):
+					raise
+
+				logging.debug('stale connection to %s, retrying: %s' % (parts.netloc, e))
+
+				if start is not None:
+					body.seek(start)
+
+				continue
+
+			rsp.pool_conn = conn
+			rsp.pool_key = (parts.scheme, parts.netloc)
+
+			return rsp
+
+	# Like open() but reads the body (into rsp.data) and releases the
+	# connection.
+
+	def request(self, method, url, body=None, headers=None):
+
+		rsp = self.open(method, url, body, headers)
+
+		try:
+			rsp.data = rsp.read()
+		except Exception:
+			self.discard(rsp)
+			raise
+
+		self.release(rsp)
+		return rsp
+
+	def close(self):
+
+		self.lock.acquire()
+
+		try:
+			for conns in self.idle.values():
+				for conn, last_used in conns:
+					conn.close()
+
+			self.idle = {}
+		finally:
+			self.lock.release()
@@ -0,0 +1,119 @@
+"""Splitting the keys under a prefix into ranges that can be listed in
+parallel.
+
+S3 can't say how keys are spread out without listing them, so the split
+is made at prefixes that are actually there: the ones a listing with '/'
+as the delimiter turns up or, where there are too few of those, the
+characters that the keys go on with, found by skipping from one to the
+next with single key listings. Either way a lone prefix is gone down
+into, so that a bucket that is all photos/0... is split within that. A
+range is (low, high]: it is listed with low as the marker (S3 lists the
+keys after the marker) and ends at the last key that is no greater than
+high, None meaning the start or the end of the listing."""
+
+# How many levels of prefixes to go down through
+
+MAX_DEPTH = 8
+
+# Higher than any character there can be in a key (U+10FFFF), for
+# skipping past every key that starts a certain way
+
+LAST = u'\U0010ffff'.encode('utf-8')
+
+# list_page(prefix, marker, max_keys) lists keys under prefix after
+# marker with '/' as the delimiter and returns (key names, common
+# prefixes). With after, only the keys after it are split up (for when
+# the first page has been listed already).
+
+def discover(list_page, prefix, count, after=None):
+
+	bounds = find_bounds(list_page, prefix, count, after)
+
+	if after is not None:
+		bounds = [ b for b in bounds if b > after ]
+
+	bounds = sorted(set(bounds))
+
+	return zip([ after ] + bounds, bounds + [ None ])
+
+def find_bounds(list_page, prefix, count, after=None, depth=0):
+
+	if count <= 1 or depth >= MAX_DEPTH:
+		return []
+
+	names, prefixes = list_page(prefix, '', 1000)
+
+	# Leave out the prefixes whose keys all come before after
+
+	if after is not None:
+		prefixes = [ p for p in prefixes if p > after or after.startswith(p) ]
+
+	# Keys of their own at this level are split up by what they go on
+	# with, as are any prefixes (by their first characters)
+
+	if names or not prefixes:
+		prefixes = next_chars(list_page, prefix, after)
+
+	return spread(list_page, prefixes, count, after, depth)
+
+# Bounds at count - 1 of the prefixes or, with fewer than that, at each
+# of them and within each of them
+
+def spread(list_page, prefixes, count, after, depth):
+
+	if len(prefixes) >= count:
+
+		step = len(prefixes) / float(count)
+		return [ prefixes[int(step * i)] for i in range(1, count) ]
+
+	if not prefixes:
+		return []
+
+	if len(prefixes) == 1:
+		return find_bounds(list_page, prefixes[0], count, after, depth + 1)
+
+	per = max(1, count / len(prefixes))
+	bounds = []
+
+	for p in prefixes:
+		bounds.append(p)
+		bounds.extend(find_bounds(list_page, p, per, after, depth + 1))
+
+	return bounds
+
+# prefix plus each character that keys under it (after after) go on
+# with, in order. Characters are whole UTF-8 sequences, so that the
+# markers stay valid.
+
+def next_chars(list_page, prefix, after=None, limit=100):
+
+	found = []
+	marker = prefix
+
+	if after is not None and after.startswith(prefix):
+		marker = after
+
+	uprefix = prefix.decode('utf-8')
+
+	while len(found) < limit:
+
+		names, prefixes = list_page(prefix, marker, 1)
+		names = names + prefixes
+
+		if not names:
+			break
+
+		name = min(names).decode('utf-8', 'replace')
+
+		if len(name) <= len(uprefix):
+			break
+
+		p = (uprefix + name[len(uprefix)]).encode('utf-8')
+
+		found.append(p)
+		marker = p + LAST
+
+	return found
+
+def in_range(name, high):
+	return high is None or name <= high
@@ -0,0 +1,214 @@
+"""Rate limiting, retries and adaptive concurrency for S3 requests.
+
+Every request goes through scheduler.call(), which waits for a free slot
+and for enough request (and byte) tokens, runs the request, and retries
+it with exponential backoff and jitter if S3 throttles us (503 SlowDown)
+or something transient goes wrong. The number of requests allowed in
+flight is halved when S3 throttles us and creeps back up as requests
+succeed, so a run settles at the highest rate S3 will sustain."""
+
+import httplib
+import logging
+import random
+import socket
+import threading
+import time
+
+# Raised by callers for responses that are worth retrying (5xx, throttling)
+# when they are not talking to S3 through boto.
+
+class transient_error(Exception):
+
+	def __init__(self, status, reason=''):
+
+		Exception.__init__(self, '%s %s' % (status, reason))
+		self.status = status
+
+def is_transient(e):
+
+	if isinstance(e, (transient_error, socket.error, httplib.HTTPException)):
+		return True
+
+	# boto.exception.S3ResponseError and friends
+
+	status = getattr(e, 'status', None)
+
+	if isinstance(status, int) and (status >= 500 or status == 429):
+		return True
+
+	if getattr(e, 'error_code', None) in ('SlowDown', 'RequestTimeout', 'InternalError', 'ServiceUnavailable'):
+		return True
+
+	return False
+
+def is_throttle(e):
+
+	return getattr(e, 'status', None) in (503, 429) or getattr(e, 'error_code', None) == 'SlowDown'
+
+# A token bucket. Takes are allowed to go into debt, which the taker then
+# waits out, so that a single take larger than the bucket still works.
+
+class tokens:
+
+	def __init__(self, rate):
+
+		self.rate = float(rate)
+		self.available = float(rate)
+		self.updated = time.time()
+		self.lock = threading.Lock()
+
+	def take(self, n=1):
+
+		if self.rate <= 0:
+			return
+
+		self.lock.acquire()
+
+		try:
+			now = time.time()
+
+			self.available = min(self.rate, self.available + (now - self.updated) * self.rate)
+			self.updated = now
+
+			self.available -= n
+			wait = -self.available / self.rate
+
+		finally:
+			self.lock.release()
+
+		if wait > 0:
+			time.sleep(wait)
+
+class scheduler:
+
+	def __init__(self, rate=0, byte_rate=0, concurrency=16, min_concurrency=1, retries=5, base_delay=0.1, max_delay=20.0, metrics=None):
+
+		self.requests = tokens(rate)
+		self.bytes = tokens(byte_rate)
+
+		self.max_concurrency = max(concurrency, 1)
+		self.min_concurrency = max(min(min_concurrency, self.max_concurrency), 1)
+		self.limit = float(self.max_concurrency)
+		self.in_flight = 0
+		self.last_cut = 0
+
+		self.retries = retries
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+
+		self.cond = threading.Condition()
+		self.metrics = metrics
+
+		self.calls = 0
+		self.retried = 0
+		self.throttled = 0
+
+	def acquire(self):
+
+		self.cond.acquire()
+
+		try:
+			while self.in_flight >= int(self.limit):
+				self.cond.wait()
+
+			self.in_flight += 1
+			self.calls += 1
+
+		finally:
+			self.cond.release()
+
+	def release(self, ok=True, throttled=False):
+
+		self.cond.acquire()
+
+		try:
+			self.in_flight -= 1
+
+			now = time.time()
+
+			# Several requests that were in flight together will all
+			# fail together, so only cut once per second
+
+			if throttled:
+				self.throttled += 1
+
+				if now - self.last_cut > 1.0:
+					self.limit = max(self.min_concurrency, self.limit / 2)
+					self.last_cut = now
+
+					logging.info('throttled by S3, concurrency limit is now %s' % int(self.limit))
+
+			elif ok and self.limit < self.max_concurrency:
+				self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+
+			self.cond.notifyAll()
+
+		finally:
+			self.cond.release()
+
+	def backoff(self, attempt):
+
+		delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+		return random.uniform(0, delay)
+
+	# Calls fn(*args, **kwargs), retrying it on transient errors. Pass
+	# nbytes=N to charge N bytes against the bandwidth limit and what=NAME
+	# to record the request's latency (and errors) under that name.
+
+	def call(self, fn, *args, **kwargs):
+
+		nbytes = kwargs.pop('nbytes', 0)
+		what = kwargs.pop('what', None)
+		attempt = 0
+
+		while True:
+
+			waited = time.time()
+
+			self.requests.take(1)
+
+			if nbytes:
+				self.bytes.take(nbytes)
+
+			self.acquire()
+
+			start = time.time()
+
+			if self.metrics:
+				self.metrics.timing('scheduler.wait', start - waited)
+
+			try:
+				rsp = fn(*args, **kwargs)
+
+			except Exception, e:
+
+				throttled = is_throttle(e)
+				self.release(False, throttled)
+
+				if self.metrics and what:
+					self.metrics.incr('request.%s.errors' % what)
+
+					if throttled:
+						self.metrics.incr('request.%s.throttled' % what)
+
+				if attempt >= self.retries or not is_transient(e):
+					raise
+
+				delay = self.backoff(attempt)
+				attempt += 1
+
+				self.cond.acquire()
+				self.retried += 1
+				self.cond.release()
+
+				logging.warning('%s, retrying in %.2fs (attempt %s of %s)' % (e, delay, attempt, self.retries))
+				time.sleep(delay)
+
+				continue
+
+			self.release(True)
+
+			if self.metrics and what:
+				self.metrics.timing('request.%s' % what, time.time() - start)
+
+			return rsp